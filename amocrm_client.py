@@ -0,0 +1,302 @@
+"""
+HTTP-клиент к AmoCRM API v4.
+Одна ClientSession на всё время жизни приложения: keep-alive, пул соединений,
+кэш DNS и таймауты настраиваются через переменные окружения.
+"""
+
+import os
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import quote
+
+import aiohttp
+import yarl
+from fastapi import HTTPException
+
+import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация из переменных окружения
+AMOCRM_SUBDOMAIN = os.getenv("AMOCRM_SUBDOMAIN", "stavgeo26")
+AMOCRM_ACCESS_TOKEN = os.getenv("AMOCRM_ACCESS_TOKEN")  # Долгосрочный токен
+
+# Параметры пула соединений
+AMO_HTTP_LIMIT = int(os.getenv("AMO_HTTP_LIMIT", "100"))                    # всего соединений
+AMO_HTTP_LIMIT_PER_HOST = int(os.getenv("AMO_HTTP_LIMIT_PER_HOST", "20"))   # на один хост
+AMO_HTTP_KEEPALIVE = float(os.getenv("AMO_HTTP_KEEPALIVE", "60"))           # сек. простоя соединения
+AMO_DNS_TTL = int(os.getenv("AMO_DNS_TTL", "300"))                          # сек. кэша DNS
+AMO_HTTP_TIMEOUT = float(os.getenv("AMO_HTTP_TIMEOUT", "30"))               # общий таймаут запроса
+AMO_HTTP_CONNECT_TIMEOUT = float(os.getenv("AMO_HTTP_CONNECT_TIMEOUT", "10"))
+
+# Сколько страниц списка запрашивать одновременно при полном обходе
+AMO_PAGE_CONCURRENCY = int(os.getenv("AMO_PAGE_CONCURRENCY", "3"))
+AMO_PAGE_LIMIT = 250  # максимум AmoCRM v4
+
+# Одинаковые одновременные GET разделяют один запрос к AmoCRM
+AMO_COALESCE_GETS = os.getenv("AMO_COALESCE_GETS", "true").lower() in ("1", "true", "yes")
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=AMO_HTTP_LIMIT,
+        limit_per_host=AMO_HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=AMO_HTTP_KEEPALIVE,
+        ttl_dns_cache=AMO_DNS_TTL,
+        use_dns_cache=True,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=AMO_HTTP_TIMEOUT,
+        sock_connect=AMO_HTTP_CONNECT_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def start() -> None:
+    """Создать общую сессию (вызывается при старте приложения)."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+        logger.info(
+            f"AmoCRM HTTP pool: limit={AMO_HTTP_LIMIT}, per_host={AMO_HTTP_LIMIT_PER_HOST}, "
+            f"keepalive={AMO_HTTP_KEEPALIVE}s, dns_ttl={AMO_DNS_TTL}s"
+        )
+
+
+async def close() -> None:
+    """Закрыть общую сессию (вызывается при остановке приложения)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Общая сессия. Если приложение запущено без lifespan (скрипты), создаётся лениво."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+def build_url_with_params(base_url: str, params: Dict = None) -> str:
+    """
+    Строит URL с query-параметрами:
+    - сохраняет [] в ключах (filter[type][])
+    - безопасно кодирует значения
+    - поддерживает повторяющиеся ключи через list
+    """
+    if not params:
+        return base_url
+
+    parts = []
+    for key, value in params.items():
+        if value is None:
+            continue
+
+        safe_key = quote(str(key), safe="[]")
+        if isinstance(value, list):
+            for item in value:
+                if item is None:
+                    continue
+                parts.append(f"{safe_key}={quote(str(item), safe='')}")
+        else:
+            parts.append(f"{safe_key}={quote(str(value), safe='')}")
+
+    if parts:
+        return f"{base_url}?{'&'.join(parts)}"
+    return base_url
+
+
+async def _read_response(response: aiohttp.ClientResponse, method: str):
+    if method == "DELETE" and response.status in (200, 202, 204):
+        # У AmoCRM при успешном удалении часто 204 и пустой ответ
+        return {"status": "deleted", "code": response.status}
+    if response.status == 204:
+        return {"status": "no_content", "code": 204}
+    try:
+        return await response.json()
+    except Exception:
+        return {"code": response.status, "text": await response.text()}
+
+
+class _Flight:
+    """Запрос в полёте и число тех, кто ждёт его ответа."""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class RequestCoalescer:
+    """
+    Single-flight для GET: пока запрос с тем же ключом в полёте, новые вызовы
+    не идут в AmoCRM, а ждут его ответ. Ответ общий для всех ожидающих (как
+    и у кэша справочников) — его не изменяют на месте. Запрос выполняется
+    отдельной задачей: отмена одного клиента не обрывает его для остальных,
+    а когда не осталось ни одного ожидающего — задача отменяется.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    @staticmethod
+    def key(endpoint: str, params: Dict = None, level: int = rate_limiter.PRIORITY_NORMAL) -> str:
+        """
+        Канонический ключ: приоритет + путь + параметры в порядке ключей (порядок
+        значений списка сохраняется). Запросы из разных очередей не объединяются,
+        иначе интерактивный вызов ждал бы в очереди массового.
+        """
+        url = build_url_with_params(endpoint, dict(sorted((params or {}).items(), key=lambda kv: str(kv[0]))))
+        return f"{level}:{url}"
+
+    async def run(self, key: str, request: Callable[[], Awaitable]):
+        flight = self._inflight.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = _Flight(asyncio.ensure_future(request()))
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+        else:
+            self.followers += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Убрать из таблицы до отмены: новый вызов не должен присоединиться к отменённой задаче
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                flight.task.cancel()
+
+    def _finish(self, key: str, flight: _Flight) -> None:
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        if not flight.task.cancelled():
+            flight.task.exception()  # ошибка уже доставлена ожидающим; не логировать как потерянную
+
+    def stats(self) -> dict:
+        total = self.leaders + self.followers
+        return {
+            "enabled": AMO_COALESCE_GETS,
+            "in_flight": len(self._inflight),
+            "upstream_requests": self.leaders,
+            "coalesced": self.followers,
+            "hit_ratio": round(self.followers / total, 4) if total else 0.0,
+        }
+
+
+coalescer = RequestCoalescer()
+
+
+async def make_amocrm_request(endpoint: str, method: str = "GET", data: Dict = None, params: Dict = None):
+    """Выполняет запрос к AmoCRM API через общий пул соединений"""
+    if not AMOCRM_ACCESS_TOKEN:
+        raise HTTPException(status_code=400, detail="AmoCRM access token не настроен")
+
+    method = method.upper()
+    if method not in ("GET", "POST", "PATCH", "DELETE"):
+        raise HTTPException(status_code=400, detail=f"Неподдерживаемый метод: {method}")
+
+    if method == "GET" and AMO_COALESCE_GETS:
+        return await coalescer.run(
+            coalescer.key(endpoint, params, rate_limiter.current_priority()),
+            lambda: _send_request(endpoint, method, data, params),
+        )
+    return await _send_request(endpoint, method, data, params)
+
+
+async def _send_request(endpoint: str, method: str, data: Dict = None, params: Dict = None):
+    # Строим URL вручную, чтобы скобки [] не кодировались
+    base_url = f"https://{AMOCRM_SUBDOMAIN}.amocrm.ru{endpoint}"
+    url = build_url_with_params(base_url, params) if method == "GET" else base_url
+
+    headers = {
+        "Authorization": f"Bearer {AMOCRM_ACCESS_TOKEN}",
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+
+    logger.info(f"AmoCRM request: {method} {url}")
+
+    session = get_session()
+    target = yarl.URL(url, encoded=True) if method == "GET" else url
+    body = data if method in ("POST", "PATCH") else None
+    attempt = 0
+    while True:
+        # Все исходящие запросы проходят через общий token bucket
+        await rate_limiter.limiter.acquire()
+        try:
+            async with session.request(method, target, headers=headers, json=body) as response:
+                if response.status != 429:
+                    return await _read_response(response, method)
+                retry_after = rate_limiter.parse_retry_after(response.headers.get("Retry-After"))
+                delay = rate_limiter.limiter.throttle(retry_after, attempt)
+                if attempt >= rate_limiter.AMO_RETRY_MAX:
+                    logger.warning(f"AmoCRM 429: попытки исчерпаны, {method} {url}")
+                    return await _read_response(response, method)
+        except Exception as e:
+            logger.error(f"Ошибка запроса к AmoCRM: {str(e)}")
+            raise HTTPException(status_code=500, detail=f"Ошибка запроса к AmoCRM: {str(e)}")
+
+        attempt += 1
+        rate_limiter.limiter.retries += 1
+        logger.warning(f"AmoCRM 429: повтор {attempt}/{rate_limiter.AMO_RETRY_MAX} через {delay:.2f}s, {method} {url}")
+        await asyncio.sleep(delay)
+
+
+async def iter_pages(
+    endpoint: str,
+    embedded_key: str,
+    params: Dict = None,
+    concurrency: Optional[int] = None,
+    level: int = rate_limiter.PRIORITY_BULK,
+) -> AsyncIterator[List[dict]]:
+    """
+    Обходит все страницы списка AmoCRM и отдаёт элементы постранично, по порядку.
+    Одновременно в полёте не больше concurrency страниц (каждая — через общий
+    token bucket с приоритетом level), поэтому память ограничена окном,
+    а не размером выборки.
+    """
+    concurrency = max(1, concurrency or AMO_PAGE_CONCURRENCY)
+    base_params = dict(params or {})
+    limit = min(int(base_params.pop("limit", None) or AMO_PAGE_LIMIT), AMO_PAGE_LIMIT)
+    next_page = int(base_params.pop("page", None) or 1)
+
+    async def fetch_page(page: int):
+        with rate_limiter.priority(level):
+            return await make_amocrm_request(endpoint, "GET", params={**base_params, "limit": limit, "page": page})
+
+    def fetch(page: int) -> asyncio.Future:
+        return asyncio.ensure_future(fetch_page(page))
+
+    window: deque = deque()
+    try:
+        while True:
+            while len(window) < concurrency:
+                window.append(fetch(next_page))
+                next_page += 1
+
+            result = await window.popleft()
+            if isinstance(result, dict) and result.get("code") == 204:
+                return  # страницы закончились
+            items = (result.get("_embedded") or {}).get(embedded_key) if isinstance(result, dict) else None
+            if items is None:
+                raise HTTPException(status_code=502, detail=f"Некорректный ответ AmoCRM: {str(result)[:300]}")
+            if items:
+                yield items
+            if len(items) < limit or not (result.get("_links") or {}).get("next"):
+                return
+    finally:
+        # Страницы за концом списка (или при отмене клиента) больше не нужны
+        for task in window:
+            task.cancel()
@@ -1,31 +1,106 @@
 from fastapi import FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any, List, Union
+from contextlib import asynccontextmanager
 import os
-import aiohttp
-import yarl
 import logging
 import time
 import json
 import asyncio
 import uuid
-from urllib.parse import quote
 from dotenv import load_dotenv
-import chat_storage
 
-# Загрузка переменных окружения из .env файла
+# Загрузка переменных окружения из .env файла (до импорта модулей, читающих окружение)
 load_dotenv()
 
+import chat_storage
+import entity_store
+import deal_analytics
+import lead_snapshot
+import sync_engine
+import amocrm_client
+import rate_limiter
+import reference_cache
+import webhook_queue
+import mcp_transport
+import session_broker
+import tool_registry
+from tool_registry import ToolArgumentError
+from amocrm_client import (
+    AMOCRM_SUBDOMAIN,
+    AMOCRM_ACCESS_TOKEN,
+    make_amocrm_request,
+)
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+async def _chat_retention_loop():
+    """Периодический перенос старых чат-сообщений в архив."""
+    while True:
+        try:
+            result = await chat_storage.run_in_writer(chat_storage.archive_old_messages)
+            if result["archived"]:
+                logger.info(f"Chat retention: в архив перенесено {result['archived']} сообщений ({', '.join(result['months'])}), освобождено страниц: {result['freed_pages']}")
+        except Exception as e:
+            logger.error(f"Chat retention: ошибка архивации: {e}")
+        await asyncio.sleep(chat_storage.CHAT_ARCHIVE_INTERVAL)
+
+
+async def _chat_compact():
+    """Однократное уплотнение базы чатов после старта (не задерживает приём запросов)."""
+    try:
+        result = await chat_storage.run_in_writer(chat_storage.compact_db)
+    except Exception as e:
+        logger.error(f"Chat storage: ошибка VACUUM: {e}")
+        return
+    if result is not None:
+        logger.info(
+            f"Chat storage: VACUUM ({result['reason']}) за {result['seconds']}s, "
+            f"{result['size_before'] // 2**20} → {result['size_after'] // 2**20} MB"
+        )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Общие ресурсы на время жизни приложения."""
+    chat_storage.init_db()
+    await amocrm_client.start()
+    await webhooks.start()
+    await mcp_broker.start()
+    if entity_store.ENTITY_STORE_ENABLED:
+        await entity_store.mirror.start()
+        await sync_engine.engine.start()
+    retention = asyncio.create_task(_chat_retention_loop()) if chat_storage.CHAT_RETENTION_DAYS > 0 else None
+    compaction = asyncio.create_task(_chat_compact())
+    try:
+        yield
+    finally:
+        # VACUUM в потоке не прервать: close_db() дождётся его завершения
+        compaction.cancel()
+        if retention is not None:
+            retention.cancel()
+            await asyncio.gather(retention, return_exceptions=True)
+        # Сначала дообрабатываем принятые вебхуки, потом закрываем ресурсы
+        await webhooks.stop()
+        await mcp_broker.close()
+        await mcp_transport.keepalive.stop()
+        if entity_store.ENTITY_STORE_ENABLED:
+            await sync_engine.engine.stop()
+            await entity_store.mirror.close()
+        await amocrm_client.close()
+        chat_storage.close_db()
+
+
 app = FastAPI(
     title="AmoCRM MCP Server",
     description="Сервер для интеграции с AmoCRM API через долгосрочный токен",
-    version="3.0.0"
+    version="3.0.0",
+    lifespan=lifespan,
 )
 
 # Добавляем CORS для ChatGPT
@@ -37,10 +112,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Конфигурация из переменных окружения
-AMOCRM_SUBDOMAIN = os.getenv("AMOCRM_SUBDOMAIN", "stavgeo26")
-AMOCRM_ACCESS_TOKEN = os.getenv("AMOCRM_ACCESS_TOKEN")  # Долгосрочный токен
-
 # Модели данных
 class EntityRequest(BaseModel):
     entity_type: str = Field(..., description="Тип сущности: leads, contacts, companies, tasks, customers")
@@ -53,6 +124,9 @@ class EntityRequest(BaseModel):
     )
     params: Optional[Dict[str, Any]] = Field(None, description="Параметры запроса для get")
 
+# Реестр MCP-инструментов; REST-эндпоинты событий, задач, контактов и примечаний вызывают те же обработчики
+tools = tool_registry.ToolRegistry()
+
 class WebhookData(BaseModel):
     leads: Optional[Dict[str, Any]] = None
     contacts: Optional[Dict[str, Any]] = None
@@ -80,13 +154,20 @@ async def root():
             "tasks": "/api/tasks",
             "contacts": "/api/contacts",
             "notes": "/api/notes/{entity_type}/{entity_id}",
+            "lead_full": "/api/lead/{lead_id}/full",
             "v4_proxy": "/api/v4-proxy/{path}",
+            "metrics": "/api/metrics",
+            "cache_invalidate": "/api/cache/invalidate",
             "webhooks": "/webhooks/receive",
             "chat_by_lead": "/api/chat/lead/{lead_id}",
             "chat_by_contact": "/api/chat/contact/{contact_id}",
             "chat_recent": "/api/chat/recent",
             "chat_search": "/api/chat/search?q=текст",
-            "chat_stats": "/api/chat/stats"
+            "chat_stats": "/api/chat/stats",
+            "chat_archive": "/api/chat/archive",
+            "sync_status": "/api/sync/status",
+            "deals_aggregate": "/api/report/deals/aggregate",
+            "deals_snapshot": "/api/report/deals/snapshot"
         }
     }
 
@@ -95,101 +176,100 @@ async def health_check():
     """Health check для Railway"""
     return {"status": "healthy", "timestamp": int(time.time())}
 
-def build_url_with_params(base_url: str, params: Dict = None) -> str:
-    """
-    Строит URL с query-параметрами:
-    - сохраняет [] в ключах (filter[type][])
-    - безопасно кодирует значения
-    - поддерживает повторяющиеся ключи через list
-    """
-    if not params:
-        return base_url
-
-    parts = []
-    for key, value in params.items():
-        if value is None:
-            continue
-
-        safe_key = quote(str(key), safe="[]")
-        if isinstance(value, list):
-            for item in value:
-                if item is None:
-                    continue
-                parts.append(f"{safe_key}={quote(str(item), safe='')}")
-        else:
-            parts.append(f"{safe_key}={quote(str(value), safe='')}")
-
-    if parts:
-        return f"{base_url}?{'&'.join(parts)}"
-    return base_url
+@app.get("/api/metrics")
+async def get_metrics():
+    """Метрики очередей и лимитов для настройки сервера"""
+    return {
+        "rate_limiter": rate_limiter.limiter.stats(),
+        "request_coalescing": amocrm_client.coalescer.stats(),
+        "reference_cache": reference_cache.cache.stats(),
+        "webhook_queue": webhooks.stats(),
+        "mcp_sessions": mcp_broker.stats(),
+        "mcp_keepalive": mcp_transport.keepalive.stats(),
+        "lead_snapshot": lead_snapshots.stats(),
+        "entity_store": {
+            **entity_store.mirror.stats(),
+            "state": await chat_storage.run_in_db(entity_store.sync_state) if entity_store.ENTITY_STORE_ENABLED else {},
+        },
+    }
 
 
-async def make_amocrm_request(endpoint: str, method: str = "GET", data: Dict = None, params: Dict = None):
-    """Выполняет запрос к AmoCRM API"""
-    if not AMOCRM_ACCESS_TOKEN:
-        raise HTTPException(status_code=400, detail="AmoCRM access token не настроен")
+@app.get("/api/sync/status")
+async def sync_status():
+    """Состояние дельта-синхронизации локального зеркала: отметки updated_at и отставание"""
+    if not entity_store.ENTITY_STORE_ENABLED:
+        return {"enabled": False}
+    return await sync_engine.engine.status()
 
-    # Строим URL вручную, чтобы скобки [] не кодировались
-    base_url = f"https://{AMOCRM_SUBDOMAIN}.amocrm.ru{endpoint}"
-    url = build_url_with_params(base_url, params) if method.upper() == "GET" else base_url
 
-    headers = {
-        "Authorization": f"Bearer {AMOCRM_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
+@app.post("/api/sync/run")
+async def sync_run():
+    """Запустить дельта-опрос AmoCRM сейчас, не дожидаясь интервала"""
+    if not entity_store.ENTITY_STORE_ENABLED:
+        raise HTTPException(status_code=400, detail="Локальное зеркало выключено (ENTITY_STORE_ENABLED)")
+    if not sync_engine.engine.trigger():
+        return {"status": "skipped", "detail": "Синхронизацию ведёт другой воркер"}
+    return {"status": "triggered"}
 
-    logger.info(f"AmoCRM request: {method} {url}")
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            if method.upper() == "GET":
-                async with session.get(yarl.URL(url, encoded=True), headers=headers) as response:
-                    if response.status == 204:
-                        return {"status": "no_content", "code": 204}
-                    try:
-                        return await response.json()
-                    except Exception:
-                        return {"code": response.status, "text": await response.text()}
-            elif method.upper() == "POST":
-                async with session.post(url, headers=headers, json=data) as response:
-                    if response.status == 204:
-                        return {"status": "no_content", "code": 204}
-                    try:
-                        return await response.json()
-                    except Exception:
-                        return {"code": response.status, "text": await response.text()}
-            elif method.upper() == "PATCH":
-                async with session.patch(url, headers=headers, json=data) as response:
-                    if response.status == 204:
-                        return {"status": "no_content", "code": 204}
-                    try:
-                        return await response.json()
-                    except Exception:
-                        return {"code": response.status, "text": await response.text()}
-            elif method.upper() == "DELETE":
-                async with session.delete(url, headers=headers) as response:
-                    if response.status in (200, 202, 204):
-                        # У AmoCRM при успешном удалении часто 204 и пустой ответ
-                        return {"status": "deleted", "code": response.status}
-                    try:
-                        return await response.json()
-                    except Exception:
-                        return {"code": response.status, "text": await response.text()}
-        except Exception as e:
-            logger.error(f"Ошибка запроса к AmoCRM: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Ошибка запроса к AmoCRM: {str(e)}")
+@app.post("/api/cache/invalidate")
+async def invalidate_cache(resource: Optional[str] = Query(None, description="account, pipelines, users, custom_fields, loss_reasons; пусто — весь кэш")):
+    """Сброс кэша справочников"""
+    if resource and resource not in reference_cache.RESOURCE_TTLS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный ресурс: {resource}")
+    removed = reference_cache.cache.invalidate(resource)
+    return {"status": "invalidated", "resource": resource or "all", "removed": removed}
 
 @app.get("/api/account")
 async def get_account(authorization: Optional[str] = Header(None)):
     """Получение информации об аккаунте"""
     try:
-        result = await make_amocrm_request("/api/v4/account")
-        return result
+        return await reference_cache.cache.get_or_fetch(
+            "account", None, lambda: make_amocrm_request("/api/v4/account")
+        )
     except Exception as e:
         logger.error(f"Ошибка получения аккаунта: {str(e)}")
         return {"error": str(e), "status": "error"}
 
+# ---------- Локальное зеркало сущностей (entity_store) ----------
+
+async def _local_entity(entity_type: str, entity_id: int) -> Optional[dict]:
+    """Сущность из локального зеркала с отметкой свежести; None — читать из AmoCRM."""
+    watermark = await entity_store.local_ready(entity_type)
+    if watermark is None:
+        return None
+    entity = await chat_storage.run_in_db(entity_store.get_entity, entity_type, entity_id)
+    if entity is None:
+        return None
+    entity["_local"] = watermark
+    return entity
+
+
+async def _local_list(entity_type: str, limit: int, page: int, **filters) -> Optional[dict]:
+    """Страница из локального зеркала в формате ответа AmoCRM; None — читать из AmoCRM."""
+    watermark = await entity_store.local_ready(entity_type)
+    if watermark is None:
+        return None
+    items = await chat_storage.run_in_db(entity_store.list_entities, entity_type, limit, page, **filters)
+    if not items and filters.get("query"):
+        # Поиск AmoCRM шире локальной подстроки (форматы телефонов и т.п.)
+        return None
+    return {"_page": page, "_embedded": {entity_type: items}, "_local": watermark}
+
+
+async def _iter_local_pages(entity_type: str, **filters):
+    """Все сущности из локального зеркала страницами по AMO_PAGE_LIMIT (keyset по id)."""
+    after_id = 0
+    while True:
+        items = await chat_storage.run_in_db(
+            entity_store.entities_after, entity_type, after_id, amocrm_client.AMO_PAGE_LIMIT, **filters
+        )
+        if not items:
+            return
+        yield items
+        after_id = items[-1]["id"]
+
+
 @app.post("/api/entities")
 async def handle_entities(request: EntityRequest, authorization: Optional[str] = Header(None)):
     """Универсальный эндпоинт для работы с сущностями AmoCRM"""
@@ -201,6 +281,10 @@ async def handle_entities(request: EntityRequest, authorization: Optional[str] =
         
         # Выполняем запрос
         if request.method.lower() == "get":
+            if request.entity_id and not request.params:
+                local = await _local_entity(request.entity_type, request.entity_id)
+                if local is not None:
+                    return local
             result = await make_amocrm_request(endpoint, "GET", params=request.params)
         elif request.method.lower() in ["post", "create"]:
             # Нормализуем формат: для POST ожидаем массив объектов
@@ -246,8 +330,9 @@ async def get_pipelines(pipeline_id: Optional[int] = Query(None), authorization:
         if pipeline_id:
             endpoint += f"/{pipeline_id}"
         
-        result = await make_amocrm_request(endpoint, "GET")
-        return result
+        return await reference_cache.cache.get_or_fetch(
+            "pipelines", pipeline_id or None, lambda: make_amocrm_request(endpoint, "GET")
+        )
     except Exception as e:
         logger.error(f"Ошибка получения воронок: {str(e)}")
         return {"error": str(e), "status": "error"}
@@ -260,8 +345,9 @@ async def get_users(user_id: Optional[int] = Query(None), authorization: Optiona
         if user_id:
             endpoint += f"/{user_id}"
         
-        result = await make_amocrm_request(endpoint, "GET")
-        return result
+        return await reference_cache.cache.get_or_fetch(
+            "users", user_id or None, lambda: make_amocrm_request(endpoint, "GET")
+        )
     except Exception as e:
         logger.error(f"Ошибка получения пользователей: {str(e)}")
         return {"error": str(e), "status": "error"}
@@ -271,15 +357,48 @@ async def get_custom_fields(entity_type: str, authorization: Optional[str] = Hea
     """Получение пользовательских полей для типа сущности"""
     try:
         endpoint = f"/api/v4/{entity_type}/custom_fields"
-        result = await make_amocrm_request(endpoint, "GET")
-        return result
+        return await reference_cache.cache.get_or_fetch(
+            "custom_fields", entity_type, lambda: make_amocrm_request(endpoint, "GET")
+        )
     except Exception as e:
         logger.error(f"Ошибка получения полей: {str(e)}")
         return {"error": str(e), "status": "error"}
 
+async def _process_webhooks(payloads: List[Any]) -> None:
+    """Обработка пачки вебхуков из очереди: кэш справочников, локальное зеркало сущностей и чат-сообщения."""
+    messages = []
+    for payload in payloads:
+        logger.info(f"Webhook: {json.dumps(payload, ensure_ascii=False, default=str)[:500]}")
+        reference_cache.invalidate_from_webhook(payload)
+        messages.extend(chat_storage.parse_webhook_messages(payload))
+
+    if entity_store.ENTITY_STORE_ENABLED:
+        try:
+            applied = await entity_store.mirror.apply_webhooks(payloads)
+            if applied:
+                logger.info(f"Entity store: по вебхукам {applied}")
+        except Exception as e:
+            entity_store.mirror.errors += 1
+            logger.error(f"Entity store: ошибка применения вебхуков: {e}")
+
+    if not messages:
+        return
+    saved = await chat_storage.run_in_writer(chat_storage.save_messages, messages)
+    for msg in messages:
+        logger.info(f"💬 {msg.get('origin')} | {msg.get('author_name')}: {msg.get('text', '')[:80]}")
+    logger.info(f"Webhook batch: {len(payloads)} вебхуков, сообщений сохранено {saved['inserted']}, дубликатов {saved['duplicates']}")
+
+
+webhooks = webhook_queue.WebhookQueue(_process_webhooks)
+
+
 @app.post("/webhooks/receive")
 async def receive_webhook(request: Request):
-    """Приём вебхуков от AmoCRM — включая чат-сообщения."""
+    """
+    Приём вебхуков от AmoCRM — включая чат-сообщения.
+    Тело только проверяется и ставится в очередь, ответ — сразу
+    (AmoCRM повторяет вебхуки, на которые долго нет ответа).
+    """
     try:
         try:
             payload = await request.json()
@@ -287,14 +406,17 @@ async def receive_webhook(request: Request):
             form = await request.form()
             payload = {k: v for k, v in form.items()}
 
-        logger.info(f"Webhook: {json.dumps(payload, ensure_ascii=False, default=str)[:500]}")
-
-        messages = chat_storage.parse_webhook_messages(payload)
-        saved = sum(1 for msg in messages if chat_storage.save_message(msg))
-        for msg in messages:
-            logger.info(f"💬 {msg.get('origin')} | {msg.get('author_name')}: {msg.get('text', '')[:80]}")
+        if not isinstance(payload, dict):
+            return {"status": "error", "detail": "Ожидается JSON-объект или form-data"}
 
-        return {"status": "received", "chat_messages_saved": saved}
+        if not webhooks.enqueue(payload):
+            # Очередь переполнена: просим AmoCRM повторить позже
+            return JSONResponse(
+                status_code=503,
+                content={"status": "busy", "detail": "Очередь вебхуков переполнена"},
+                headers={"Retry-After": "5"},
+            )
+        return {"status": "queued"}
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return {"status": "error", "detail": str(e)}
@@ -303,8 +425,9 @@ async def receive_webhook(request: Request):
 async def get_loss_reasons(authorization: Optional[str] = Header(None)):
     """Получение списка причин потери сделок"""
     try:
-        result = await make_amocrm_request("/api/v4/leads/loss_reasons", "GET")
-        return result
+        return await reference_cache.cache.get_or_fetch(
+            "loss_reasons", None, lambda: make_amocrm_request("/api/v4/leads/loss_reasons", "GET")
+        )
     except Exception as e:
         logger.error(f"Ошибка получения причин потери: {str(e)}")
         return {"error": str(e), "status": "error"}
@@ -324,7 +447,6 @@ async def get_events(
 ):
     """Получение событий из amoCRM (почта, звонки, чаты)"""
     try:
-        params = {}
         type_values: List[str] = []
 
         if type:
@@ -338,31 +460,15 @@ async def get_events(
             if key.startswith("filter[type][") and key.endswith("]") and value:
                 type_values.append(value)
 
-        if type_values:
-            params["filter[type][]"] = type_values
-
-        if date_from:
-            # Если пришла ISO дата, конвертируем в unix timestamp
-            try:
-                ts = int(date_from)
-            except ValueError:
-                from datetime import datetime
-                dt = datetime.fromisoformat(date_from.replace("Z", "+00:00"))
-                ts = int(dt.timestamp())
-            params["filter[created_at][from]"] = ts
-        if date_to:
-            try:
-                ts = int(date_to)
-            except ValueError:
-                from datetime import datetime
-                dt = datetime.fromisoformat(date_to.replace("Z", "+00:00"))
-                ts = int(dt.timestamp())
-            params["filter[created_at][to]"] = ts
-        params["limit"] = min(limit, 100)
-        params["page"] = page
-
-        result = await make_amocrm_request("/api/v4/events", "GET", params=params)
-        return result
+        return await tools.call("get_events", {
+            "type": ",".join(dict.fromkeys(type_values)) or None,
+            "date_from": date_from,
+            "date_to": date_to,
+            "limit": limit,
+            "page": page,
+        })
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка получения событий: {str(e)}")
         return {"error": str(e), "status": "error"}
@@ -380,14 +486,14 @@ async def get_tasks(
 ):
     """Получение задач из amoCRM"""
     try:
-        params = {"limit": min(limit, 250), "page": page}
-        if is_completed is not None:
-            params["filter[is_completed]"] = is_completed
-        if responsible_user_id:
-            params["filter[responsible_user_id]"] = responsible_user_id
-
-        result = await make_amocrm_request("/api/v4/tasks", "GET", params=params)
-        return result
+        return await tools.call("get_tasks", {
+            "is_completed": is_completed,
+            "responsible_user_id": responsible_user_id,
+            "limit": limit,
+            "page": page,
+        })
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка получения задач: {str(e)}")
         return {"error": str(e), "status": "error"}
@@ -420,14 +526,14 @@ async def get_contacts_endpoint(
 ):
     """Получение контактов из amoCRM с возможностью поиска"""
     try:
-        params = {"limit": min(limit, 250), "page": page}
-        if query:
-            params["query"] = query
-        if with_leads:
-            params["with"] = "leads"
-
-        result = await make_amocrm_request("/api/v4/contacts", "GET", params=params)
-        return result
+        return await tools.call("get_contacts", {
+            "query": query,
+            "limit": limit,
+            "with_leads": with_leads,
+            "page": page,
+        })
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка получения контактов: {str(e)}")
         return {"error": str(e), "status": "error"}
@@ -444,20 +550,45 @@ async def get_notes(
     note_type: Optional[str] = Query(None, description="Тип примечания (common, call_in, call_out, sms_in, sms_out и т.д.)"),
     authorization: Optional[str] = Header(None)
 ):
-    """Получение примечаний к сущности (leads, contacts, companies)"""
+    """Получение примечаний к сущности (leads, contacts, companies, customers)"""
     try:
-        params = {"limit": min(limit, 250), "page": page}
-        if note_type:
-            params["filter[note_type]"] = note_type
-
-        endpoint = f"/api/v4/{entity_type}/{entity_id}/notes"
-        result = await make_amocrm_request(endpoint, "GET", params=params)
-        return result
+        return await tools.call("get_notes", {
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "limit": limit,
+            "page": page,
+            "note_type": note_type,
+        })
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка получения примечаний: {str(e)}")
         return {"error": str(e), "status": "error"}
 
 
+# ========== КАРТОЧКА СДЕЛКИ ==========
+
+@app.get("/api/lead/{lead_id}/full")
+async def get_lead_full(
+    lead_id: int,
+    limit: Optional[int] = Query(50, description="Сколько примечаний, задач и сообщений чата вернуть"),
+    include_archive: bool = Query(False, description="Добавить сообщения чата из архива"),
+    authorization: Optional[str] = Header(None)
+):
+    """Сделка с контактами, примечаниями, задачами и чатами одним ответом (запросы параллельно)"""
+    try:
+        return await tools.call("get_lead_context", {
+            "lead_id": lead_id,
+            "limit": limit,
+            "include_archive": include_archive,
+        })
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка получения карточки сделки: {str(e)}")
+        return {"error": str(e), "status": "error"}
+
+
 # ========== УНИВЕРСАЛЬНЫЙ ПРОКСИ К amoCRM API v4 ==========
 
 @app.api_route("/api/v4-proxy/{path:path}", methods=["GET", "POST", "PATCH", "DELETE"])
@@ -486,6 +617,72 @@ async def proxy_amocrm_v4(path: str, request: Request, authorization: Optional[s
         return {"error": str(e), "status": "error"}
 
 
+def _deals_report_params(
+    query: Optional[str],
+    created_at_from: Optional[int],
+    updated_at_from: Optional[int],
+    status_id: Optional[int],
+    pipeline_id: Optional[int],
+) -> Dict[str, Any]:
+    """Параметры AmoCRM для отчёта по сделкам."""
+    params = {}
+    if query:
+        params["query"] = query
+    if created_at_from:
+        params["filter[created_at][from]"] = created_at_from
+    if updated_at_from:
+        params["filter[updated_at][from]"] = updated_at_from
+    if status_id:
+        params["filter[statuses][0][status_id]"] = status_id
+    if pipeline_id:
+        params["filter[statuses][0][pipeline_id]"] = pipeline_id
+
+    # Добавляем дополнительные поля для более подробной информации
+    params["with"] = "contacts,companies,loss_reason"
+    return params
+
+
+async def _stream_deals_report(source, filters: Dict[str, Any], watermark: Optional[dict] = None):
+    """
+    NDJSON-поток отчёта по всем страницам source (AmoCRM или локальное зеркало):
+    по строке на сделку и строка summary после каждой страницы
+    (итоги накапливаются, сделки не хранятся).
+    """
+    total_count = 0
+    total_amount = 0
+    pages = 0
+    try:
+        async for leads in source:
+            pages += 1
+            lines = []
+            for lead in leads:
+                total_count += 1
+                total_amount += lead.get("price") or 0
+                lines.append(json.dumps({"type": "lead", "data": lead}, ensure_ascii=False))
+            lines.append(json.dumps({
+                "type": "summary",
+                "final": False,
+                "pages": pages,
+                "total_count": total_count,
+                "total_amount": total_amount,
+            }, ensure_ascii=False))
+            yield "\n".join(lines) + "\n"
+    except Exception as e:
+        logger.error(f"Ошибка потокового отчета по сделкам: {str(e)}")
+        yield json.dumps({"type": "error", "error": str(e), "pages": pages}, ensure_ascii=False) + "\n"
+        return
+
+    yield json.dumps({
+        "type": "summary",
+        "final": True,
+        "pages": pages,
+        "total_count": total_count,
+        "total_amount": total_amount,
+        "filters_applied": filters,
+        **({"_local": watermark} if watermark else {}),
+    }, ensure_ascii=False) + "\n"
+
+
 @app.get("/api/report/deals")
 async def get_deals_report(
     query: Optional[str] = Query(None, description="Поисковый запрос для фильтрации сделок"),
@@ -495,34 +692,50 @@ async def get_deals_report(
     pipeline_id: Optional[int] = Query(None, description="ID воронки продаж"),
     limit: Optional[int] = Query(250, description="Количество сделок за один запрос (макс 250)"),
     page: Optional[int] = Query(1, description="Номер страницы для пагинации"),
+    all_pages: bool = Query(False, description="Обойти все страницы на сервере и вернуть NDJSON-поток"),
     authorization: Optional[str] = Header(None)
 ):
     """
     Получение отчета по сделкам.
     Позволяет фильтровать сделки по дате создания, обновления, статусу, воронке и поисковому запросу.
     Теперь с поддержкой пагинации - можно получить до 250 сделок за раз.
+    С all_pages=true сервер сам обходит все страницы и отдаёт application/x-ndjson.
     """
+    filters = {
+        "query": query,
+        "created_at_from": created_at_from,
+        "updated_at_from": updated_at_from,
+        "status_id": status_id,
+        "pipeline_id": pipeline_id
+    }
     try:
         # Формируем параметры для AmoCRM API
-        params = {}
-        
-        if query:
-            params["query"] = query
-        if created_at_from:
-            params["filter[created_at][from]"] = created_at_from
-        if updated_at_from:
-            params["filter[updated_at][from]"] = updated_at_from
-        if status_id:
-            params["filter[statuses][0][status_id]"] = status_id
-        if pipeline_id:
-            params["filter[statuses][0][pipeline_id]"] = pipeline_id
-        
-        # Добавляем дополнительные поля для более подробной информации
-        params["with"] = "contacts,companies,loss_reason"
+        params = _deals_report_params(query, created_at_from, updated_at_from, status_id, pipeline_id)
+
+        # Без полнотекстового query отчёт строится по локальному зеркалу, если оно синхронизировано
+        local_filters = {k: v for k, v in filters.items() if k != "query"}
+        watermark = None if query else await entity_store.local_ready("leads")
+
+        if all_pages:
+            params["page"] = page
+            if watermark is not None and page == 1:
+                source = _iter_local_pages("leads", **local_filters)
+            else:
+                source = amocrm_client.iter_pages("/api/v4/leads", "leads", params)
+            return StreamingResponse(
+                _stream_deals_report(source, filters, watermark),
+                media_type="application/x-ndjson",
+            )
+
         params["limit"] = min(limit, 250)  # Максимум 250 (ограничение AmoCRM)
         params["page"] = page
-        
-        result = await make_amocrm_request("/api/v4/leads", "GET", params=params)
+
+        result = None
+        if watermark is not None:
+            result = await _local_list("leads", params["limit"], page, **local_filters)
+        if result is None:
+            with rate_limiter.priority(rate_limiter.PRIORITY_BULK):
+                result = await make_amocrm_request("/api/v4/leads", "GET", params=params)
         
         # Добавляем метаинформацию к ответу
         if "_embedded" in result and "leads" in result["_embedded"]:
@@ -534,16 +747,11 @@ async def get_deals_report(
                 "summary": {
                     "total_count": len(leads),
                     "total_amount": total_amount,
-                    "filters_applied": {
-                        "query": query,
-                        "created_at_from": created_at_from,
-                        "updated_at_from": updated_at_from,
-                        "status_id": status_id,
-                        "pipeline_id": pipeline_id
-                    }
+                    "filters_applied": filters
                 },
                 "page_info": result.get("_page", {}),
-                "_links": result.get("_links", {})
+                "_links": result.get("_links", {}),
+                **({"_local": result["_local"]} if "_local" in result else {}),
             }
         else:
             return result
@@ -553,284 +761,811 @@ async def get_deals_report(
         return {"error": str(e), "status": "error"}
 
 
+@app.get("/api/report/deals/aggregate")
+async def get_deals_aggregate(
+    group_by: Optional[str] = Query(None, description="Поля группировки через запятую: pipeline_id, status_id, responsible_user_id, loss_reason_id, created_month, closed_month"),
+    query: Optional[str] = Query(None, description="Поисковый запрос для фильтрации сделок"),
+    created_at_from: Optional[int] = Query(None, description="Дата создания (Unix Timestamp) с которой нужно начать поиск"),
+    updated_at_from: Optional[int] = Query(None, description="Дата обновления (Unix Timestamp) с которой нужно начать поиск"),
+    status_id: Optional[int] = Query(None, description="ID статуса сделки (этапа воронки)"),
+    pipeline_id: Optional[int] = Query(None, description="ID воронки продаж"),
+    percentiles: str = Query("50,90", description="Перцентили через запятую"),
+    authorization: Optional[str] = Header(None)
+):
+    """
+    Агрегаты по всем подходящим сделкам, посчитанные на сервере за один проход:
+    количество, выигранные/проигранные, конверсия, сумма/среднее/перцентили бюджета,
+    длительность цикла закрытых и возраст открытых сделок — по группам.
+    """
+    try:
+        return await tools.call("aggregate_deals", {
+            "group_by": group_by,
+            "query": query,
+            "created_at_from": created_at_from,
+            "updated_at_from": updated_at_from,
+            "status_id": status_id,
+            "pipeline_id": pipeline_id,
+            "percentiles": percentiles,
+        })
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка агрегации сделок: {str(e)}")
+        return {"error": str(e), "status": "error"}
+
+
+async def _lead_snapshot_pages():
+    """Источник снимка сделок: локальное зеркало, если синхронизировано, иначе выгрузка из AmoCRM."""
+    if await entity_store.local_ready("leads") is not None:
+        return _iter_local_pages("leads"), "local"
+    return amocrm_client.iter_pages("/api/v4/leads", "leads"), "amocrm"
+
+
+lead_snapshots = lead_snapshot.SnapshotManager(_lead_snapshot_pages)
+
+
+@app.get("/api/report/deals/snapshot")
+async def get_deals_snapshot():
+    """Состояние колоночного снимка сделок: размер, возраст, источник, TTL"""
+    return lead_snapshots.stats()
+
+
+@app.post("/api/report/deals/snapshot/refresh")
+async def refresh_deals_snapshot():
+    """Построить снимок сделок заново (одна массовая выгрузка)"""
+    try:
+        snapshot = await lead_snapshots.get(refresh=True)
+        return {"status": "refreshed", **snapshot.info()}
+    except Exception as e:
+        logger.error(f"Ошибка построения снимка сделок: {str(e)}")
+        return {"error": str(e), "status": "error"}
+
+
+@app.delete("/api/report/deals/snapshot")
+async def drop_deals_snapshot():
+    """Освободить память снимка; следующий запрос построит новый"""
+    return {"status": "dropped" if lead_snapshots.drop() else "empty"}
+
+
+@app.get("/api/report/deals/snapshot/query")
+async def query_deals_snapshot(
+    group_by: Optional[str] = Query(None, description="Поля группировки через запятую: pipeline_id, status_id, responsible_user_id, loss_reason_id, created_month, closed_month"),
+    pipeline_id: Optional[int] = Query(None, description="ID воронки"),
+    status_id: Optional[int] = Query(None, description="ID статуса"),
+    responsible_user_id: Optional[int] = Query(None, description="ID ответственного"),
+    created_at_from: Optional[str] = Query(None, description="Создана не раньше (ISO или unix timestamp)"),
+    created_at_to: Optional[str] = Query(None, description="Создана не позже (ISO или unix timestamp)"),
+    updated_at_from: Optional[str] = Query(None, description="Обновлена не раньше (ISO или unix timestamp)"),
+    updated_at_to: Optional[str] = Query(None, description="Обновлена не позже (ISO или unix timestamp)"),
+    closed_at_from: Optional[str] = Query(None, description="Закрыта не раньше (ISO или unix timestamp)"),
+    closed_at_to: Optional[str] = Query(None, description="Закрыта не позже (ISO или unix timestamp)"),
+    percentiles: str = Query("50,90", description="Перцентили через запятую"),
+    max_age: Optional[float] = Query(None, description="Допустимый возраст снимка, сек. (по умолчанию LEAD_SNAPSHOT_TTL)"),
+    refresh: bool = Query(False, description="Построить снимок заново перед запросом"),
+    authorization: Optional[str] = Header(None)
+):
+    """Агрегаты по снимку сделок в памяти: без обращений к AmoCRM, пока снимок свежий"""
+    try:
+        return await tools.call("query_deal_snapshot", {
+            "group_by": group_by,
+            "pipeline_id": pipeline_id,
+            "status_id": status_id,
+            "responsible_user_id": responsible_user_id,
+            "created_at_from": created_at_from,
+            "created_at_to": created_at_to,
+            "updated_at_from": updated_at_from,
+            "updated_at_to": updated_at_to,
+            "closed_at_from": closed_at_from,
+            "closed_at_to": closed_at_to,
+            "percentiles": percentiles,
+            "max_age": max_age,
+            "refresh": refresh,
+        })
+    except ToolArgumentError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Ошибка запроса к снимку сделок: {str(e)}")
+        return {"error": str(e), "status": "error"}
+
+
 # ========== ЧАТ-СООБЩЕНИЯ (webhook-based storage) ==========
 
+async def _chat_page(
+    field: str,
+    value,
+    limit: int,
+    cursor: Optional[str],
+    offset: int,
+    include_archive: bool,
+    include_raw: bool = False,
+):
+    """Страница горячей истории и, для первой страницы, последние limit сообщений из архива."""
+    try:
+        msgs, next_cursor = await chat_storage.run_in_db(
+            chat_storage.get_messages_page, field, value, limit, cursor, offset, include_raw
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    archived = []
+    if include_archive and not cursor and not offset:
+        archived = await chat_storage.run_in_db(
+            chat_storage.get_archived_messages, field, value, limit, include_raw=include_raw
+        )
+    return msgs, next_cursor, archived
+
 @app.get("/api/chat/lead/{lead_id}")
-async def chat_by_lead(lead_id: int, limit: int = 50, offset: int = 0):
+async def chat_by_lead(
+    lead_id: int,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = Query(None, description="next_cursor из предыдущего ответа"),
+    include_archive: bool = Query(False, description="Добавить сообщения из архива (старше срока хранения)"),
+    include_raw: bool = Query(False, description="Добавить исходный JSON вебхука (raw_payload)"),
+):
     """Сообщения чатов по ID сделки."""
-    msgs = chat_storage.get_messages_by_lead(lead_id, limit, offset)
-    return {"lead_id": lead_id, "count": len(msgs), "messages": msgs, "formatted": chat_storage.format_chat_history(msgs)}
+    msgs, next_cursor, archived = await _chat_page("lead_id", lead_id, limit, cursor, offset, include_archive, include_raw)
+    return {"lead_id": lead_id, "count": len(msgs), "messages": msgs, "next_cursor": next_cursor, "archived_count": len(archived), "archived_messages": archived, "formatted": chat_storage.format_chat_history(archived + msgs)}
 
 @app.get("/api/chat/contact/{contact_id}")
-async def chat_by_contact(contact_id: int, limit: int = 50, offset: int = 0):
+async def chat_by_contact(
+    contact_id: int,
+    limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = Query(None, description="next_cursor из предыдущего ответа"),
+    include_archive: bool = Query(False, description="Добавить сообщения из архива (старше срока хранения)"),
+    include_raw: bool = Query(False, description="Добавить исходный JSON вебхука (raw_payload)"),
+):
     """Сообщения чатов по ID контакта."""
-    msgs = chat_storage.get_messages_by_contact(contact_id, limit, offset)
-    return {"contact_id": contact_id, "count": len(msgs), "messages": msgs, "formatted": chat_storage.format_chat_history(msgs)}
+    msgs, next_cursor, archived = await _chat_page("contact_id", contact_id, limit, cursor, offset, include_archive, include_raw)
+    return {"contact_id": contact_id, "count": len(msgs), "messages": msgs, "next_cursor": next_cursor, "archived_count": len(archived), "archived_messages": archived, "formatted": chat_storage.format_chat_history(archived + msgs)}
+
+@app.get("/api/chat/archive")
+async def chat_archive():
+    """Архивные шарды и настройки хранения."""
+    archives = await chat_storage.run_in_db(chat_storage.list_archives)
+    return {
+        "retention_days": chat_storage.CHAT_RETENTION_DAYS,
+        "archive_dir": chat_storage.CHAT_ARCHIVE_DIR,
+        "archives": archives,
+    }
 
 @app.get("/api/chat/recent")
 async def chat_recent(limit: int = 20):
     """Последние сообщения из всех каналов."""
-    msgs = chat_storage.get_recent_messages(limit)
+    msgs = await chat_storage.run_in_db(chat_storage.get_recent_messages, limit)
     return {"count": len(msgs), "messages": msgs, "formatted": chat_storage.format_chat_history(msgs)}
 
 @app.get("/api/chat/search")
-async def chat_search(q: str = Query("", description="Текст для поиска"), limit: int = 20):
-    """Поиск по тексту чат-сообщений."""
-    msgs = chat_storage.search_messages(q, limit)
+async def chat_search(
+    q: str = Query("", description="Текст для поиска"),
+    limit: int = 20,
+    order: str = Query("rank", description="rank — по релевантности, recent — сначала новые"),
+):
+    """Полнотекстовый поиск по чат-сообщениям."""
+    msgs = await chat_storage.run_in_db(chat_storage.search_messages, q, limit, order)
     return {"query": q, "count": len(msgs), "messages": msgs, "formatted": chat_storage.format_chat_history(msgs)}
 
 @app.get("/api/chat/stats")
-async def chat_stats():
+async def chat_stats(days: int = Query(7, description="Сколько последних дней показать в разбивке daily")):
     """Статистика по чат-сообщениям."""
-    return chat_storage.get_stats()
+    return await chat_storage.run_in_db(chat_storage.get_stats, days)
 
 
 # ========================================================================
 # MCP SSE TRANSPORT (spec: https://spec.modelcontextprotocol.io/specification/2024-11-05/basic/transports/#sse)
 # ========================================================================
 
-# Хранилище активных SSE-сессий: session_id -> asyncio.Queue
-mcp_sessions: Dict[str, asyncio.Queue] = {}
+# Брокер SSE-сессий: очереди сессий этого воркера + доставка ответов владельцу сессии
+mcp_broker = session_broker.create_broker()
+
+# Максимум запросов в одной JSON-RPC пачке
+MCP_BATCH_MAX = int(os.getenv("MCP_BATCH_MAX", "50"))
+
+# ---------- MCP-инструменты (реестр: схема + обработчик, из него же — MCP_TOOLS) ----------
+
+def _events_params(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Параметры /api/v4/events из проверенных аргументов get_events."""
+    params: Dict[str, Any] = {}
+    types = [t.strip() for t in args.get("type", "").split(",") if t.strip()]
+    if types:
+        params["filter[type][]"] = types
+    if "date_from" in args:
+        params["filter[created_at][from]"] = args["date_from"]
+    if "date_to" in args:
+        params["filter[created_at][to]"] = args["date_to"]
+    params["limit"] = min(args["limit"], 100)
+    if "page" in args:
+        params["page"] = args["page"]
+    return params
+
+
+def _tasks_params(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Параметры /api/v4/tasks из проверенных аргументов get_tasks."""
+    params: Dict[str, Any] = {"limit": min(args["limit"], 250)}
+    if "page" in args:
+        params["page"] = args["page"]
+    if "is_completed" in args:
+        params["filter[is_completed]"] = args["is_completed"]
+    if args.get("responsible_user_id"):
+        params["filter[responsible_user_id]"] = args["responsible_user_id"]
+    return params
+
+
+def _contacts_params(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Параметры /api/v4/contacts из проверенных аргументов get_contacts."""
+    params: Dict[str, Any] = {"limit": min(args["limit"], 250)}
+    if "page" in args:
+        params["page"] = args["page"]
+    if args.get("query"):
+        params["query"] = args["query"]
+    if args.get("with_leads"):
+        params["with"] = "leads"
+    return params
+
+
+def _notes_params(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Параметры /api/v4/{entity}/{id}/notes из проверенных аргументов get_notes."""
+    params: Dict[str, Any] = {"limit": min(args["limit"], 250)}
+    if "page" in args:
+        params["page"] = args["page"]
+    if args.get("note_type"):
+        params["filter[note_type]"] = args["note_type"]
+    return params
+
+
+@tools.tool("get_account", "Получить информацию об аккаунте AmoCRM")
+async def _tool_get_account(args: dict):
+    return await reference_cache.cache.get_or_fetch(
+        "account", None, lambda: make_amocrm_request("/api/v4/account")
+    )
 
-# Список MCP-инструментов (tools)
-MCP_TOOLS = [
+
+@tools.tool(
+    "search_contacts",
+    "Поиск контактов по email или телефону",
     {
-        "name": "get_account",
-        "description": "Получить информацию об аккаунте AmoCRM",
-        "inputSchema": {
-            "type": "object",
-            "properties": {}
+        "query": {
+            "type": "string",
+            "description": "Email, телефон или имя для поиска"
         }
     },
+    required=["query"],
+)
+async def _tool_search_contacts(args: dict):
+    return await make_amocrm_request("/api/v4/contacts", "GET", params={"query": args["query"], "limit": 10})
+
+
+@tools.tool(
+    "create_lead",
+    "Создать сделку в AmoCRM",
     {
-        "name": "search_contacts",
-        "description": "Поиск контактов по email или телефону",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "query": {
-                    "type": "string",
-                    "description": "Email, телефон или имя для поиска"
-                }
-            },
-            "required": ["query"]
+        "name": {
+            "type": "string",
+            "description": "Название сделки"
+        },
+        "price": {
+            "type": "number",
+            "description": "Бюджет сделки"
         }
     },
+    required=["name"],
+)
+async def _tool_create_lead(args: dict):
+    lead_data = [{
+        "name": args["name"],
+        "price": args.get("price", 0)
+    }]
+    return await make_amocrm_request("/api/v4/leads", "POST", data=lead_data)
+
+
+@tools.tool(
+    "get_events",
+    "Получить события из amoCRM (почта, звонки, чаты). Используйте для сводки входящей/исходящей почты, звонков и сообщений.",
     {
-        "name": "create_lead",
-        "description": "Создать сделку в AmoCRM",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "name": {
-                    "type": "string",
-                    "description": "Название сделки"
-                },
-                "price": {
-                    "type": "number",
-                    "description": "Бюджет сделки"
-                }
-            },
-            "required": ["name"]
+        "type": {
+            "type": "string",
+            "description": "Тип события: incoming_mail_message, outgoing_mail_message, incoming_call, outgoing_call, incoming_chat_message. Можно несколько через запятую."
+        },
+        "date_from": {
+            "type": "string",
+            "format": "timestamp",
+            "description": "Начало периода (ISO дата или unix timestamp)"
+        },
+        "date_to": {
+            "type": "string",
+            "format": "timestamp",
+            "description": "Конец периода (ISO дата или unix timestamp)"
+        },
+        "limit": {
+            "type": "number",
+            "description": "Количество записей (по умолчанию 50, максимум 100)",
+            "default": 50
+        },
+        "page": {
+            "type": "number",
+            "description": "Номер страницы"
         }
     },
+)
+async def _tool_get_events(args: dict):
+    return await make_amocrm_request("/api/v4/events", "GET", params=_events_params(args))
+
+
+@tools.tool(
+    "get_tasks",
+    "Получить список задач из amoCRM. Используйте для показа задач на день, невыполненных задач, задач конкретного пользователя.",
     {
-        "name": "get_events",
-        "description": "Получить события из amoCRM (почта, звонки, чаты). Используйте для сводки входящей/исходящей почты, звонков и сообщений.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "type": {
-                    "type": "string",
-                    "description": "Тип события: incoming_mail_message, outgoing_mail_message, incoming_call, outgoing_call, incoming_chat_message. Можно несколько через запятую."
-                },
-                "date_from": {
-                    "type": "string",
-                    "description": "Начало периода (ISO дата или unix timestamp)"
-                },
-                "date_to": {
-                    "type": "string",
-                    "description": "Конец периода (ISO дата или unix timestamp)"
-                },
-                "limit": {
-                    "type": "number",
-                    "description": "Количество записей (по умолчанию 50)",
-                    "default": 50
-                }
-            }
+        "is_completed": {
+            "type": "number",
+            "description": "0 — не выполнены, 1 — выполнены. Если не указано — все задачи."
+        },
+        "responsible_user_id": {
+            "type": "number",
+            "description": "ID ответственного пользователя"
+        },
+        "limit": {
+            "type": "number",
+            "description": "Количество задач (по умолчанию 50)",
+            "default": 50
+        },
+        "page": {
+            "type": "number",
+            "description": "Номер страницы"
         }
     },
+)
+async def _tool_get_tasks(args: dict):
+    return await make_amocrm_request("/api/v4/tasks", "GET", params=_tasks_params(args))
+
+
+@tools.tool(
+    "create_task",
+    "Создать задачу в amoCRM. Привязывается к сделке или контакту.",
     {
-        "name": "get_tasks",
-        "description": "Получить список задач из amoCRM. Используйте для показа задач на день, невыполненных задач, задач конкретного пользователя.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "is_completed": {
-                    "type": "number",
-                    "description": "0 — не выполнены, 1 — выполнены. Если не указано — все задачи."
-                },
-                "responsible_user_id": {
-                    "type": "number",
-                    "description": "ID ответственного пользователя"
-                },
-                "limit": {
-                    "type": "number",
-                    "description": "Количество задач (по умолчанию 50)",
-                    "default": 50
-                }
-            }
+        "text": {
+            "type": "string",
+            "description": "Текст задачи"
+        },
+        "complete_till": {
+            "type": "number",
+            "format": "timestamp",
+            "description": "Срок выполнения (Unix timestamp)"
+        },
+        "entity_id": {
+            "type": "number",
+            "description": "ID сделки или контакта"
+        },
+        "entity_type": {
+            "type": "string",
+            "description": "Тип сущности: leads или contacts",
+            "enum": ["leads", "contacts"]
+        },
+        "task_type_id": {
+            "type": "number",
+            "description": "Тип задачи (1 — Связаться, 2 — Встреча). По умолчанию 1."
+        },
+        "responsible_user_id": {
+            "type": "number",
+            "description": "ID ответственного"
         }
     },
+    required=["text", "complete_till", "entity_id", "entity_type"],
+)
+async def _tool_create_task(args: dict):
+    task_data = [{
+        "text": args["text"],
+        "complete_till": args["complete_till"],
+        "entity_id": args["entity_id"],
+        "entity_type": args["entity_type"],
+        "task_type_id": args.get("task_type_id", 1),
+    }]
+    if args.get("responsible_user_id"):
+        task_data[0]["responsible_user_id"] = args["responsible_user_id"]
+    return await make_amocrm_request("/api/v4/tasks", "POST", data=task_data)
+
+
+@tools.tool(
+    "get_contacts",
+    "Получить контакты из amoCRM с поиском по имени, телефону или email. Может подтянуть связанные сделки.",
     {
-        "name": "create_task",
-        "description": "Создать задачу в amoCRM. Привязывается к сделке или контакту.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "text": {
-                    "type": "string",
-                    "description": "Текст задачи"
-                },
-                "complete_till": {
-                    "type": "number",
-                    "description": "Срок выполнения (Unix timestamp)"
-                },
-                "entity_id": {
-                    "type": "number",
-                    "description": "ID сделки или контакта"
-                },
-                "entity_type": {
-                    "type": "string",
-                    "description": "Тип сущности: leads или contacts",
-                    "enum": ["leads", "contacts"]
-                },
-                "task_type_id": {
-                    "type": "number",
-                    "description": "Тип задачи (1 — Связаться, 2 — Встреча). По умолчанию 1."
-                },
-                "responsible_user_id": {
-                    "type": "number",
-                    "description": "ID ответственного"
-                }
-            },
-            "required": ["text", "complete_till", "entity_id", "entity_type"]
+        "query": {
+            "type": "string",
+            "description": "Поисковый запрос (имя, телефон, email)"
+        },
+        "limit": {
+            "type": "number",
+            "description": "Количество контактов (по умолчанию 50)",
+            "default": 50
+        },
+        "with_leads": {
+            "type": "boolean",
+            "description": "Подтянуть связанные сделки (true/false)",
+            "default": False
+        },
+        "page": {
+            "type": "number",
+            "description": "Номер страницы"
         }
     },
+)
+async def _tool_get_contacts(args: dict):
+    local = await _local_list("contacts", min(args["limit"], 250), args.get("page", 1), query=args.get("query"))
+    if local is not None:
+        return local
+    return await make_amocrm_request("/api/v4/contacts", "GET", params=_contacts_params(args))
+
+
+@tools.tool(
+    "get_notes",
+    "Получить примечания (notes) к сделке, контакту, компании или покупателю. Используйте для чтения истории переписки и комментариев.",
     {
-        "name": "get_contacts",
-        "description": "Получить контакты из amoCRM с поиском по имени, телефону или email. Может подтянуть связанные сделки.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "query": {
-                    "type": "string",
-                    "description": "Поисковый запрос (имя, телефон, email)"
-                },
-                "limit": {
-                    "type": "number",
-                    "description": "Количество контактов (по умолчанию 50)",
-                    "default": 50
-                },
-                "with_leads": {
-                    "type": "boolean",
-                    "description": "Подтянуть связанные сделки (true/false)",
-                    "default": False
-                }
-            }
+        "entity_type": {
+            "type": "string",
+            "description": "Тип сущности: leads, contacts, companies или customers",
+            "enum": ["leads", "contacts", "companies", "customers"]
+        },
+        "entity_id": {
+            "type": "number",
+            "description": "ID сущности"
+        },
+        "limit": {
+            "type": "number",
+            "description": "Количество примечаний (по умолчанию 50)",
+            "default": 50
+        },
+        "page": {
+            "type": "number",
+            "description": "Номер страницы"
+        },
+        "note_type": {
+            "type": "string",
+            "description": "Тип примечания (common, call_in, call_out, sms_in, sms_out и т.д.)"
         }
     },
+    required=["entity_type", "entity_id"],
+)
+async def _tool_get_notes(args: dict):
+    return await make_amocrm_request(
+        f"/api/v4/{args['entity_type']}/{args['entity_id']}/notes",
+        "GET",
+        params=_notes_params(args)
+    )
+
+
+# Известные GET-эндпоинты amocrm_request идут через те же проверки и сборку параметров, что и инструменты
+_AMOCRM_REQUEST_ROUTES = {
+    "/api/events": ("get_events", "/api/v4/events", _events_params),
+    "/api/tasks": ("get_tasks", "/api/v4/tasks", _tasks_params),
+    "/api/contacts": ("get_contacts", "/api/v4/contacts", _contacts_params),
+}
+
+
+@tools.tool(
+    "amocrm_request",
+    "Универсальный запрос к amoCRM API v4. Используйте для любого endpoint amoCRM, который не покрыт другими инструментами. Все params передаются напрямую в query string запроса к amoCRM.",
     {
-        "name": "get_notes",
-        "description": "Получить примечания (notes) к сделке, контакту или компании. Используйте для чтения истории переписки и комментариев.",
-        "inputSchema": {
+        "method": {
+            "type": "string",
+            "description": "HTTP метод: GET, POST, PATCH, DELETE"
+        },
+        "path": {
+            "type": "string",
+            "description": "Путь к API amoCRM, например: /api/v4/events, /api/v4/tasks, /api/v4/contacts"
+        },
+        "params": {
             "type": "object",
-            "properties": {
-                "entity_type": {
-                    "type": "string",
-                    "description": "Тип сущности: leads, contacts или companies",
-                    "enum": ["leads", "contacts", "companies"]
-                },
-                "entity_id": {
-                    "type": "number",
-                    "description": "ID сущности"
-                },
-                "limit": {
-                    "type": "number",
-                    "description": "Количество примечаний (по умолчанию 50)",
-                    "default": 50
-                }
-            },
-            "required": ["entity_type", "entity_id"]
+            "description": "Query-параметры запроса. Например: {\"filter[type][]\": \"incoming_mail_message\", \"limit\": 5}"
+        },
+        "body": {
+            "type": "object",
+            "description": "JSON тело запроса для POST/PATCH"
         }
     },
+    required=["method", "path"],
+)
+async def _tool_amocrm_request(args: dict):
+    req_method = args["method"].upper()
+    if req_method not in ("GET", "POST", "PATCH", "DELETE"):
+        raise ToolArgumentError(f"amocrm_request: неподдерживаемый метод {args['method']}")
+    req_path = args["path"].rstrip("/")
+    req_params = args.get("params") or {}
+    req_body = args.get("body")
+
+    # Нормализуем путь
+    norm_path = req_path
+    if norm_path.startswith("/api/v4/"):
+        norm_path = "/api/" + norm_path[8:]
+    elif not norm_path.startswith("/api/"):
+        norm_path = "/api/" + norm_path.lstrip("/")
+
+    # Роутинг через внутреннюю логику для известных эндпоинтов
+    route = _AMOCRM_REQUEST_ROUTES.get(norm_path) if req_method == "GET" else None
+    if route is not None:
+        tool_name, endpoint, build_params = route
+        params = build_params(tools[tool_name].validate({"page": 1, **req_params}))
+        if req_params.get("with"):
+            params["with"] = req_params["with"]
+        for k, v in req_params.items():
+            if k.startswith("filter["):
+                params[k] = v
+        return await make_amocrm_request(endpoint, "GET", params=params)
+
+    # Универсальный passthrough
+    if not req_path.startswith("/api/v4"):
+        if req_path.startswith("/api/"):
+            req_path = "/api/v4/" + req_path[5:]
+        elif req_path.startswith("/"):
+            req_path = "/api/v4" + req_path
+        else:
+            req_path = "/api/v4/" + req_path
+
+    data = None
+    if req_method in ("POST", "PATCH") and req_body:
+        data = req_body if isinstance(req_body, list) else [req_body]
+
+    return await make_amocrm_request(
+        req_path,
+        req_method,
+        data=data,
+        params=req_params if req_method == "GET" else None
+    )
+
+
+# Чат-тулы
+
+@tools.tool(
+    "get_chat_messages",
+    "Получить историю чат-сообщений (Авито, WhatsApp, Telegram) по ID сделки. Для следующей страницы передайте next_cursor из ответа.",
     {
-        "name": "amocrm_request",
-        "description": "Универсальный запрос к amoCRM API v4. Используйте для любого endpoint amoCRM, который не покрыт другими инструментами. Все params передаются напрямую в query string запроса к amoCRM.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "method": {
-                    "type": "string",
-                    "description": "HTTP метод: GET, POST, PATCH, DELETE",
-                    "enum": ["GET", "POST", "PATCH", "DELETE"]
-                },
-                "path": {
-                    "type": "string",
-                    "description": "Путь к API amoCRM, например: /api/v4/events, /api/v4/tasks, /api/v4/contacts"
-                },
-                "params": {
-                    "type": "object",
-                    "description": "Query-параметры запроса. Например: {\"filter[type][]\": \"incoming_mail_message\", \"limit\": 5}"
-                },
-                "body": {
-                    "type": "object",
-                    "description": "JSON тело запроса для POST/PATCH"
-                }
-            },
-            "required": ["method", "path"]
-        }
+        "lead_id": {"type": "integer", "description": "ID сделки"},
+        "limit": {"type": "integer", "default": 50},
+        "cursor": {"type": "string", "description": "next_cursor из предыдущего ответа для следующей страницы"},
+        "include_archive": {"type": "boolean", "default": False, "description": "Добавить старые сообщения из архива"}
     },
+    required=["lead_id"],
+)
+async def _tool_get_chat_messages(args: dict):
+    lead_id = args["lead_id"]
+    msgs, next_cursor, archived = await _chat_page(
+        "lead_id", lead_id, args["limit"], args.get("cursor"), 0, args["include_archive"]
+    )
+    msgs = archived + msgs
+    return {"lead_id": lead_id, "count": len(msgs), "formatted": chat_storage.format_chat_history(msgs), "messages": msgs, "next_cursor": next_cursor} if msgs else {"lead_id": lead_id, "count": 0, "note": "Сообщений не найдено"}
+
+
+@tools.tool(
+    "get_recent_chats",
+    "Последние чат-сообщения из всех каналов.",
     {
-        "name": "get_chat_messages",
-        "description": "Получить историю чат-сообщений (Авито, WhatsApp, Telegram) по ID сделки.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "lead_id": {"type": "integer", "description": "ID сделки"},
-                "limit": {"type": "integer", "default": 50}
-            },
-            "required": ["lead_id"]
-        }
+        "limit": {"type": "integer", "default": 20}
     },
+)
+async def _tool_get_recent_chats(args: dict):
+    msgs = await chat_storage.run_in_db(chat_storage.get_recent_messages, args["limit"])
+    return {"count": len(msgs), "formatted": chat_storage.format_chat_history(msgs), "messages": msgs}
+
+
+@tools.tool(
+    "search_chat_messages",
+    "Полнотекстовый поиск по чат-сообщениям (слова по префиксу, результаты с ранжированием и сниппетом).",
     {
-        "name": "get_recent_chats",
-        "description": "Последние чат-сообщения из всех каналов.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "limit": {"type": "integer", "default": 20}
-            }
-        }
+        "query": {"type": "string"},
+        "limit": {"type": "integer", "default": 20},
+        "order": {"type": "string", "enum": ["rank", "recent"], "default": "rank"}
     },
+    required=["query"],
+)
+async def _tool_search_chat_messages(args: dict):
+    msgs = await chat_storage.run_in_db(chat_storage.search_messages, args["query"], args["limit"], args["order"])
+    return {"query": args["query"], "count": len(msgs), "formatted": chat_storage.format_chat_history(msgs), "messages": msgs}
+
+
+@tools.tool(
+    "get_chat_stats",
+    "Статистика по чат-сообщениям: всего, за сегодня, по каналам, по направлению и по дням.",
     {
-        "name": "search_chat_messages",
-        "description": "Поиск по тексту чат-сообщений.",
-        "inputSchema": {
-            "type": "object",
-            "properties": {
-                "query": {"type": "string"},
-                "limit": {"type": "integer", "default": 20}
-            },
-            "required": ["query"]
-        }
+        "days": {"type": "integer", "description": "Сколько последних дней в разбивке по дням", "default": 7}
     },
+)
+async def _tool_get_chat_stats(args: dict):
+    return await chat_storage.run_in_db(chat_storage.get_stats, args["days"])
+
+
+# Карточка сделки
+
+def _embedded_items(result: Any, key: str) -> Union[list, dict]:
+    """Список из ответа AmoCRM (204 → []); {"error"} — если этот запрос не удался."""
+    if isinstance(result, Exception):
+        return {"error": str(result)}
+    if isinstance(result, dict) and result.get("code") == 204:
+        return []
+    if isinstance(result, dict) and "_embedded" in result:
+        return (result["_embedded"] or {}).get(key) or []
+    return {"error": str(result)[:300]}
+
+
+async def _timed(timings: Dict[str, float], name: str, coro):
+    started = time.monotonic()
+    try:
+        return await coro
+    finally:
+        timings[name] = round((time.monotonic() - started) * 1000, 1)
+
+
+async def _fetch_lead(lead_id: int) -> dict:
+    local = await _local_entity("leads", lead_id)
+    if local is not None:
+        return local
+    return await make_amocrm_request(f"/api/v4/leads/{lead_id}", "GET", params={"with": entity_store.ENTITY_WITH["leads"]})
+
+
+def _get_entities(entity_type: str, ids: List[int]) -> List[dict]:
+    return [entity for entity in (entity_store.get_entity(entity_type, i) for i in ids) if entity is not None]
+
+
+async def _contacts_by_ids(contact_ids: List[int]) -> Union[list, dict]:
+    found: List[dict] = []
+    if await entity_store.local_ready("contacts") is not None:
+        found = await chat_storage.run_in_db(_get_entities, "contacts", contact_ids)
+        known = {contact["id"] for contact in found}
+        contact_ids = [i for i in contact_ids if i not in known]
+        if not contact_ids:
+            return found
+    try:
+        result = await make_amocrm_request(
+            "/api/v4/contacts", "GET", params={"filter[id][]": contact_ids, "limit": min(len(contact_ids), 250)}
+        )
+    except Exception as e:
+        result = e
+    items = _embedded_items(result, "contacts")
+    return found + items if isinstance(items, list) else items
+
+
+async def _lead_with_contacts(lead_id: int, timings: Dict[str, float]):
+    """Сделка (из зеркала или AmoCRM), затем её контакты одним запросом filter[id][]."""
+    lead = await _timed(timings, "lead", _fetch_lead(lead_id))
+    if not isinstance(lead, dict) or lead.get("code") == 204 or "id" not in lead:
+        return None, []
+    contact_ids = [c["id"] for c in (lead.get("_embedded") or {}).get("contacts") or [] if c.get("id")]
+    if not contact_ids:
+        return lead, []
+    contacts = await _timed(timings, "contacts", _contacts_by_ids(contact_ids))
+    return lead, contacts
+
+
+@tools.tool(
+    "get_lead_context",
+    "Полная карточка сделки одним вызовом: сделка, её контакты, примечания, задачи и история чатов. Все запросы выполняются параллельно, ответ — один документ. Используйте вместо последовательных вызовов get_notes, get_tasks, get_contacts и get_chat_messages по одной сделке.",
     {
-        "name": "get_chat_stats",
-        "description": "Статистика по чат-сообщениям: всего, за сегодня, по каналам.",
-        "inputSchema": {"type": "object", "properties": {}}
+        "lead_id": {"type": "integer", "description": "ID сделки"},
+        "limit": {"type": "integer", "description": "Сколько примечаний, задач и сообщений чата вернуть (по умолчанию 50)", "default": 50},
+        "include_archive": {"type": "boolean", "default": False, "description": "Добавить старые сообщения чата из архива"}
+    },
+    required=["lead_id"],
+)
+async def _tool_get_lead_context(args: dict):
+    lead_id = args["lead_id"]
+    limit = min(max(1, args["limit"]), 250)
+    started = time.monotonic()
+    timings: Dict[str, float] = {}
+    # Сделка с контактами, примечания, задачи и чат — одновременно; все запросы
+    # к AmoCRM проходят через общий rate limiter, чат читается из локальной БД
+    lead_part, notes, tasks, chat = await asyncio.gather(
+        _lead_with_contacts(lead_id, timings),
+        _timed(timings, "notes", make_amocrm_request(f"/api/v4/leads/{lead_id}/notes", "GET", params={"limit": limit})),
+        _timed(timings, "tasks", make_amocrm_request("/api/v4/tasks", "GET", params={
+            "filter[entity_type]": "leads",
+            "filter[entity_id][]": lead_id,
+            "limit": limit,
+        })),
+        _timed(timings, "chat", _chat_page("lead_id", lead_id, limit, None, 0, args["include_archive"])),
+        return_exceptions=True,
+    )
+    if isinstance(lead_part, Exception):
+        lead, contacts = {"error": str(lead_part)}, []
+    else:
+        lead, contacts = lead_part
+    if isinstance(chat, Exception):
+        chat_part = {"error": str(chat)}
+    else:
+        msgs, next_cursor, archived = chat
+        msgs = archived + msgs
+        chat_part = {"count": len(msgs), "messages": msgs, "next_cursor": next_cursor, "formatted": chat_storage.format_chat_history(msgs)}
+    result = {
+        "lead_id": lead_id,
+        "lead": lead,
+        "contacts": contacts,
+        "notes": _embedded_items(notes, "notes"),
+        "tasks": _embedded_items(tasks, "tasks"),
+        "chat": chat_part,
+        "timings_ms": timings,
+        "seconds": round(time.monotonic() - started, 3),
     }
-]
+    if lead is None:
+        result["note"] = "Сделка не найдена"
+    return result
+
+
+@tools.tool(
+    "aggregate_deals",
+    "Аналитика по сделкам без выгрузки сделок: сервер обходит все подходящие сделки и возвращает только таблицу агрегатов по группам — количество, выигранные/проигранные, конверсия (win_rate), сумма/среднее/перцентили бюджета, длительность цикла закрытых сделок и возраст открытых (в днях). Используйте для воронки, среднего чека по воронкам/этапам/менеджерам и разбивки причин отказа.",
+    {
+        "group_by": {
+            "type": "string",
+            "description": "Поля группировки через запятую: pipeline_id, status_id, responsible_user_id, loss_reason_id, created_month, closed_month (пусто — только итоги)"
+        },
+        "query": {"type": "string", "description": "Поисковый запрос для фильтрации сделок"},
+        "created_at_from": {"type": "string", "format": "timestamp", "description": "Создана не раньше (unix timestamp или ISO дата)"},
+        "updated_at_from": {"type": "string", "format": "timestamp", "description": "Обновлена не раньше (unix timestamp или ISO дата)"},
+        "status_id": {"type": "integer", "description": "ID статуса"},
+        "pipeline_id": {"type": "integer", "description": "ID воронки"},
+        "percentiles": {"type": "string", "description": "Перцентили через запятую", "default": "50,90"}
+    },
+)
+async def _tool_aggregate_deals(args: dict):
+    try:
+        group_by = deal_analytics.parse_group_by(args.get("group_by"))
+        percentiles = deal_analytics.parse_percentiles(args["percentiles"])
+    except ValueError as e:
+        raise ToolArgumentError(f"aggregate_deals: {e}")
+    filters = {field: args.get(field) for field in ("created_at_from", "updated_at_from", "status_id", "pipeline_id")}
+    query = args.get("query")
+
+    # Как и отчёт по сделкам: без query — по локальному зеркалу, если оно синхронизировано
+    watermark = None if query else await entity_store.local_ready("leads")
+    if watermark is not None:
+        source = _iter_local_pages("leads", **filters)
+    else:
+        params = _deals_report_params(query, **filters)
+        params.pop("with")  # связи для агрегатов не нужны — страницы легче
+        source = amocrm_client.iter_pages("/api/v4/leads", "leads", params)
+
+    started = time.monotonic()
+    aggregator = deal_analytics.DealAggregator(group_by, percentiles, now=int(time.time()))
+    async for leads in source:
+        aggregator.add_page(leads)
+    result = aggregator.result()
+    result["filters_applied"] = {"query": query, **filters}
+    result["seconds"] = round(time.monotonic() - started, 3)
+    if watermark is not None:
+        result["_local"] = watermark
+    return result
+
+
+@tools.tool(
+    "query_deal_snapshot",
+    "Быстрые повторные срезы по сделкам из снимка в памяти (одна выгрузка на все запросы, снимок живёт LEAD_SNAPSHOT_TTL). Фильтры по воронке, статусу, ответственному и периодам, группировка и те же метрики, что у aggregate_deals. Используйте для серии похожих отчётов с разными фильтрами.",
+    {
+        "group_by": {
+            "type": "string",
+            "description": "Поля группировки через запятую: pipeline_id, status_id, responsible_user_id, loss_reason_id, created_month, closed_month"
+        },
+        "pipeline_id": {"type": "integer", "description": "ID воронки"},
+        "status_id": {"type": "integer", "description": "ID статуса"},
+        "responsible_user_id": {"type": "integer", "description": "ID ответственного"},
+        "created_at_from": {"type": "string", "format": "timestamp", "description": "Создана не раньше"},
+        "created_at_to": {"type": "string", "format": "timestamp", "description": "Создана не позже"},
+        "updated_at_from": {"type": "string", "format": "timestamp", "description": "Обновлена не раньше"},
+        "updated_at_to": {"type": "string", "format": "timestamp", "description": "Обновлена не позже"},
+        "closed_at_from": {"type": "string", "format": "timestamp", "description": "Закрыта не раньше"},
+        "closed_at_to": {"type": "string", "format": "timestamp", "description": "Закрыта не позже"},
+        "percentiles": {"type": "string", "description": "Перцентили через запятую", "default": "50,90"},
+        "max_age": {"type": "number", "description": "Допустимый возраст снимка, сек."},
+        "refresh": {"type": "boolean", "description": "Построить снимок заново", "default": False}
+    },
+)
+async def _tool_query_deal_snapshot(args: dict):
+    try:
+        group_by = deal_analytics.parse_group_by(args.get("group_by"))
+        percentiles = deal_analytics.parse_percentiles(args["percentiles"])
+    except ValueError as e:
+        raise ToolArgumentError(f"query_deal_snapshot: {e}")
+    filters = {name: args.get(name) for name in lead_snapshot.FILTERS}
+    return await lead_snapshots.query(filters, group_by, percentiles, args.get("max_age"), args["refresh"])
+
+
+# Список MCP-инструментов (tools)
+MCP_TOOLS = tools.list_tools()
 
 
 @app.get("/mcp")
@@ -859,35 +1594,44 @@ async def mcp_sse_endpoint(request: Request):
     4. Сервер отвечает через SSE-стрим (event: message\\ndata: {...})
     """
     session_id = str(uuid.uuid4())
-    queue = asyncio.Queue()
-    mcp_sessions[session_id] = queue
+    queue = await mcp_broker.register(session_id)
 
     logger.info(f"MCP SSE: Новое подключение, sessionId={session_id}")
 
+    async def watch_disconnect():
+        # Отключение клиента приходит событием http.disconnect — без опроса в цикле
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        logger.info(f"MCP SSE: Клиент отключился, sessionId={session_id}")
+        await queue.close()
+
     async def event_generator():
+        watcher = asyncio.create_task(watch_disconnect())
+        mcp_transport.keepalive.add(queue)
         try:
             # ШАГ 1: Отправляем endpoint — это ОБЯЗАТЕЛЬНОЕ первое сообщение по спецификации MCP
             yield f"event: endpoint\ndata: /mcp/messages?sessionId={session_id}\n\n"
 
-            # ШАГ 2: Держим соединение открытым, слушаем очередь ответов
+            # ШАГ 2: Держим соединение открытым: ждём сообщение, keep-alive от общего колеса или закрытие
             while True:
-                if await request.is_disconnected():
-                    logger.info(f"MCP SSE: Клиент отключился, sessionId={session_id}")
+                message = await queue.get()
+                if message is None:
                     break
-
-                try:
-                    message = await asyncio.wait_for(queue.get(), timeout=30.0)
-                    yield f"event: message\ndata: {json.dumps(message, ensure_ascii=False)}\n\n"
-                except asyncio.TimeoutError:
+                if message is mcp_transport.KEEPALIVE:
                     # Keep-alive comment (не event, просто комментарий SSE)
                     yield ": keep-alive\n\n"
+                else:
+                    # Сообщения в очереди уже сериализованы (компактный JSON без переводов строк)
+                    yield f"event: message\ndata: {message}\n\n"
 
         except asyncio.CancelledError:
             logger.info(f"MCP SSE: Соединение отменено, sessionId={session_id}")
         except Exception as e:
             logger.error(f"MCP SSE ошибка: {str(e)}")
         finally:
-            mcp_sessions.pop(session_id, None)
+            watcher.cancel()
+            mcp_transport.keepalive.discard(queue)
+            await mcp_broker.unregister(session_id)
             logger.info(f"MCP SSE: Соединение закрыто, sessionId={session_id}")
 
     return StreamingResponse(
@@ -901,319 +1645,165 @@ async def mcp_sse_endpoint(request: Request):
     )
 
 
-@app.post("/mcp/messages")
-async def mcp_messages_endpoint(request: Request, sessionId: str = Query(...)):
-    """
-    MCP JSON-RPC messages endpoint.
-    Клиент отправляет сюда JSON-RPC запросы, ответ кладётся в SSE-очередь сессии.
-    Также возвращаем ответ в теле HTTP-ответа (для совместимости).
-    """
-    queue = mcp_sessions.get(sessionId)
-    if not queue:
-        raise HTTPException(status_code=400, detail=f"Unknown session: {sessionId}")
-
-    try:
-        body = await request.json()
-        logger.info(f"MCP Message (session={sessionId}): method={body.get('method')}")
-
-        method = body.get("method")
-        params = body.get("params", {})
-        msg_id = body.get("id")
-
-        response = None
-
-        # ---- initialize ----
-        if method == "initialize":
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {
-                    "protocolVersion": "2024-11-05",
-                    "capabilities": {
-                        "tools": {}
-                    },
-                    "serverInfo": {
-                        "name": "amocrm-mcp-server",
-                        "version": "3.0.0"
-                    }
-                }
-            }
-
-        # ---- notifications/initialized ----
-        elif method == "notifications/initialized":
-            # Это нотификация, не требует ответа
-            return {"jsonrpc": "2.0"}
-
-        # ---- tools/list ----
-        elif method == "tools/list":
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {
-                    "tools": MCP_TOOLS
-                }
-            }
+def _rpc_error(msg_id: Any, code: int, message: str) -> dict:
+    return {
+        "jsonrpc": "2.0",
+        "id": msg_id,
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }
 
-        # ---- tools/call ----
-        elif method == "tools/call":
-            tool_name = params.get("name")
-            tool_args = params.get("arguments", {})
-            result = await _execute_tool(tool_name, tool_args)
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": json.dumps(result, ensure_ascii=False, indent=2)
-                        }
-                    ]
-                }
-            }
 
-        # ---- ping ----
-        elif method == "ping":
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "result": {}
-            }
+async def _dispatch_rpc(session_id: str, body: dict):
+    """
+    Ответ на один JSON-RPC запрос: dict, уже сериализованная строка (только
+    успешный результат tools/call) или None (нотификация). Ошибки всегда
+    возвращаются dict-ом с ключом "error".
+    """
+    method = body.get("method")
+    params = body.get("params") or {}
+    msg_id = body.get("id")
 
-        # ---- unknown method ----
-        else:
-            response = {
-                "jsonrpc": "2.0",
-                "id": msg_id,
-                "error": {
-                    "code": -32601,
-                    "message": f"Method not found: {method}"
+    # ---- initialize ----
+    if method == "initialize":
+        return {
+            "jsonrpc": "2.0",
+            "id": msg_id,
+            "result": {
+                "protocolVersion": "2024-11-05",
+                "capabilities": {
+                    "tools": {}
+                },
+                "serverInfo": {
+                    "name": "amocrm-mcp-server",
+                    "version": "3.0.0"
                 }
             }
+        }
 
-        # Кладём ответ в SSE-очередь, чтобы клиент получил через стрим
-        if response and msg_id is not None:
-            await queue.put(response)
-
-        # Также возвращаем в HTTP-теле (Claude использует и то, и другое)
-        return response or {"jsonrpc": "2.0"}
+    # ---- notifications/* (initialized, cancelled, ...) ----
+    if method and method.startswith("notifications/"):
+        # Нотификации не требуют ответа
+        return None
 
-    except Exception as e:
-        logger.error(f"MCP Messages ошибка: {str(e)}")
-        error_resp = {
+    # ---- tools/list ----
+    if method == "tools/list":
+        return {
             "jsonrpc": "2.0",
-            "id": body.get("id") if 'body' in dir() else None,
-            "error": {
-                "code": -32603,
-                "message": str(e)
+            "id": msg_id,
+            "result": {
+                "tools": MCP_TOOLS
             }
         }
-        if queue:
-            await queue.put(error_resp)
-        return error_resp
-
-
-async def _execute_tool(tool_name: str, tool_args: dict) -> dict:
-    """Выполнить MCP-инструмент и вернуть результат."""
 
-    if tool_name == "get_account":
-        return await make_amocrm_request("/api/v4/account")
+    # ---- tools/call ----
+    if method == "tools/call":
+        tool_name = params.get("name")
+        tool_args = params.get("arguments", {})
+        progress_token = (params.get("_meta") or {}).get("progressToken")
+        if progress_token is not None:
+            await mcp_broker.publish(session_id, mcp_transport.progress_notification(progress_token, 0, 1, f"Выполняется {tool_name}"))
+        response = None
+        try:
+            # Интерактивные вызовы агента идут вперёд массовых выгрузок
+            with rate_limiter.priority(rate_limiter.PRIORITY_INTERACTIVE):
+                result = await _execute_tool(tool_name, tool_args)
+            # Одна сериализация на SSE и на тело HTTP-ответа
+            response = mcp_transport.serialize_tool_result(msg_id, result)
+            del result
+        except ToolArgumentError as e:
+            response = _rpc_error(msg_id, -32602, str(e))
+        finally:
+            # Финальный прогресс уходит и при ошибке инструмента, иначе клиент ждёт его вечно
+            if progress_token is not None:
+                message = f"Результат готов: {len(response)} символов" if isinstance(response, str) else f"Ошибка {tool_name}"
+                await mcp_broker.publish(session_id, mcp_transport.progress_notification(progress_token, 1, 1, message))
+        return response
+
+    # ---- ping ----
+    if method == "ping":
+        return {
+            "jsonrpc": "2.0",
+            "id": msg_id,
+            "result": {}
+        }
 
-    elif tool_name == "search_contacts":
-        return await make_amocrm_request(
-            "/api/v4/contacts",
-            "GET",
-            params={"query": tool_args.get("query"), "limit": 10}
-        )
+    # ---- unknown method ----
+    return _rpc_error(msg_id, -32601, f"Method not found: {method}")
 
-    elif tool_name == "create_lead":
-        lead_data = [{
-            "name": tool_args.get("name"),
-            "price": tool_args.get("price", 0)
-        }]
-        return await make_amocrm_request("/api/v4/leads", "POST", data=lead_data)
-
-    elif tool_name == "get_events":
-        params = {}
-        event_type = tool_args.get("type")
-        if event_type:
-            types = [t.strip() for t in event_type.split(",")]
-            for i, t in enumerate(types):
-                params[f"filter[type][{i}]"] = t
-        date_from = tool_args.get("date_from")
-        if date_from:
-            try:
-                ts = int(date_from)
-            except (ValueError, TypeError):
-                from datetime import datetime as dt_cls
-                d = dt_cls.fromisoformat(str(date_from).replace("Z", "+00:00"))
-                ts = int(d.timestamp())
-            params["filter[created_at][from]"] = ts
-        date_to = tool_args.get("date_to")
-        if date_to:
-            try:
-                ts = int(date_to)
-            except (ValueError, TypeError):
-                from datetime import datetime as dt_cls
-                d = dt_cls.fromisoformat(str(date_to).replace("Z", "+00:00"))
-                ts = int(d.timestamp())
-            params["filter[created_at][to]"] = ts
-        params["limit"] = tool_args.get("limit", 50)
-        return await make_amocrm_request("/api/v4/events", "GET", params=params)
-
-    elif tool_name == "get_tasks":
-        params = {"limit": tool_args.get("limit", 50)}
-        if "is_completed" in tool_args and tool_args["is_completed"] is not None:
-            params["filter[is_completed]"] = tool_args["is_completed"]
-        if tool_args.get("responsible_user_id"):
-            params["filter[responsible_user_id]"] = tool_args["responsible_user_id"]
-        return await make_amocrm_request("/api/v4/tasks", "GET", params=params)
-
-    elif tool_name == "create_task":
-        task_data = [{
-            "text": tool_args["text"],
-            "complete_till": tool_args["complete_till"],
-            "entity_id": tool_args["entity_id"],
-            "entity_type": tool_args["entity_type"],
-            "task_type_id": tool_args.get("task_type_id", 1),
-        }]
-        if tool_args.get("responsible_user_id"):
-            task_data[0]["responsible_user_id"] = tool_args["responsible_user_id"]
-        return await make_amocrm_request("/api/v4/tasks", "POST", data=task_data)
-
-    elif tool_name == "get_contacts":
-        params = {"limit": tool_args.get("limit", 50)}
-        if tool_args.get("query"):
-            params["query"] = tool_args["query"]
-        if tool_args.get("with_leads"):
-            params["with"] = "leads"
-        return await make_amocrm_request("/api/v4/contacts", "GET", params=params)
-
-    elif tool_name == "get_notes":
-        entity_type = tool_args["entity_type"]
-        entity_id = tool_args["entity_id"]
-        params = {"limit": tool_args.get("limit", 50)}
-        return await make_amocrm_request(
-            f"/api/v4/{entity_type}/{entity_id}/notes",
-            "GET",
-            params=params
-        )
 
-    elif tool_name == "amocrm_request":
-        req_method = tool_args.get("method", "GET").upper()
-        req_path = tool_args.get("path", "").rstrip("/")
-        req_params = tool_args.get("params", {})
-        req_body = tool_args.get("body")
-
-        # Нормализуем путь
-        norm_path = req_path
-        if norm_path.startswith("/api/v4/"):
-            norm_path = "/api/" + norm_path[8:]
-        elif not norm_path.startswith("/api/"):
-            norm_path = "/api/" + norm_path.lstrip("/")
-
-        # Роутинг через внутреннюю логику для известных эндпоинтов
-        if norm_path == "/api/events" and req_method == "GET":
-            ev_params = {}
-            event_type = req_params.get("type")
-            if event_type:
-                types = [t.strip() for t in str(event_type).split(",")]
-                for i, t in enumerate(types):
-                    ev_params[f"filter[type][{i}]"] = t
-            date_from = req_params.get("date_from")
-            if date_from:
-                try:
-                    ts = int(date_from)
-                except (ValueError, TypeError):
-                    from datetime import datetime as dt_cls
-                    d = dt_cls.fromisoformat(str(date_from).replace("Z", "+00:00"))
-                    ts = int(d.timestamp())
-                ev_params["filter[created_at][from]"] = ts
-            date_to = req_params.get("date_to")
-            if date_to:
-                try:
-                    ts = int(date_to)
-                except (ValueError, TypeError):
-                    from datetime import datetime as dt_cls
-                    d = dt_cls.fromisoformat(str(date_to).replace("Z", "+00:00"))
-                    ts = int(d.timestamp())
-                ev_params["filter[created_at][to]"] = ts
-            ev_params["limit"] = req_params.get("limit", 50)
-            ev_params["page"] = req_params.get("page", 1)
-            for k, v in req_params.items():
-                if k.startswith("filter["):
-                    ev_params[k] = v
-            return await make_amocrm_request("/api/v4/events", "GET", params=ev_params)
-
-        elif norm_path == "/api/tasks" and req_method == "GET":
-            t_params = {
-                "limit": req_params.get("limit", 50),
-                "page": req_params.get("page", 1)
-            }
-            if "is_completed" in req_params and req_params["is_completed"] is not None:
-                t_params["filter[is_completed]"] = req_params["is_completed"]
-            if req_params.get("responsible_user_id"):
-                t_params["filter[responsible_user_id]"] = req_params["responsible_user_id"]
-            for k, v in req_params.items():
-                if k.startswith("filter["):
-                    t_params[k] = v
-            return await make_amocrm_request("/api/v4/tasks", "GET", params=t_params)
-
-        elif norm_path == "/api/contacts" and req_method == "GET":
-            c_params = {
-                "limit": req_params.get("limit", 50),
-                "page": req_params.get("page", 1)
-            }
-            if req_params.get("query"):
-                c_params["query"] = req_params["query"]
-            if req_params.get("with_leads"):
-                c_params["with"] = "leads"
-            if req_params.get("with"):
-                c_params["with"] = req_params["with"]
-            for k, v in req_params.items():
-                if k.startswith("filter["):
-                    c_params[k] = v
-            return await make_amocrm_request("/api/v4/contacts", "GET", params=c_params)
+async def _handle_rpc(session_id: str, body: Any) -> Optional[str]:
+    """
+    Обработать один JSON-RPC объект. Ответ сериализуется, сразу уходит
+    в SSE-стрим сессии и возвращается для тела HTTP-ответа.
+    У нотификаций (без id) ответа нет — None, даже при ошибке (JSON-RPC 2.0, п. 4.1);
+    ответ с id: null получает только тело, которое не является объектом.
+    """
+    if not isinstance(body, dict):
+        response = _rpc_error(None, -32600, "Invalid Request")
+    else:
+        try:
+            response = await _dispatch_rpc(session_id, body)
+        except Exception as e:
+            logger.error(f"MCP Messages ошибка: {str(e)}")
+            response = _rpc_error(body.get("id"), -32603, str(e))
+        if "id" not in body:
+            return None
+    if response is None:
+        return None
+    if not isinstance(response, str):
+        response = mcp_transport.dumps(response)
 
-        else:
-            # Универсальный passthrough
-            if not req_path.startswith("/api/v4"):
-                if req_path.startswith("/api/"):
-                    req_path = "/api/v4/" + req_path[5:]
-                elif req_path.startswith("/"):
-                    req_path = "/api/v4" + req_path
-                else:
-                    req_path = "/api/v4/" + req_path
+    # Кладём ответ в SSE-очередь, чтобы клиент получил через стрим
+    await mcp_broker.publish(session_id, response)
+    return response
 
-            data = None
-            if req_method in ("POST", "PATCH") and req_body:
-                data = req_body if isinstance(req_body, list) else [req_body]
 
-            return await make_amocrm_request(
-                req_path,
-                req_method,
-                data=data,
-                params=req_params if req_method == "GET" else None
-            )
+@app.post("/mcp/messages")
+async def mcp_messages_endpoint(request: Request, sessionId: str = Query(...)):
+    """
+    MCP JSON-RPC messages endpoint.
+    Клиент отправляет сюда JSON-RPC запрос или пачку (массив) запросов, ответы кладутся
+    в SSE-очередь сессии (через брокер — в воркер, который держит её SSE-стрим).
+    Запросы пачки выполняются параллельно, каждый ответ уходит в SSE сразу по готовности.
+    Также возвращаем ответ (или массив ответов) в теле HTTP-ответа (для совместимости).
+    """
+    if not await mcp_broker.exists(sessionId):
+        raise HTTPException(status_code=400, detail=f"Unknown session: {sessionId}")
 
-    # Чат-тулы
-    if tool_name == "get_chat_messages":
-        lead_id = tool_args["lead_id"]
-        msgs = chat_storage.get_messages_by_lead(lead_id, tool_args.get("limit", 50))
-        return {"lead_id": lead_id, "count": len(msgs), "formatted": chat_storage.format_chat_history(msgs), "messages": msgs} if msgs else {"lead_id": lead_id, "count": 0, "note": "Сообщений не найдено"}
+    try:
+        body = await request.json()
+    except Exception as e:
+        error_resp = mcp_transport.dumps(_rpc_error(None, -32700, f"Parse error: {e}"))
+        await mcp_broker.publish(sessionId, error_resp)
+        return Response(content=error_resp, media_type="application/json")
+
+    if isinstance(body, list):
+        if not body or len(body) > MCP_BATCH_MAX:
+            error_resp = mcp_transport.dumps(_rpc_error(None, -32600, f"Пачка должна содержать от 1 до {MCP_BATCH_MAX} запросов"))
+            await mcp_broker.publish(sessionId, error_resp)
+            return Response(content=error_resp, media_type="application/json")
+        logger.info(f"MCP Batch (session={sessionId}): {[item.get('method') if isinstance(item, dict) else None for item in body]}")
+        # Темп обращений к AmoCRM по-прежнему задаёт общий rate limiter
+        responses = [r for r in await asyncio.gather(*(_handle_rpc(sessionId, item) for item in body)) if r is not None]
+        if not responses:
+            return {"jsonrpc": "2.0"}
+        return Response(content="[" + ",".join(responses) + "]", media_type="application/json")
 
-    if tool_name == "get_recent_chats":
-        msgs = chat_storage.get_recent_messages(tool_args.get("limit", 20))
-        return {"count": len(msgs), "formatted": chat_storage.format_chat_history(msgs), "messages": msgs}
+    logger.info(f"MCP Message (session={sessionId}): method={body.get('method') if isinstance(body, dict) else None}")
+    response = await _handle_rpc(sessionId, body)
+    if response is None:
+        return {"jsonrpc": "2.0"}
 
-    if tool_name == "search_chat_messages":
-        msgs = chat_storage.search_messages(tool_args["query"], tool_args.get("limit", 20))
-        return {"query": tool_args["query"], "count": len(msgs), "formatted": chat_storage.format_chat_history(msgs), "messages": msgs}
+    # Также возвращаем в HTTP-теле (Claude использует и то, и другое)
+    return Response(content=response, media_type="application/json")
 
-    if tool_name == "get_chat_stats":
-        return chat_storage.get_stats()
 
-    return {"error": f"Unknown tool: {tool_name}"}
+async def _execute_tool(tool_name: str, tool_args: dict) -> dict:
+    """Выполнить MCP-инструмент и вернуть результат (ToolArgumentError — неизвестный инструмент или плохие аргументы)."""
+    return await tools.call(tool_name, tool_args)
 
 
 if __name__ == "__main__":
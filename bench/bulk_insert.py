@@ -0,0 +1,61 @@
+"""
+Бенчмарк записи сообщений вебхука: save_message по одному (транзакция на
+сообщение) против save_messages (одна транзакция на пачку) при размере
+пачки 1, 10 и 100 сообщений.
+
+    python bench/bulk_insert.py [--messages 3000] [--dir /dev/shm]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=3000)
+    parser.add_argument("--dir", default=None, help="Каталог для временной БД (например, tmpfs)")
+    args = parser.parse_args()
+
+    os.environ["CHAT_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-bulk-", dir=args.dir), "chat.db")
+    import chat_storage
+
+    chat_storage.init_db()
+    counter = 0
+
+    def batch(size: int) -> list:
+        nonlocal counter
+        result = []
+        for _ in range(size):
+            counter += 1
+            result.append({
+                "message_id": f"m{counter}",
+                "lead_id": counter % 100,
+                "text": "x" * 200,
+                "origin": "avito",
+                "created_at": 1700000000 + counter,
+                "raw_payload": "{}",
+            })
+        return result
+
+    for size in (1, 10, 100):
+        rounds = args.messages // size
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for message in batch(size):
+                chat_storage.save_message(message)
+        single = rounds * size / (time.perf_counter() - started)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            chat_storage.save_messages(batch(size))
+        bulk = rounds * size / (time.perf_counter() - started)
+        print(f"пачка {size:3d}: save_message {single:8.0f} сообщ./с, save_messages {bulk:8.0f} сообщ./с")
+    chat_storage.close_db()
+
+
+if __name__ == "__main__":
+    main()
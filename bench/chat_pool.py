@@ -0,0 +1,48 @@
+"""
+Бенчмарк чтения истории чата (chat_storage.get_messages_by_lead) на 2000
+сообщениях. Сравнение — с деревом до пула соединений, где каждый вызов
+открывал соединение и заново выполнял CREATE TABLE/INDEX:
+
+    python bench/chat_pool.py --root /tmp/amocrm-before   # до
+    python bench/chat_pool.py                             # после
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=3000)
+    args = parser.parse_args()
+
+    os.environ["CHAT_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-chat-"), "chat.db")
+    sys.path.insert(0, args.root)
+    import chat_storage
+
+    if hasattr(chat_storage, "init_db"):
+        chat_storage.init_db()
+    for i in range(args.messages):
+        chat_storage.save_message({
+            "message_id": f"m{i}",
+            "lead_id": i % 50,
+            "text": f"привет {i}",
+            "origin": "avito",
+            "created_at": 1700000000 + i,
+            "raw_payload": "{}",
+        })
+
+    started = time.perf_counter()
+    for i in range(args.calls):
+        chat_storage.get_messages_by_lead(i % 50)
+    per_call = (time.perf_counter() - started) / args.calls * 1e6
+    print(f"{args.root}: get_messages_by_lead {per_call:.0f} us/вызов ({args.messages} сообщений, {args.calls} вызовов)")
+
+
+if __name__ == "__main__":
+    main()
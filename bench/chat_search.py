@@ -0,0 +1,81 @@
+"""
+Бенчмарк поиска по чатам: LIKE '%слово%' (как до FTS5) против
+search_messages по индексу chat_messages_fts, с сортировкой по
+релевантности и по свежести. Корпус генерируется из словаря в 26 слов;
+каждое 10000-е сообщение содержит редкое слово.
+
+    python bench/chat_search.py [--messages 1000000] [--db /tmp/chat_search.db]
+
+Существующая БД из --db используется повторно, генерация пропускается.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = (
+    "здравствуйте доставка заказ цена скидка квартира участок межевание кадастр геодезия съёмка выезд "
+    "инженер договор оплата счёт документы срок завтра сегодня спасибо можно уточнить адрес телефон"
+).split()
+RARE = "трансформатор"
+QUERIES = (RARE, "трансф", "межевание кадастр")
+
+
+def _generate(chat_storage, total: int) -> None:
+    rng = random.Random(1)
+    started = time.perf_counter()
+    for first in range(0, total, 1000):
+        batch = []
+        for k in range(first + 1, min(total, first + 1000) + 1):
+            text = " ".join(rng.choice(WORDS) for _ in range(12))
+            if k % 10000 == 0:
+                text += " " + RARE
+            batch.append({"message_id": f"m{k}", "lead_id": k % 5000, "text": text, "origin": "avito", "created_at": 1700000000 + k})
+        chat_storage.save_messages(batch)
+    print(f"сгенерировано {total} сообщений за {time.perf_counter() - started:.1f}s")
+
+
+def _timed(fn):
+    started = time.perf_counter()
+    rows = fn()
+    return (time.perf_counter() - started) * 1000, len(rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--db", default=os.path.join(tempfile.gettempdir(), "bench_chat_search.db"))
+    args = parser.parse_args()
+
+    exists = os.path.exists(args.db)
+    os.environ["CHAT_DB_PATH"] = args.db
+    import chat_storage
+
+    chat_storage.init_db()
+    if not exists:
+        _generate(chat_storage, args.messages)
+
+    with chat_storage._reader() as db:
+        for query in QUERIES:
+            words = query.split()
+            sql = (
+                "SELECT id FROM chat_messages WHERE " + " AND ".join(["text LIKE ?"] * len(words))
+                + " ORDER BY created_at DESC LIMIT 20"
+            )
+            like_ms, like_rows = _timed(lambda: db.execute(sql, [f"%{w}%" for w in words]).fetchall())
+            rank_ms, rank_rows = _timed(lambda: chat_storage.search_messages(query))
+            recent_ms, _ = _timed(lambda: chat_storage.search_messages(query, order="recent"))
+            print(
+                f"{query!r}: LIKE {like_ms:.1f} ms ({like_rows} строк), "
+                f"FTS rank {rank_ms:.1f} ms ({rank_rows} строк), FTS recent {recent_ms:.1f} ms"
+            )
+    chat_storage.close_db()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Бенчмарк пула соединений AmoCRM (amocrm_client): новая aiohttp-сессия на
+каждый запрос против общей сессии с keep-alive. Сервер — локальная заглушка
+на loopback без TLS, поэтому разница занижена относительно реального AmoCRM.
+
+    python bench/http_session.py [--calls 500]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("AMOCRM_ACCESS_TOKEN", "bench")
+
+import amocrm_client  # noqa: E402
+
+PORT = 8765
+
+
+async def _leads(request):
+    return web.json_response({"_embedded": {"leads": [{"id": 1}]}})
+
+
+async def main(calls: int) -> None:
+    server = web.Application()
+    server.router.add_get("/api/v4/leads", _leads)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    url = f"http://127.0.0.1:{PORT}/api/v4/leads"
+    try:
+        started = time.perf_counter()
+        for _ in range(calls):
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as response:
+                    await response.json()
+        per_call = (time.perf_counter() - started) / calls * 1000
+
+        await amocrm_client.start()
+        session = amocrm_client.get_session()
+        started = time.perf_counter()
+        for _ in range(calls):
+            async with session.get(url) as response:
+                await response.json()
+        pooled = (time.perf_counter() - started) / calls * 1000
+        await amocrm_client.close()
+    finally:
+        await runner.cleanup()
+    print(f"{calls} последовательных GET: сессия на запрос {per_call:.2f} ms/запрос, общая сессия {pooled:.2f} ms/запрос")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=500)
+    asyncio.run(main(parser.parse_args().calls))
@@ -0,0 +1,108 @@
+"""
+Бенчмарк хранения raw_payload: размер БД и время типичных чтений на 200k
+сообщений с полным JSON вебхука. Сравнение — с деревом до переноса
+raw_payload в сжатую боковую таблицу:
+
+    python bench/raw_payload.py --root /tmp/amocrm-before --db /tmp/raw_before.db   # до
+    python bench/raw_payload.py --db /tmp/raw_after.db                              # после
+
+Миграция существующей БД: скопировать БД «до» и открыть её новым деревом
+с --reuse — init_db() применит миграции, затем те же замеры:
+
+    cp /tmp/raw_before.db /tmp/raw_migrated.db
+    python bench/raw_payload.py --db /tmp/raw_migrated.db --reuse
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+BASE_TS = 1760000000
+WORDS = "привет цена доставка когда можно забрать квартира участок ипотека документы спасибо".split()
+
+
+def _item(rng: random.Random, n: int) -> dict:
+    return {
+        "id": f"msg-{n}",
+        "chat_id": f"chat-{n % 3000}",
+        "element_id": str(n % 4000),
+        "element_type": "1",
+        "created_at": BASE_TS + n * 30,
+        "text": " ".join(rng.choices(WORDS, k=8)),
+        "origin": rng.choice(["avito", "whatsapp", "telegram"]),
+        "author": {
+            "id": f"a-{n % 500}",
+            "name": "Клиент Иванов",
+            "type": rng.choice(["contact", "user"]),
+            "avatar_url": f"https://example.com/avatars/{n % 500}.png",
+        },
+        "attachment": {},
+        "talk_id": n % 3000,
+        "contact_id": n % 4000,
+        "entity": {"id": n % 4000, "type": "lead"},
+        "message": {"id": f"msg-{n}", "type": "text", "text": "…", "markup": None, "tag": "", "media": "", "thumbnail": "", "file_name": "", "file_size": 0},
+    }
+
+
+def _generate(chat_storage, total: int) -> None:
+    rng = random.Random(1)
+    for first in range(0, total, 1000):
+        items = [_item(rng, n) for n in range(first, min(total, first + 1000))]
+        chat_storage.save_messages(chat_storage.parse_webhook_messages({"message": {"add": items}}))
+
+
+def _bench(name: str, fn, runs: int = 300) -> None:
+    times = []
+    for i in range(runs):
+        started = time.perf_counter()
+        fn(i)
+        times.append(time.perf_counter() - started)
+    times.sort()
+    print(f"{name}: медиана {statistics.median(times) * 1000:.3f} ms, p95 {times[int(runs * 0.95)] * 1000:.3f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--reuse", action="store_true", help="Не генерировать, замерить существующую БД")
+    args = parser.parse_args()
+
+    if not args.reuse:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    os.environ["CHAT_DB_PATH"] = args.db
+    sys.path.insert(0, args.root)
+    import chat_storage
+
+    started = time.perf_counter()
+    chat_storage.init_db()
+    if args.reuse:
+        print(f"init_db (миграции) {time.perf_counter() - started:.1f}s")
+    else:
+        _generate(chat_storage, args.messages)
+
+    with chat_storage._writer() as db:
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"{args.root}: размер БД {os.path.getsize(args.db) / 1e6:.1f} MB")
+
+    _bench("страница сделки (50)", lambda i: chat_storage.get_messages_page("lead_id", (i * 37) % 4000, 50))
+    _bench("страница чата (50)", lambda i: chat_storage.get_messages_page("chat_id", f"chat-{(i * 7) % 3000}", 50))
+    _bench("последние (100)", lambda i: chat_storage.get_recent_messages(100))
+    _bench("поиск FTS", lambda i: chat_storage.search_messages("доставка ипотека", 20, "recent"), 100)
+
+    def scan(_):
+        with chat_storage._reader() as db:
+            db.execute("SELECT origin, COUNT(*) FROM chat_messages GROUP BY origin").fetchall()
+
+    _bench("полный проход таблицы", scan, 5)
+    chat_storage.close_db()
+
+
+if __name__ == "__main__":
+    main()
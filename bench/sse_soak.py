@@ -0,0 +1,132 @@
+"""
+Soak-тест SSE-сессий: поднимает uvicorn с app из --root, открывает --sessions
+простаивающих SSE-стримов и меряет CPU сервера за минуту простоя, задержку
+ping → ответ в SSE и как быстро сервер замечает 1000 отключений.
+
+    python bench/sse_soak.py --root /tmp/amocrm-before   # до
+    python bench/sse_soak.py                             # после
+
+Только Linux (CPU процесса читается из /proc). Для 5000 сессий нужен
+ulimit -n не меньше 12000.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+
+def _cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def _soak(base: str, pid: int, sessions: int, idle: float, pings: int, disconnects: int) -> None:
+    client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), timeout=aiohttp.ClientTimeout(total=None))
+    streams = {}
+    waiters = {}
+    keepalives = 0
+
+    async def open_stream():
+        nonlocal keepalives
+        response = await client.get(base + "/mcp/sse")
+        line = b""
+        while b"sessionId=" not in line:
+            line = await response.content.readline()
+        session_id = line.decode().strip().split("sessionId=")[1]
+        streams[session_id] = response
+
+        async def read():
+            nonlocal keepalives
+            try:
+                async for raw in response.content:
+                    if raw.startswith(b": keep-alive"):
+                        keepalives += 1
+                    elif raw.startswith(b"data:"):
+                        waiter = waiters.pop(session_id, None)
+                        if waiter is not None and not waiter.done():
+                            waiter.set_result(time.perf_counter())
+            except (aiohttp.ClientError, asyncio.CancelledError):
+                pass
+
+        asyncio.ensure_future(read())
+
+    started = time.time()
+    for first in range(0, sessions, 250):
+        await asyncio.gather(*(open_stream() for _ in range(first, min(sessions, first + 250))))
+    print(f"открыто {len(streams)} сессий за {time.time() - started:.1f}s", flush=True)
+    await asyncio.sleep(5)
+
+    cpu = _cpu_seconds(pid)
+    await asyncio.sleep(idle)
+    print(f"CPU сервера за {idle:g}s простоя: {_cpu_seconds(pid) - cpu:.2f}s; keep-alive получено {keepalives}", flush=True)
+
+    latencies = []
+    for session_id in random.sample(list(streams), min(pings, len(streams))):
+        waiter = asyncio.get_running_loop().create_future()
+        waiters[session_id] = waiter
+        sent = time.perf_counter()
+        async with client.post(f"{base}/mcp/messages?sessionId={session_id}", json={"jsonrpc": "2.0", "id": 1, "method": "ping"}) as response:
+            await response.read()
+        latencies.append((await asyncio.wait_for(waiter, 60) - sent) * 1000)
+    latencies.sort()
+    print(
+        f"ping → SSE: медиана {latencies[len(latencies) // 2]:.2f} ms, p95 {latencies[int(len(latencies) * 0.95)]:.2f} ms",
+        flush=True,
+    )
+
+    async def active() -> int:
+        async with client.get(base + "/api/metrics") as response:
+            return (await response.json())["mcp_sessions"]["active"]
+
+    before = await active()
+    victims = random.sample(list(streams), min(disconnects, len(streams)))
+    started = time.time()
+    for session_id in victims:
+        streams[session_id].close()
+    now_active = before
+    while now_active > before - len(victims) and time.time() - started < 90:
+        await asyncio.sleep(0.2)
+        now_active = await active()
+    print(f"отключение {len(victims)}: активных {before} → {now_active} за {time.time() - started:.1f}s", flush=True)
+    for response in streams.values():
+        response.close()
+    await client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--port", type=int, default=8811)
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--idle", type=float, default=60)
+    parser.add_argument("--pings", type=int, default=200)
+    parser.add_argument("--disconnects", type=int, default=1000)
+    args = parser.parse_args()
+
+    env = dict(os.environ, CHAT_DB_PATH=os.path.join(tempfile.mkdtemp(prefix="bench-soak-"), "chat.db"))
+    env.setdefault("AMOCRM_ACCESS_TOKEN", "bench")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", args.root, "app:app", "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,  # app пишет INFO-лог на каждое подключение
+    )
+    try:
+        time.sleep(4)
+        print(f"{args.root}: uvicorn pid {server.pid}", flush=True)
+        asyncio.run(_soak(f"http://127.0.0.1:{args.port}", server.pid, args.sessions, args.idle, args.pings, args.disconnects))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
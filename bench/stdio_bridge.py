@@ -0,0 +1,72 @@
+"""
+Бенчмарк stdio-моста (mcp_server): сессия на каждый вызов против общей
+keep-alive сессии и пачек make_requests. Вместо HTTP API сервера — локальная
+заглушка с задержкой ответа --delay.
+
+    python bench/stdio_bridge.py [--calls 300] [--delay 0.005]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+import aiohttp
+from aiohttp import web
+
+PORT = 8767
+os.environ["AMOCRM_SERVER_URL"] = f"http://127.0.0.1:{PORT}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcp_server  # noqa: E402
+
+
+async def _session_per_call(endpoint: str):
+    """Как было до общей сессии: новая ClientSession на каждый вызов."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{mcp_server.AMOCRM_SERVER_URL}{endpoint}") as response:
+            return await response.json()
+
+
+async def main(calls: int, delay: float) -> None:
+    async def handler(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"ok": True})
+
+    server = web.Application()
+    server.router.add_route("*", "/{tail:.*}", handler)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    try:
+        started = time.perf_counter()
+        for _ in range(calls):
+            await _session_per_call("/api/account")
+        per_call = (time.perf_counter() - started) / calls * 1000
+
+        started = time.perf_counter()
+        for _ in range(calls):
+            await mcp_server.make_request("GET", "/api/account")
+        shared = (time.perf_counter() - started) / calls * 1000
+
+        batch = [{"method": "GET", "path": "/api/account"}] * 10
+        started = time.perf_counter()
+        for _ in range(calls // len(batch)):
+            await mcp_server.make_requests(batch)
+        batched = (time.perf_counter() - started) / calls * 1000
+        await mcp_server.close_session()
+    finally:
+        await runner.cleanup()
+    print(
+        f"{calls} вызовов, задержка заглушки {delay * 1000:g} ms: сессия на вызов {per_call:.2f} ms/вызов, "
+        f"общая сессия {shared:.2f} ms/вызов, пачки по 10 {batched:.2f} ms/вызов"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--delay", type=float, default=0.005)
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.delay))
@@ -0,0 +1,104 @@
+"""
+Нагрузочный тест приёма вебхуков в процессе: 300 вебхуков по 20 сообщений,
+до 50 одновременно, через ASGI-транспорт httpx. Параллельно задача-пульс
+спит по 5 ms и меряет, насколько event loop опаздывает её разбудить.
+Время — от первого запроса до момента, когда все сообщения в SQLite.
+
+    python bench/webhook_flood.py --root /tmp/amocrm-before   # до
+    python bench/webhook_flood.py                             # после
+
+Нужен httpx.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import sqlite3
+import argparse
+import tempfile
+
+HEARTBEAT = 0.005
+
+
+def _payload(k: int, per_webhook: int) -> dict:
+    return {"message": {"add": [
+        {
+            "id": f"{k}-{i}",
+            "chat_id": "c",
+            "element_id": str(k % 100),
+            "element_type": "1",
+            "text": "x" * 200,
+            "origin": "avito",
+            "created_at": 1700000000 + i,
+            "author": {"name": "A", "type": "contact"},
+        }
+        for i in range(per_webhook)
+    ]}}
+
+
+def _stored(db_path: str) -> int:
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM chat_messages").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+async def main(args) -> None:
+    import httpx
+    import app
+
+    db_path = os.environ["CHAT_DB_PATH"]
+    expected = args.webhooks * args.per_webhook
+    lags = []
+    stop = False
+
+    async def heartbeat():
+        while not stop:
+            started = time.perf_counter()
+            await asyncio.sleep(HEARTBEAT)
+            lags.append((time.perf_counter() - started - HEARTBEAT) * 1000)
+
+    async with app.app.router.lifespan_context(app.app):
+        pulse = asyncio.create_task(heartbeat())
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench") as client:
+            started = time.perf_counter()
+            limit = asyncio.Semaphore(args.concurrency)
+
+            async def send(k: int):
+                async with limit:
+                    await client.post("/webhooks/receive", json=_payload(k, args.per_webhook))
+
+            await asyncio.gather(*(send(k) for k in range(args.webhooks)))
+            acknowledged = time.perf_counter() - started
+            while await asyncio.to_thread(_stored, db_path) < expected:
+                await asyncio.sleep(0.05)
+            stored = time.perf_counter() - started
+        stop = True
+        await pulse
+
+    lags.sort()
+    print(
+        f"{args.root}: {expected} сообщений, ответы за {acknowledged:.2f}s, в БД за {stored:.2f}s; "
+        f"пульсов {len(lags)}, задержка loop p50={lags[len(lags) // 2]:.2f} ms "
+        f"p99={lags[int(len(lags) * 0.99)]:.2f} ms max={lags[-1]:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--webhooks", type=int, default=300)
+    parser.add_argument("--per-webhook", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ["CHAT_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-webhooks-"), "chat.db")
+    os.environ.setdefault("AMOCRM_ACCESS_TOKEN", "bench")
+    sys.path.insert(0, args.root)
+    logging.disable(logging.CRITICAL)
+    asyncio.run(main(args))
@@ -1,49 +1,453 @@
 """
 Модуль хранения чат-сообщений из webhook amoCRM (Авито, WhatsApp, Telegram).
 SQLite-хранилище для message[add] событий.
+
+Схема создаётся один раз при старте (версионные миграции через PRAGMA user_version),
+дальше работают долгоживущие соединения: одно на запись, несколько на чтение.
+Сообщения старше срока хранения переносятся в помесячные архивные шарды.
 """
 
 import sqlite3
 import os
+import re
+import sys
+import glob
 import json
+import zlib
+import base64
 import time
+import queue
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
+from typing import Optional
 
 CHAT_DB_PATH = os.getenv("CHAT_DB_PATH", "/tmp/chat_messages.db")
+CHAT_DB_READERS = int(os.getenv("CHAT_DB_READERS", "4"))
+
+# Хранение: сообщения старше CHAT_RETENTION_DAYS переносятся в помесячные архивы (0 — не переносить)
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "0"))
+CHAT_ARCHIVE_DIR = os.getenv(
+    "CHAT_ARCHIVE_DIR", os.path.join(os.path.dirname(CHAT_DB_PATH) or ".", "chat_archive")
+)
+CHAT_ARCHIVE_INTERVAL = float(os.getenv("CHAT_ARCHIVE_INTERVAL", "3600"))  # сек. между проходами
+CHAT_ARCHIVE_BATCH = int(os.getenv("CHAT_ARCHIVE_BATCH", "5000"))           # строк за транзакцию
+CHAT_VACUUM_PAGES = int(os.getenv("CHAT_VACUUM_PAGES", "2000"))             # страниц за incremental_vacuum
 
 # Московское время UTC+3
 MSK = timezone(timedelta(hours=3))
 
-
-def get_db() -> sqlite3.Connection:
-    """Подключение к SQLite + создание таблицы если нет."""
-    conn = sqlite3.connect(CHAT_DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL")
+# Миграции схемы: индекс + 1 = номер версии в PRAGMA user_version
+MIGRATIONS = [
+    # 1: базовая схема
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id TEXT UNIQUE,
+        chat_id TEXT,
+        lead_id INTEGER,
+        contact_id INTEGER,
+        author_name TEXT,
+        author_id TEXT,
+        text TEXT,
+        origin TEXT,
+        is_incoming INTEGER DEFAULT 1,
+        media_url TEXT,
+        media_type TEXT,
+        created_at INTEGER,
+        raw_payload TEXT,
+        inserted_at INTEGER DEFAULT (strftime('%s', 'now'))
+    );
+    CREATE INDEX IF NOT EXISTS idx_chat_lead_id ON chat_messages(lead_id);
+    CREATE INDEX IF NOT EXISTS idx_chat_contact_id ON chat_messages(contact_id);
+    CREATE INDEX IF NOT EXISTS idx_chat_created_at ON chat_messages(created_at);
+    """,
+    # 2: полнотекстовый индекс FTS5 (unicode61: регистр Unicode, включая кириллицу; ё → е)
+    """
+    CREATE VIEW IF NOT EXISTS chat_messages_fts_src AS
+        SELECT id, replace(replace(text, 'ё', 'е'), 'Ё', 'Е') AS text FROM chat_messages;
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+        text,
+        content='chat_messages_fts_src',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    );
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(rowid, text)
+        VALUES (new.id, replace(replace(new.text, 'ё', 'е'), 'Ё', 'Е'));
+    END;
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, text)
+        VALUES ('delete', old.id, replace(replace(old.text, 'ё', 'е'), 'Ё', 'Е'));
+    END;
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF text ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, text)
+        VALUES ('delete', old.id, replace(replace(old.text, 'ё', 'е'), 'Ё', 'Е'));
+        INSERT INTO chat_messages_fts(rowid, text)
+        VALUES (new.id, replace(replace(new.text, 'ё', 'е'), 'Ё', 'Е'));
+    END;
+    INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild');
+    """,
+    # 3: составные индексы под keyset-пагинацию (created_at, id)
+    """
+    UPDATE chat_messages SET created_at = inserted_at WHERE created_at IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_chat_lead_created ON chat_messages(lead_id, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_chat_contact_created ON chat_messages(contact_id, created_at, id);
+    CREATE INDEX IF NOT EXISTS idx_chat_chat_created ON chat_messages(chat_id, created_at, id);
+    DROP INDEX IF EXISTS idx_chat_lead_id;
+    DROP INDEX IF EXISTS idx_chat_contact_id;
+    """,
+    # 4: счётчики по дням (МСК) / каналам / направлению, обновляются в той же транзакции, что и вставка
+    """
+    CREATE TABLE IF NOT EXISTS chat_stats_daily (
+        day TEXT NOT NULL,
+        origin TEXT NOT NULL DEFAULT '',
+        is_incoming INTEGER NOT NULL,
+        cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, origin, is_incoming)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER IF NOT EXISTS chat_stats_daily_ai AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_stats_daily(day, origin, is_incoming, cnt)
+        VALUES (date(new.created_at + 10800, 'unixepoch'), COALESCE(new.origin, ''), COALESCE(new.is_incoming, 1), 1)
+        ON CONFLICT(day, origin, is_incoming) DO UPDATE SET cnt = cnt + 1;
+    END;
+    INSERT INTO chat_stats_daily(day, origin, is_incoming, cnt)
+        SELECT date(created_at + 10800, 'unixepoch'), COALESCE(origin, ''), COALESCE(is_incoming, 1), COUNT(*)
+        FROM chat_messages
+        GROUP BY 1, 2, 3;
+    """,
+    # 5: raw_payload — в отдельную таблицу, сжатым zlib (см. _migrate_payloads)
+    lambda conn: _migrate_payloads(conn),
+    # 6: служебные отметки (например, отложенный VACUUM после миграций)
+    """
+    CREATE TABLE IF NOT EXISTS chat_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    ) WITHOUT ROWID;
+    """,
+]
+
+# После этих миграций на непустой базе нужен VACUUM: его делает compact_db() в фоне
+VACUUM_AFTER_MIGRATIONS = {5}
+
+# ALTER TABLE ... DROP COLUMN есть с SQLite 3.35; на старых версиях таблица пересобирается
+_HAS_DROP_COLUMN = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+_init_lock = threading.Lock()
+_writer_lock = threading.Lock()
+_writer_conn: sqlite3.Connection = None
+_readers: "queue.Queue[sqlite3.Connection]" = None
+_all_conns: list = []
+_executor: ThreadPoolExecutor = None
+_write_executor: ThreadPoolExecutor = None
+
+
+def _connect() -> sqlite3.Connection:
+    """Долгоживущее соединение; sqlite3 кэширует подготовленные выражения на нём."""
+    conn = sqlite3.connect(CHAT_DB_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _compress_payload(payload: Optional[str]) -> Optional[bytes]:
+    return zlib.compress(payload.encode("utf-8"), 6) if payload else None
+
+
+def _decompress_payload(payload) -> Optional[str]:
+    if isinstance(payload, bytes):
+        return zlib.decompress(payload).decode("utf-8")
+    return payload
+
+
+def _migrate_payloads(conn: sqlite3.Connection) -> None:
+    """
+    Исходный JSON сообщения читается редко, а в строке chat_messages занимал больше,
+    чем все остальные поля: переносим его в chat_message_payloads и сжимаем.
+    """
+    conn.create_function("zlib_compress", 1, _compress_payload, deterministic=True)
     conn.execute("""
-        CREATE TABLE IF NOT EXISTS chat_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            message_id TEXT UNIQUE,
-            chat_id TEXT,
-            lead_id INTEGER,
-            contact_id INTEGER,
-            author_name TEXT,
-            author_id TEXT,
-            text TEXT,
-            origin TEXT,
-            is_incoming INTEGER DEFAULT 1,
-            media_url TEXT,
-            media_type TEXT,
-            created_at INTEGER,
-            raw_payload TEXT,
-            inserted_at INTEGER DEFAULT (strftime('%s', 'now'))
+        CREATE TABLE IF NOT EXISTS chat_message_payloads (
+            message_pk INTEGER PRIMARY KEY,
+            payload BLOB NOT NULL
         )
     """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_lead_id ON chat_messages(lead_id)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_contact_id ON chat_messages(contact_id)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_created_at ON chat_messages(created_at)")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS chat_message_payloads_ad AFTER DELETE ON chat_messages BEGIN
+            DELETE FROM chat_message_payloads WHERE message_pk = old.id;
+        END
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO chat_message_payloads(message_pk, payload)
+        SELECT id, zlib_compress(raw_payload) FROM chat_messages WHERE raw_payload IS NOT NULL AND raw_payload != ''
+    """)
+    if _HAS_DROP_COLUMN:
+        conn.execute("ALTER TABLE chat_messages DROP COLUMN raw_payload")
+    else:
+        _rebuild_without_raw_payload(conn)
+
+
+def _rebuild_without_raw_payload(conn: sqlite3.Connection) -> None:
+    """
+    DROP COLUMN для SQLite < 3.35: новая таблица без raw_payload, копирование строк
+    с теми же id, замена старой. Триггеры и представления снимаются заранее (иначе
+    DROP TABLE заденет FTS и chat_message_payloads, а RENAME споткнётся о view
+    на несуществующую таблицу) и создаются заново вместе с индексами.
+    """
+    table_sql = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages'"
+    ).fetchone()[0]
+    new_sql, replaced = re.subn(r"\s*raw_payload\s+TEXT\s*,", "", table_sql, count=1)
+    if not replaced:
+        raise RuntimeError("Миграция 5: не найден столбец raw_payload в схеме chat_messages")
+    new_sql = new_sql.replace("chat_messages", "chat_messages_new", 1)
+    dependents = conn.execute(
+        """
+        SELECT type, name, sql FROM sqlite_master
+        WHERE sql IS NOT NULL AND (
+            (type IN ('index', 'trigger') AND tbl_name = 'chat_messages')
+            OR (type = 'view' AND sql LIKE '%chat_messages%')
+        )
+        """
+    ).fetchall()
+    columns = ", ".join(
+        row[1] for row in conn.execute("PRAGMA table_info(chat_messages)") if row[1] != "raw_payload"
+    )
+    for kind, name, _ in dependents:
+        if kind != "index":
+            conn.execute(f"DROP {kind.upper()} {name}")
+    conn.execute(new_sql)
+    conn.execute(f"INSERT INTO chat_messages_new ({columns}) SELECT {columns} FROM chat_messages")
+    conn.execute("DROP TABLE chat_messages")
+    conn.execute("ALTER TABLE chat_messages_new RENAME TO chat_messages")
+    # Представления — первыми: на них ссылается FTS
+    for kind, _, sql in sorted(dependents, key=lambda item: item[0] != "view"):
+        conn.execute(sql)
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """Применить недостающие миграции, каждую в своей транзакции."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    had_rows = _has_rows(conn, "chat_messages")
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            if callable(step):
+                conn.execute("BEGIN")
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            else:
+                conn.executescript(f"BEGIN; {step}; PRAGMA user_version = {number}; COMMIT;")
+        except Exception:
+            conn.rollback()
+            raise
+    # Миграции, переписавшие таблицы, оставляют полупустые страницы: отметка для compact_db()
+    if had_rows and any(number > version for number in VACUUM_AFTER_MIGRATIONS):
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_meta(key, value) VALUES ('vacuum_pending', ?)",
+                (f"после миграций {version + 1}..{len(MIGRATIONS)}",),
+            )
+
+
+def _has_rows(conn: sqlite3.Connection, table: str) -> bool:
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    return exists is not None and conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None
+
+
+def _init_auto_vacuum() -> None:
+    """
+    auto_vacuum=INCREMENTAL, чтобы место после архивации возвращалось порциями.
+    Режим задаётся до первой таблицы и до перевода в WAL (иначе SQLite его молча
+    игнорирует), поэтому новую базу размечает отдельное соединение ещё до _connect();
+    существующую переводит compact_db() в фоне после старта.
+    """
+    conn = sqlite3.connect(CHAT_DB_PATH)
+    try:
+        if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")  # пустая база: записывает заголовок с выбранным режимом
+    finally:
+        conn.close()
+
+
+def _compaction_reason(conn: sqlite3.Connection) -> Optional[str]:
+    """Зачем нужен VACUUM; несколько причин закрываются одним проходом."""
+    reasons = []
+    pending = conn.execute("SELECT value FROM chat_meta WHERE key = 'vacuum_pending'").fetchone()
+    if pending is not None:
+        reasons.append(pending[0])
+    if CHAT_RETENTION_DAYS > 0 and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        reasons.append("включение auto_vacuum=INCREMENTAL для архивации")
+    return "; ".join(reasons) or None
+
+
+def compact_db() -> Optional[dict]:
+    """
+    Однократный полный VACUUM, если он нужен (см. _compaction_reason); иначе None.
+    Запускается в фоне после старта, а не в init_db: на большой базе VACUUM идёт
+    минутами. Вызывать через run_in_writer: запись в это время копится в очереди
+    потока писателя, пул читателей остаётся свободным.
+    Уплотняет один воркер: остальные, не дождавшись блокировки, пропускают шаг.
+    """
+    if _writer_conn is None:
+        init_db()
+    lock = sqlite3.connect(CHAT_DB_PATH + ".compact.lock", timeout=0, isolation_level=None)
+    try:
+        lock.execute("BEGIN EXCLUSIVE")
+    except sqlite3.OperationalError:
+        lock.close()
+        return None
+    try:
+        with _writer_lock:
+            return _compact(_writer_conn)
+    finally:
+        lock.close()
+
+
+def _compact(conn: sqlite3.Connection) -> Optional[dict]:
+    reason = _compaction_reason(conn)
+    if reason is None:
+        return None
     conn.commit()
-    return conn
+    size_before = os.path.getsize(CHAT_DB_PATH)
+    started = time.monotonic()
+    if CHAT_RETENTION_DAYS > 0:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    with conn:
+        conn.execute("DELETE FROM chat_meta WHERE key = 'vacuum_pending'")
+    return {
+        "reason": reason,
+        "seconds": round(time.monotonic() - started, 1),
+        "size_before": size_before,
+        "size_after": os.path.getsize(CHAT_DB_PATH),
+    }
+
+
+@contextmanager
+def _migration_lock():
+    """
+    Межпроцессная блокировка на время миграций: воркеры uvicorn --workers N
+    стартуют одновременно, миграции должен применить ровно один из них.
+    """
+    lock = sqlite3.connect(CHAT_DB_PATH + ".lock", timeout=600, isolation_level=None)
+    try:
+        lock.execute("BEGIN EXCLUSIVE")
+        yield
+    finally:
+        lock.close()
+
+
+def init_db() -> None:
+    """Создать схему и пул соединений (идемпотентно, вызывается при старте)."""
+    global _writer_conn, _readers
+    with _init_lock:
+        if _writer_conn is not None:
+            return
+        with _migration_lock():
+            _init_auto_vacuum()
+            writer = _connect()
+            _migrate(writer)
+        readers = queue.Queue()
+        conns = [writer]
+        for _ in range(max(1, CHAT_DB_READERS)):
+            conn = _connect()
+            readers.put(conn)
+            conns.append(conn)
+        _all_conns[:] = conns
+        _readers = readers
+        _writer_conn = writer
+
+
+def close_db() -> None:
+    """Закрыть все соединения пула (при остановке приложения)."""
+    global _writer_conn, _readers, _executor, _write_executor
+    with _init_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _write_executor is not None:
+            _write_executor.shutdown(wait=True)
+            _write_executor = None
+        for conn in _all_conns:
+            conn.close()
+        _all_conns.clear()
+        _writer_conn = None
+        _readers = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _init_lock:
+            if _executor is None:
+                # Читатели + один поток под запись зеркала сущностей (у него своя база)
+                _executor = ThreadPoolExecutor(
+                    max_workers=max(1, CHAT_DB_READERS) + 1,
+                    thread_name_prefix="chat-db",
+                )
+    return _executor
+
+
+async def run_in_db(fn, *args, **kwargs):
+    """
+    Асинхронный фасад: выполнить функцию хранилища в пуле потоков БД,
+    не блокируя event loop (SSE-стримы и прокси к AmoCRM продолжают работать).
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def _get_write_executor() -> ThreadPoolExecutor:
+    global _write_executor
+    if _write_executor is None:
+        with _init_lock:
+            if _write_executor is None:
+                _write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-db-write")
+    return _write_executor
+
+
+async def run_in_writer(fn, *args, **kwargs):
+    """
+    То же, что run_in_db, для записи в базу чатов: отдельный поток писателя.
+    Пока пишущее соединение занято (архивация, VACUUM в compact_db), запись ждёт
+    в очереди этого потока и не занимает потоки, которые обслуживают чтение.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_write_executor(), functools.partial(fn, *args, **kwargs))
+
+
+@contextmanager
+def _reader():
+    if _writer_conn is None:
+        init_db()
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+
+@contextmanager
+def _writer():
+    """Единственное пишущее соединение: транзакция коммитится на выходе."""
+    if _writer_conn is None:
+        init_db()
+    with _writer_lock:
+        try:
+            yield _writer_conn
+            _writer_conn.commit()
+        except Exception:
+            _writer_conn.rollback()
+            raise
 
 
 def parse_webhook_messages(payload: dict) -> list[dict]:
@@ -105,36 +509,75 @@ def parse_webhook_messages(payload: dict) -> list[dict]:
     return messages
 
 
+_INSERT_MESSAGE_SQL = """
+    INSERT OR IGNORE INTO chat_messages
+    (message_id, chat_id, lead_id, contact_id, author_name, author_id,
+     text, origin, is_incoming, media_url, media_type, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Payload привязывается к строке по message_id; у дубликата он уже есть — игнорируется
+_INSERT_PAYLOAD_SQL = """
+    INSERT OR IGNORE INTO chat_message_payloads(message_pk, payload)
+    SELECT id, ? FROM chat_messages WHERE message_id = ?
+"""
+
+
+def _message_row(msg: dict) -> tuple:
+    return (
+        msg.get("message_id"),
+        msg.get("chat_id"),
+        msg.get("lead_id"),
+        msg.get("contact_id"),
+        msg.get("author_name"),
+        msg.get("author_id"),
+        msg.get("text"),
+        msg.get("origin"),
+        msg.get("is_incoming", 1),
+        msg.get("media_url"),
+        msg.get("media_type"),
+        # created_at нужен для keyset-пагинации: без него — время приёма
+        msg.get("created_at") if msg.get("created_at") is not None else int(time.time()),
+    )
+
+
+def save_messages(messages: list[dict]) -> dict:
+    """
+    Сохранить пачку сообщений одной транзакцией (один commit/fsync на пачку).
+    raw_payload сохраняется сжатым в chat_message_payloads.
+    Возвращает {"inserted": N, "duplicates": M}.
+    """
+    if not messages:
+        return {"inserted": 0, "duplicates": 0}
+    keyed = [msg for msg in messages if msg.get("message_id") is not None]
+    with _writer() as db:
+        cursor = db.executemany(_INSERT_MESSAGE_SQL, [_message_row(msg) for msg in keyed])
+        # rowcount — сумма sqlite3_changes() по всем строкам; проигнорированные дубликаты дают 0
+        inserted = cursor.rowcount if keyed else 0
+        db.executemany(_INSERT_PAYLOAD_SQL, [
+            (_compress_payload(msg["raw_payload"]), msg["message_id"])
+            for msg in keyed if msg.get("raw_payload")
+        ])
+        # Без message_id связать payload можно только через lastrowid
+        for msg in messages:
+            if msg.get("message_id") is not None:
+                continue
+            row_id = db.execute(_INSERT_MESSAGE_SQL, _message_row(msg)).lastrowid
+            inserted += 1
+            if msg.get("raw_payload"):
+                db.execute(
+                    "INSERT INTO chat_message_payloads(message_pk, payload) VALUES (?, ?)",
+                    (row_id, _compress_payload(msg["raw_payload"]))
+                )
+    return {"inserted": inserted, "duplicates": len(messages) - inserted}
+
+
 def save_message(msg: dict) -> bool:
     """Сохранить сообщение в БД. Возвращает True если записано (не дубликат)."""
     try:
-        db = get_db()
-        db.execute("""
-            INSERT OR IGNORE INTO chat_messages
-            (message_id, chat_id, lead_id, contact_id, author_name, author_id,
-             text, origin, is_incoming, media_url, media_type, created_at, raw_payload)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            msg.get("message_id"),
-            msg.get("chat_id"),
-            msg.get("lead_id"),
-            msg.get("contact_id"),
-            msg.get("author_name"),
-            msg.get("author_id"),
-            msg.get("text"),
-            msg.get("origin"),
-            msg.get("is_incoming", 1),
-            msg.get("media_url"),
-            msg.get("media_type"),
-            msg.get("created_at"),
-            msg.get("raw_payload"),
-        ))
-        db.commit()
-        return db.total_changes > 0
+        return save_messages([msg])["inserted"] > 0
     except Exception:
         return False
-    finally:
-        db.close()
 
 
 def _rows_to_dicts(rows) -> list[dict]:
@@ -142,94 +585,360 @@ def _rows_to_dicts(rows) -> list[dict]:
     return [dict(row) for row in rows]
 
 
+# Поля, которые отдают читающие запросы (raw_payload — только по include_raw)
+_MESSAGE_COLUMNS = (
+    "id", "message_id", "chat_id", "lead_id", "contact_id", "author_name", "author_id",
+    "text", "origin", "is_incoming", "media_url", "media_type", "created_at",
+)
+_SELECT_COLUMNS = ", ".join(_MESSAGE_COLUMNS)
+
+
+def _attach_payloads(db: sqlite3.Connection, messages: list[dict]) -> list[dict]:
+    """Подгрузить и распаковать raw_payload для уже выбранных сообщений."""
+    if not messages:
+        return messages
+    ids = [msg["id"] for msg in messages]
+    rows = db.execute(
+        f"SELECT message_pk, payload FROM chat_message_payloads WHERE message_pk IN ({', '.join('?' for _ in ids)})",
+        ids
+    ).fetchall()
+    payloads = {row["message_pk"]: row["payload"] for row in rows}
+    for msg in messages:
+        msg["raw_payload"] = _decompress_payload(payloads.get(msg["id"]))
+    return messages
+
+
+_PAGE_FIELDS = ("lead_id", "contact_id", "chat_id")
+
+
+def encode_cursor(created_at: int, row_id: int) -> str:
+    """Непрозрачный курсор на позицию (created_at, id)."""
+    return base64.urlsafe_b64encode(f"{created_at}:{row_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[int, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split(":")
+        return int(created_at), int(row_id)
+    except Exception:
+        raise ValueError(f"Некорректный cursor: {cursor}")
+
+
+def get_messages_page(
+    field: str,
+    value,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    offset: int = 0,
+    include_raw: bool = False,
+) -> tuple[list[dict], Optional[str]]:
+    """
+    Страница сообщений по lead_id / contact_id / chat_id в порядке (created_at, id).
+    С cursor — keyset-пагинация по составному индексу (offset игнорируется):
+    глубокие страницы не пересканируются, новые сообщения не сдвигают границы.
+    include_raw — добавить исходный JSON вебхука (raw_payload).
+    Возвращает (messages, next_cursor); next_cursor = None на последней странице.
+    """
+    if field not in _PAGE_FIELDS:
+        raise ValueError(f"Неподдерживаемое поле: {field}")
+    sql = f"SELECT {_SELECT_COLUMNS} FROM chat_messages WHERE {field} = ?"
+    args: list = [value]
+    if cursor:
+        sql += " AND (created_at, id) > (?, ?)"
+        args.extend(decode_cursor(cursor))
+        offset = 0
+    sql += " ORDER BY created_at ASC, id ASC LIMIT ? OFFSET ?"
+    args.extend([limit + 1, offset])
+
+    with _reader() as db:
+        rows = db.execute(sql, args).fetchall()
+        messages = _rows_to_dicts(rows[:limit])
+        if include_raw:
+            _attach_payloads(db, messages)
+    next_cursor = None
+    if len(rows) > limit and messages:
+        last = messages[-1]
+        next_cursor = encode_cursor(last["created_at"], last["id"])
+    return messages, next_cursor
+
+
 def get_messages_by_lead(lead_id: int, limit: int = 50, offset: int = 0) -> list[dict]:
     """Получить сообщения по ID сделки."""
-    db = get_db()
-    try:
-        rows = db.execute(
-            "SELECT * FROM chat_messages WHERE lead_id = ? ORDER BY created_at ASC LIMIT ? OFFSET ?",
-            (lead_id, limit, offset)
-        ).fetchall()
-        return _rows_to_dicts(rows)
-    finally:
-        db.close()
+    return get_messages_page("lead_id", lead_id, limit, offset=offset)[0]
 
 
 def get_messages_by_contact(contact_id: int, limit: int = 50, offset: int = 0) -> list[dict]:
     """Получить сообщения по ID контакта."""
-    db = get_db()
-    try:
-        rows = db.execute(
-            "SELECT * FROM chat_messages WHERE contact_id = ? ORDER BY created_at ASC LIMIT ? OFFSET ?",
-            (contact_id, limit, offset)
-        ).fetchall()
-        return _rows_to_dicts(rows)
-    finally:
-        db.close()
+    return get_messages_page("contact_id", contact_id, limit, offset=offset)[0]
 
 
 def get_messages_by_chat(chat_id: str, limit: int = 50, offset: int = 0) -> list[dict]:
     """Получить сообщения по ID чата."""
-    db = get_db()
-    try:
-        rows = db.execute(
-            "SELECT * FROM chat_messages WHERE chat_id = ? ORDER BY created_at ASC LIMIT ? OFFSET ?",
-            (chat_id, limit, offset)
-        ).fetchall()
-        return _rows_to_dicts(rows)
-    finally:
-        db.close()
+    return get_messages_page("chat_id", chat_id, limit, offset=offset)[0]
 
 
 def get_recent_messages(limit: int = 20) -> list[dict]:
     """Получить последние сообщения из всех каналов."""
-    db = get_db()
-    try:
+    with _reader() as db:
         rows = db.execute(
-            "SELECT * FROM chat_messages ORDER BY created_at DESC LIMIT ?",
+            f"SELECT {_SELECT_COLUMNS} FROM chat_messages ORDER BY created_at DESC LIMIT ?",
             (limit,)
         ).fetchall()
         return _rows_to_dicts(rows)
-    finally:
-        db.close()
 
 
-def search_messages(query: str, limit: int = 20) -> list[dict]:
-    """Поиск по тексту сообщений (LIKE)."""
-    db = get_db()
-    try:
+_SEARCH_TOKEN_RE = re.compile(r"\w+")
+
+
+def _fts_query(query: str) -> str:
+    """Запрос пользователя -> MATCH-выражение FTS5: все слова, каждое как префикс."""
+    normalized = query.replace("ё", "е").replace("Ё", "Е")
+    return " ".join(f'"{token}"*' for token in _SEARCH_TOKEN_RE.findall(normalized))
+
+
+def search_messages(query: str, limit: int = 20, order: str = "rank") -> list[dict]:
+    """
+    Полнотекстовый поиск (FTS5): слова ищутся по префиксу, в ответе сниппет
+    с подсветкой [..]. order="rank" — по релевантности (bm25),
+    order="recent" — сначала новые (быстрее для частых слов).
+    Пустой запрос — последние сообщения.
+    """
+    match = _fts_query(query or "")
+    if not match:
+        return get_recent_messages(limit)
+    order_by = "rowid DESC" if order == "recent" else "rank"
+    with _reader() as db:
         rows = db.execute(
-            "SELECT * FROM chat_messages WHERE text LIKE ? ORDER BY created_at DESC LIMIT ?",
-            (f"%{query}%", limit)
+            f"""
+            SELECT {", ".join(f"m.{column}" for column in _MESSAGE_COLUMNS)}, f.snippet, f.rank
+            FROM (
+                SELECT rowid, rank, snippet(chat_messages_fts, 0, '[', ']', '…', 12) AS snippet
+                FROM chat_messages_fts
+                WHERE chat_messages_fts MATCH ?
+                ORDER BY {order_by}
+                LIMIT ?
+            ) f
+            JOIN chat_messages m ON m.id = f.rowid
+            ORDER BY {"m.id DESC" if order == "recent" else "f.rank"}
+            """,
+            (match, limit)
         ).fetchall()
         return _rows_to_dicts(rows)
-    finally:
-        db.close()
 
 
-def get_stats() -> dict:
-    """Статистика: всего сообщений, за сегодня, по каналам."""
-    db = get_db()
-    try:
-        total = db.execute("SELECT COUNT(*) FROM chat_messages").fetchone()[0]
+def rebuild_search_index() -> None:
+    """Перестроить FTS-индекс из chat_messages (после ручных правок БД или восстановления)."""
+    with _writer() as db:
+        db.execute("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')")
+        db.execute("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('optimize')")
 
-        today_start = int(datetime.now(MSK).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
-        today = db.execute(
-            "SELECT COUNT(*) FROM chat_messages WHERE created_at >= ?", (today_start,)
-        ).fetchone()[0]
 
-        by_origin_rows = db.execute(
-            "SELECT origin, COUNT(*) as cnt FROM chat_messages GROUP BY origin ORDER BY cnt DESC"
+def get_stats(days: int = 7) -> dict:
+    """
+    Статистика: всего сообщений, за сегодня, по каналам, по направлению
+    и по дням за последние days дней (МСК). Читается из chat_stats_daily,
+    поэтому не зависит от размера истории.
+    """
+    today = datetime.now(MSK).date()
+    since = (today - timedelta(days=max(days, 1) - 1)).isoformat()
+    with _reader() as db:
+        rows = db.execute(
+            "SELECT origin, is_incoming, SUM(cnt) AS cnt FROM chat_stats_daily GROUP BY origin, is_incoming"
+        ).fetchall()
+        daily_rows = db.execute(
+            "SELECT day, is_incoming, SUM(cnt) AS cnt FROM chat_stats_daily WHERE day >= ? GROUP BY day, is_incoming ORDER BY day",
+            (since,)
         ).fetchall()
-        by_origin = {row["origin"]: row["cnt"] for row in by_origin_rows}
 
-        return {
-            "total": total,
-            "today": today,
-            "by_origin": by_origin
-        }
+    by_origin: dict = {}
+    by_direction = {"incoming": 0, "outgoing": 0}
+    for row in rows:
+        origin = row["origin"] or ""
+        by_origin[origin] = by_origin.get(origin, 0) + row["cnt"]
+        by_direction["incoming" if row["is_incoming"] else "outgoing"] += row["cnt"]
+
+    daily: dict = {}
+    for row in daily_rows:
+        bucket = daily.setdefault(row["day"], {"day": row["day"], "total": 0, "incoming": 0, "outgoing": 0})
+        bucket["total"] += row["cnt"]
+        bucket["incoming" if row["is_incoming"] else "outgoing"] += row["cnt"]
+
+    return {
+        "total": sum(by_direction.values()),
+        "today": daily.get(today.isoformat(), {}).get("total", 0),
+        "by_origin": dict(sorted(by_origin.items(), key=lambda item: item[1], reverse=True)),
+        "by_direction": by_direction,
+        "daily": list(daily.values()),
+    }
+
+
+# ---------- Архив: помесячные SQLite-шарды ----------
+
+_ARCHIVE_COLUMNS = (
+    "id", "message_id", "chat_id", "lead_id", "contact_id", "author_name", "author_id",
+    "text", "origin", "is_incoming", "media_url", "media_type", "created_at", "raw_payload", "inserted_at",
+)
+
+# raw_payload в архиве хранится сжатым (zlib) прямо в строке, остальные поля — как в основной таблице
+_ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id INTEGER PRIMARY KEY,
+    message_id TEXT UNIQUE,
+    chat_id TEXT,
+    lead_id INTEGER,
+    contact_id INTEGER,
+    author_name TEXT,
+    author_id TEXT,
+    text TEXT,
+    origin TEXT,
+    is_incoming INTEGER,
+    media_url TEXT,
+    media_type TEXT,
+    created_at INTEGER,
+    raw_payload BLOB,
+    inserted_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_chat_lead_created ON chat_messages(lead_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_chat_contact_created ON chat_messages(contact_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_chat_chat_created ON chat_messages(chat_id, created_at, id);
+"""
+
+_ARCHIVE_NAME_RE = re.compile(r"chat_messages_(\d{4}-\d{2})\.db$")
+
+
+def _archive_path(month: str) -> str:
+    return os.path.join(CHAT_ARCHIVE_DIR, f"chat_messages_{month}.db")
+
+
+def _open_shard(month: str) -> sqlite3.Connection:
+    os.makedirs(CHAT_ARCHIVE_DIR, exist_ok=True)
+    conn = sqlite3.connect(_archive_path(month))
+    conn.executescript(_ARCHIVE_SCHEMA)
+    return conn
+
+
+def list_archives() -> list[dict]:
+    """Архивные шарды: месяц (МСК), путь и размер файла."""
+    archives = []
+    for path in sorted(glob.glob(os.path.join(CHAT_ARCHIVE_DIR, "chat_messages_*.db"))):
+        match = _ARCHIVE_NAME_RE.search(path)
+        if match:
+            archives.append({"month": match.group(1), "path": path, "size": os.path.getsize(path)})
+    return archives
+
+
+def archive_old_messages(retention_days: Optional[int] = None) -> dict:
+    """
+    Перенести сообщения старше retention_days в помесячные шарды CHAT_ARCHIVE_DIR
+    (месяц по created_at, МСК) и вернуть место в основной базе через incremental_vacuum.
+    Пачка сначала фиксируется в шарде, потом удаляется из основной базы: при сбое
+    между шагами строки останутся в обоих местах и будут дочищены следующим проходом.
+    Счётчики chat_stats_daily не уменьшаются — статистика остаётся за всю историю.
+    """
+    days = CHAT_RETENTION_DAYS if retention_days is None else retention_days
+    if days <= 0:
+        return {"archived": 0, "months": [], "freed_pages": 0}
+    cutoff = int(time.time()) - days * 86400
+    columns = ", ".join(_ARCHIVE_COLUMNS)
+    placeholders = ", ".join("?" for _ in _ARCHIVE_COLUMNS)
+    # payload уже сжат в chat_message_payloads — копируется как есть
+    source_columns = ", ".join(
+        "p.payload AS raw_payload" if column == "raw_payload" else f"m.{column}" for column in _ARCHIVE_COLUMNS
+    )
+
+    archived = 0
+    months: set = set()
+    shards: dict = {}
+    try:
+        while True:
+            with _reader() as db:
+                rows = db.execute(
+                    f"""
+                    SELECT {source_columns}
+                    FROM chat_messages m LEFT JOIN chat_message_payloads p ON p.message_pk = m.id
+                    WHERE m.created_at < ? ORDER BY m.created_at, m.id LIMIT ?
+                    """,
+                    (cutoff, CHAT_ARCHIVE_BATCH)
+                ).fetchall()
+            if not rows:
+                break
+
+            by_month: dict = {}
+            for row in rows:
+                month = datetime.fromtimestamp(row["created_at"], tz=MSK).strftime("%Y-%m")
+                by_month.setdefault(month, []).append(tuple(row))
+            for month, values in by_month.items():
+                shard = shards.get(month) or shards.setdefault(month, _open_shard(month))
+                with shard:
+                    shard.executemany(
+                        f"INSERT OR IGNORE INTO chat_messages ({columns}) VALUES ({placeholders})", values
+                    )
+            months.update(by_month)
+
+            # Триггеры убирают строки из полнотекстового индекса и chat_message_payloads
+            with _writer() as db:
+                db.executemany("DELETE FROM chat_messages WHERE id = ?", [(row["id"],) for row in rows])
+            archived += len(rows)
     finally:
-        db.close()
+        for shard in shards.values():
+            shard.close()
+
+    # Свободные страницы возвращаются порциями: остаток доберут следующие проходы
+    return {"archived": archived, "months": sorted(months), "freed_pages": vacuum_incremental()}
+
+
+def vacuum_incremental(pages: Optional[int] = None) -> int:
+    """Вернуть ОС до pages свободных страниц основной базы. Возвращает их число."""
+    pages = CHAT_VACUUM_PAGES if pages is None else pages
+    with _writer() as db:
+        free_before = db.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript прогоняет PRAGMA до конца: через execute освобождается одна страница за шаг
+        db.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        free_after = db.execute("PRAGMA freelist_count").fetchone()[0]
+    return free_before - free_after
+
+
+def get_archived_messages(
+    field: str,
+    value,
+    limit: int = 50,
+    before: Optional[int] = None,
+    include_raw: bool = False,
+) -> list[dict]:
+    """
+    Сообщения по lead_id / contact_id / chat_id из архивных шардов, последние limit штук
+    (до before, если задан), в порядке (created_at, id). Шарды читаются от новых к старым,
+    пока не наберётся limit.
+    """
+    if field not in _PAGE_FIELDS:
+        raise ValueError(f"Неподдерживаемое поле: {field}")
+    columns = _MESSAGE_COLUMNS + (("raw_payload",) if include_raw else ())
+    sql = f"SELECT {', '.join(columns)} FROM chat_messages WHERE {field} = ?"
+    args: list = [value]
+    if before is not None:
+        sql += " AND created_at < ?"
+        args.append(before)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+
+    messages: list = []
+    for archive in reversed(list_archives()):
+        if len(messages) >= limit:
+            break
+        conn = sqlite3.connect(f"file:{archive['path']}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute(sql, args + [limit - len(messages)]).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            msg = dict(row)
+            if include_raw:
+                msg["raw_payload"] = _decompress_payload(msg["raw_payload"])
+            msg["archived"] = True
+            messages.append(msg)
+    messages.reverse()
+    return messages
 
 
 def format_chat_history(messages: list[dict]) -> str:
@@ -267,3 +976,18 @@ def format_chat_history(messages: list[dict]) -> str:
         lines.append("")
 
     return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # Служебные команды: python chat_storage.py rebuild-fts | archive
+    commands = {
+        "rebuild-fts": rebuild_search_index,
+        "archive": lambda: print(archive_old_messages()),
+    }
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        print(f"Использование: python chat_storage.py [{'|'.join(commands)}]")
+        sys.exit(1)
+    init_db()
+    commands[sys.argv[1]]()
+    close_db()
+    print("OK")
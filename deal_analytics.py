@@ -0,0 +1,226 @@
+"""
+Агрегаты по сделкам за один проход.
+Сделки поступают постранично (из AmoCRM или локального зеркала) и сразу
+сворачиваются в группы: счётчики, суммы, min/max и выборка фиксированного
+размера для перцентилей. Память зависит от числа групп, а не от числа сделок.
+"""
+
+import os
+import random
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from chat_storage import MSK
+
+DEAL_AGG_RESERVOIR = int(os.getenv("DEAL_AGG_RESERVOIR", "1024"))  # размер выборки для перцентилей на группу
+DEAL_AGG_MAX_GROUPS = int(os.getenv("DEAL_AGG_MAX_GROUPS", "10000"))
+
+# Системные статусы AmoCRM: «Успешно реализовано» и «Закрыто и не реализовано»
+STATUS_WON = 142
+STATUS_LOST = 143
+
+DAY = 86400
+
+
+def _month(ts: Optional[int]) -> Optional[str]:
+    return datetime.fromtimestamp(ts, MSK).strftime("%Y-%m") if ts else None
+
+
+# Поля группировки: имя → значение из сделки
+GROUP_FIELDS = {
+    "pipeline_id": lambda lead: lead.get("pipeline_id"),
+    "status_id": lambda lead: lead.get("status_id"),
+    "responsible_user_id": lambda lead: lead.get("responsible_user_id"),
+    "loss_reason_id": lambda lead: lead.get("loss_reason_id"),
+    "created_month": lambda lead: _month(lead.get("created_at")),
+    "closed_month": lambda lead: _month(lead.get("closed_at")),
+}
+
+
+def parse_group_by(value: Optional[str]) -> Tuple[str, ...]:
+    """'pipeline_id,status_id' → ('pipeline_id', 'status_id'); ValueError для неизвестных полей."""
+    fields = tuple(dict.fromkeys(f.strip() for f in (value or "").split(",") if f.strip()))
+    unknown = [f for f in fields if f not in GROUP_FIELDS]
+    if unknown:
+        raise ValueError(f"неизвестные поля группировки {unknown}, допустимы: {sorted(GROUP_FIELDS)}")
+    return fields
+
+
+def parse_percentiles(value: Optional[str]) -> Tuple[float, ...]:
+    """'50,90,99' → (50.0, 90.0, 99.0)."""
+    result = []
+    for part in (value or "").split(","):
+        if not part.strip():
+            continue
+        p = float(part)
+        if not 0 <= p <= 100:
+            raise ValueError(f"перцентиль {p} вне диапазона 0..100")
+        result.append(p)
+    return tuple(result)
+
+
+def summarize(ordered: Sequence[float], total: float, percentiles: Sequence[float], scale: float = 1.0, digits: int = 2) -> dict:
+    """n/sum/avg/min/max и перцентили (ближайший ранг) по отсортированным значениям."""
+    n = len(ordered)
+    if not n:
+        return {"n": 0}
+    result = {
+        "n": n,
+        "sum": round(total / scale, digits),
+        "avg": round(total / n / scale, digits),
+        "min": round(float(ordered[0]) / scale, digits),
+        "max": round(float(ordered[-1]) / scale, digits),
+    }
+    for p in percentiles:
+        index = min(n - 1, max(0, int(round(p / 100 * (n - 1)))))
+        result[f"p{p:g}"] = round(float(ordered[index]) / scale, digits)
+    return result
+
+
+class Reservoir:
+    """
+    Числовая метрика: count/sum/min/max точно, перцентили — по равномерной
+    выборке из size значений (алгоритм R). Пока значений не больше size,
+    перцентили точные.
+    """
+
+    __slots__ = ("size", "count", "total", "minimum", "maximum", "sample", "_random")
+
+    def __init__(self, size: int, rng: random.Random):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.sample: List[float] = []
+        self._random = rng
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            slot = self._random.randrange(self.count)
+            if slot < self.size:
+                self.sample[slot] = value
+
+    def summary(self, percentiles: Sequence[float], scale: float = 1.0, digits: int = 2) -> dict:
+        if not self.count:
+            return {"n": 0}
+        # Перцентили — по выборке; n, сумма, min и max — точные
+        result = summarize(sorted(self.sample), self.total, percentiles, scale, digits)
+        result.update(
+            n=self.count,
+            avg=round(self.total / self.count / scale, digits),
+            min=round(self.minimum / scale, digits),
+            max=round(self.maximum / scale, digits),
+        )
+        return result
+
+
+class _Group:
+    __slots__ = ("count", "won", "lost", "price", "cycle", "age")
+
+    def __init__(self, size: int, rng: random.Random):
+        self.count = 0
+        self.won = 0
+        self.lost = 0
+        self.price = Reservoir(size, rng)
+        self.cycle = Reservoir(size, rng)   # закрытые: closed_at - created_at
+        self.age = Reservoir(size, rng)     # открытые: now - created_at
+
+
+class DealAggregator:
+    """
+    Группировка сделок по group_by и метрики по группам.
+    Время в статусе AmoCRM в сделке не отдаёт (только события смены статуса),
+    поэтому считаются длительность цикла закрытых сделок и возраст открытых.
+    """
+
+    def __init__(
+        self,
+        group_by: Sequence[str] = (),
+        percentiles: Sequence[float] = (50, 90),
+        reservoir: int = DEAL_AGG_RESERVOIR,
+        now: Optional[int] = None,
+        seed: int = 0,
+    ):
+        self.group_by = tuple(group_by)
+        self.percentiles = tuple(percentiles)
+        self.reservoir = max(1, reservoir)
+        self.now = now
+        self._getters = [GROUP_FIELDS[field] for field in self.group_by]
+        self._random = random.Random(seed)
+        self._groups: Dict[Tuple, _Group] = {}
+        self._total = _Group(self.reservoir, self._random)
+        self.pages = 0
+        self.ungrouped = 0
+
+    def _group(self, key: Tuple) -> Optional[_Group]:
+        group = self._groups.get(key)
+        if group is None:
+            if len(self._groups) >= DEAL_AGG_MAX_GROUPS:
+                self.ungrouped += 1
+                return None
+            group = self._groups[key] = _Group(self.reservoir, self._random)
+        return group
+
+    def add_page(self, leads: Iterable[dict]) -> None:
+        self.pages += 1
+        now = self.now
+        for lead in leads:
+            group = self._group(tuple(getter(lead) for getter in self._getters)) if self._getters else None
+            for target in (self._total, group) if group is not None else (self._total,):
+                self._add(target, lead, now)
+
+    @staticmethod
+    def _add(group: _Group, lead: dict, now: Optional[int]) -> None:
+        group.count += 1
+        status_id = lead.get("status_id")
+        if status_id == STATUS_WON:
+            group.won += 1
+        elif status_id == STATUS_LOST:
+            group.lost += 1
+        price = lead.get("price")
+        if price is not None:
+            group.price.add(price)
+        created_at = lead.get("created_at")
+        if not created_at:
+            return
+        closed_at = lead.get("closed_at")
+        if closed_at:
+            group.cycle.add(max(0, closed_at - created_at))
+        elif now:
+            group.age.add(max(0, now - created_at))
+
+    def _row(self, group: _Group) -> dict:
+        closed = group.won + group.lost
+        return {
+            "count": group.count,
+            "won": group.won,
+            "lost": group.lost,
+            "open": group.count - closed,
+            "win_rate": round(group.won / closed, 4) if closed else None,
+            "price": group.price.summary(self.percentiles),
+            "cycle_days": group.cycle.summary(self.percentiles, scale=DAY),
+            "age_days": group.age.summary(self.percentiles, scale=DAY),
+        }
+
+    def result(self) -> dict:
+        rows = [
+            {"group": dict(zip(self.group_by, key)), **self._row(group)}
+            for key, group in self._groups.items()
+        ]
+        rows.sort(key=lambda row: row["count"], reverse=True)
+        return {
+            "group_by": list(self.group_by),
+            "groups": rows if self.group_by else [],
+            "totals": self._row(self._total),
+            "pages": self.pages,
+            "ungrouped_leads": self.ungrouped,
+        }
@@ -0,0 +1,620 @@
+"""
+Локальное зеркало сделок, контактов и компаний AmoCRM (SQLite рядом с chat_storage).
+
+Заполняется полной постраничной синхронизацией, дальше поддерживается вебхуками
+leads/contacts/companies[add|update|status|responsible|restore|delete]: изменённые
+сущности перечитываются из AmoCRM пачкой по filter[id][], удалённые помечаются.
+Чтения обслуживаются локально; в каждом ответе — отметка свежести (_local).
+Пока тип не синхронизирован полностью, чтения идут в AmoCRM как раньше.
+"""
+
+import os
+import json
+import time
+import queue
+import asyncio
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import amocrm_client
+import chat_storage
+import rate_limiter
+from reference_cache import iter_webhook_fields
+
+logger = logging.getLogger(__name__)
+
+ENTITY_STORE_ENABLED = os.getenv("ENTITY_STORE_ENABLED", "false").lower() in ("1", "true", "yes")
+ENTITY_DB_PATH = os.getenv(
+    "ENTITY_DB_PATH", os.path.join(os.path.dirname(chat_storage.CHAT_DB_PATH) or ".", "amocrm_entities.db")
+)
+ENTITY_DB_READERS = int(os.getenv("ENTITY_DB_READERS", "2"))
+
+# Типы сущностей зеркала и связи, которые AmoCRM отдаёт в _embedded при with=...
+ENTITY_TYPES = ("leads", "contacts", "companies")
+ENTITY_WITH = {
+    "leads": "contacts,companies,loss_reason",
+    "contacts": "leads",
+    "companies": "leads,contacts",
+}
+# Связь хранится одной строкой: сторона a — тип с меньшим номером
+_TYPE_ORDER = {name: number for number, name in enumerate(ENTITY_TYPES)}
+
+# Действия вебхука, после которых сущность перечитывается; delete — помечается удалённой
+WEBHOOK_REFRESH_ACTIONS = {"add", "update", "status", "responsible", "restore"}
+WEBHOOK_DELETE_ACTIONS = {"delete"}
+
+MIGRATIONS = [
+    # 1: сущности, связи и состояние синхронизации
+    """
+    CREATE TABLE IF NOT EXISTS entities (
+        entity_type TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        name TEXT,
+        price INTEGER,
+        pipeline_id INTEGER,
+        status_id INTEGER,
+        responsible_user_id INTEGER,
+        created_at INTEGER,
+        updated_at INTEGER NOT NULL DEFAULT 0,
+        closed_at INTEGER,
+        search_text TEXT,
+        data TEXT,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        synced_at INTEGER NOT NULL,
+        PRIMARY KEY (entity_type, id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_entities_status ON entities(entity_type, pipeline_id, status_id);
+    CREATE INDEX IF NOT EXISTS idx_entities_updated ON entities(entity_type, updated_at);
+    CREATE INDEX IF NOT EXISTS idx_entities_created ON entities(entity_type, created_at);
+    CREATE TABLE IF NOT EXISTS entity_links (
+        a_type TEXT NOT NULL,
+        a_id INTEGER NOT NULL,
+        b_type TEXT NOT NULL,
+        b_id INTEGER NOT NULL,
+        PRIMARY KEY (a_type, a_id, b_type, b_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_entity_links_b ON entity_links(b_type, b_id, a_type, a_id);
+    CREATE TABLE IF NOT EXISTS entity_sync_state (
+        entity_type TEXT PRIMARY KEY,
+        full_sync_at INTEGER,
+        last_change_at INTEGER,
+        items INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    # 2: отметка updated_at для дельта-синхронизации (sync_engine)
+    """
+    ALTER TABLE entity_sync_state ADD COLUMN updated_watermark INTEGER;
+    ALTER TABLE entity_sync_state ADD COLUMN last_poll_at INTEGER;
+    """,
+    # 3: сделки зеркалировались без _embedded.companies — до новой полной синхронизации читаются из AmoCRM
+    """
+    UPDATE entity_sync_state SET full_sync_at = NULL WHERE entity_type = 'leads';
+    """,
+]
+
+_init_lock = threading.Lock()
+_writer_lock = threading.Lock()
+_writer_conn: sqlite3.Connection = None
+_readers: "queue.Queue[sqlite3.Connection]" = None
+_all_conns: list = []
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(ENTITY_DB_PATH, check_same_thread=False, cached_statements=128)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.executescript(f"BEGIN; {step}; PRAGMA user_version = {number}; COMMIT;")
+        except Exception:
+            conn.rollback()
+            raise
+
+
+@contextmanager
+def _migration_lock():
+    """Межпроцессная блокировка на время миграций (см. chat_storage._migration_lock)."""
+    lock = sqlite3.connect(ENTITY_DB_PATH + ".lock", timeout=600, isolation_level=None)
+    try:
+        lock.execute("BEGIN EXCLUSIVE")
+        yield
+    finally:
+        lock.close()
+
+
+def init_db() -> None:
+    """Создать схему и соединения (идемпотентно)."""
+    global _writer_conn, _readers
+    with _init_lock:
+        if _writer_conn is not None:
+            return
+        writer = _connect()
+        with _migration_lock():
+            _migrate(writer)
+        readers = queue.Queue()
+        conns = [writer]
+        for _ in range(max(1, ENTITY_DB_READERS)):
+            conn = _connect()
+            readers.put(conn)
+            conns.append(conn)
+        _all_conns[:] = conns
+        _readers = readers
+        _writer_conn = writer
+
+
+def close_db() -> None:
+    global _writer_conn, _readers
+    with _init_lock:
+        for conn in _all_conns:
+            conn.close()
+        _all_conns.clear()
+        _writer_conn = None
+        _readers = None
+
+
+@contextmanager
+def _reader():
+    if _writer_conn is None:
+        init_db()
+    conn = _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put(conn)
+
+
+@contextmanager
+def _writer():
+    if _writer_conn is None:
+        init_db()
+    with _writer_lock:
+        try:
+            yield _writer_conn
+            _writer_conn.commit()
+        except Exception:
+            _writer_conn.rollback()
+            raise
+
+
+# ---------- Запись ----------
+
+# Более старая версия (страница полной синхронизации, прочитанная до вебхука)
+# не перезаписывает более новую и не воскрешает удалённую сущность
+_UPSERT_SQL = """
+    INSERT INTO entities (
+        entity_type, id, name, price, pipeline_id, status_id, responsible_user_id,
+        created_at, updated_at, closed_at, search_text, data, deleted, synced_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)
+    ON CONFLICT(entity_type, id) DO UPDATE SET
+        name = excluded.name,
+        price = excluded.price,
+        pipeline_id = excluded.pipeline_id,
+        status_id = excluded.status_id,
+        responsible_user_id = excluded.responsible_user_id,
+        created_at = excluded.created_at,
+        updated_at = excluded.updated_at,
+        closed_at = excluded.closed_at,
+        search_text = excluded.search_text,
+        data = excluded.data,
+        deleted = 0,
+        synced_at = excluded.synced_at
+    WHERE excluded.updated_at >= entities.updated_at
+"""
+
+
+def _search_text(entity: dict) -> str:
+    """Имя и значения полей (телефоны, email) в нижнем регистре — для локального поиска."""
+    parts = [str(entity.get("name") or "")]
+    for field in entity.get("custom_fields_values") or ():
+        for item in field.get("values") or ():
+            if item.get("value") not in (None, ""):
+                parts.append(str(item["value"]))
+    return " ".join(parts).lower()
+
+
+def _link_row(type_1: str, id_1: int, type_2: str, id_2: int) -> Tuple[str, int, str, int]:
+    if _TYPE_ORDER[type_1] <= _TYPE_ORDER[type_2]:
+        return type_1, id_1, type_2, id_2
+    return type_2, id_2, type_1, id_1
+
+
+def _replace_links(conn: sqlite3.Connection, entity_type: str, entity_id: int, embedded: dict) -> None:
+    """Связи сущности с типами, пришедшими в _embedded, заменяются целиком."""
+    for other_type in ENTITY_TYPES:
+        if other_type == entity_type or not isinstance(embedded.get(other_type), list):
+            continue
+        a_type, _, b_type, _ = _link_row(entity_type, entity_id, other_type, 0)
+        if a_type == entity_type:
+            conn.execute(
+                "DELETE FROM entity_links WHERE a_type = ? AND a_id = ? AND b_type = ?",
+                (entity_type, entity_id, other_type),
+            )
+        else:
+            conn.execute(
+                "DELETE FROM entity_links WHERE b_type = ? AND b_id = ? AND a_type = ?",
+                (entity_type, entity_id, other_type),
+            )
+        conn.executemany(
+            "INSERT OR IGNORE INTO entity_links (a_type, a_id, b_type, b_id) VALUES (?, ?, ?, ?)",
+            [
+                _link_row(entity_type, entity_id, other_type, int(item["id"]))
+                for item in embedded[other_type]
+                if isinstance(item, dict) and item.get("id")
+            ],
+        )
+
+
+def upsert_entities(entity_type: str, items: List[dict], synced_at: Optional[int] = None) -> int:
+    """Сохранить сущности, как их вернул AmoCRM (с _embedded-связями). Возвращает число изменённых строк."""
+    synced_at = synced_at or int(time.time())
+    changed = 0
+    with _writer() as conn:
+        for entity in items:
+            cursor = conn.execute(_UPSERT_SQL, (
+                entity_type,
+                int(entity["id"]),
+                entity.get("name"),
+                entity.get("price"),
+                entity.get("pipeline_id"),
+                entity.get("status_id"),
+                entity.get("responsible_user_id"),
+                entity.get("created_at"),
+                entity.get("updated_at") or 0,
+                entity.get("closed_at"),
+                _search_text(entity),
+                json.dumps(entity, ensure_ascii=False, separators=(",", ":")),
+                synced_at,
+            ))
+            if cursor.rowcount:
+                changed += 1
+                _replace_links(conn, entity_type, int(entity["id"]), entity.get("_embedded") or {})
+    return changed
+
+
+def mark_deleted(entity_type: str, ids: Iterable[int], deleted_at: Optional[int] = None) -> int:
+    """
+    Пометить сущности удалёнными. updated_at поднимается до момента удаления,
+    чтобы ранее прочитанная страница синхронизации их не вернула.
+    """
+    deleted_at = deleted_at or int(time.time())
+    rows = [(entity_type, int(entity_id), deleted_at, deleted_at) for entity_id in ids]
+    with _writer() as conn:
+        conn.executemany(
+            """
+            INSERT INTO entities (entity_type, id, updated_at, deleted, synced_at) VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT(entity_type, id) DO UPDATE SET
+                deleted = 1,
+                updated_at = MAX(entities.updated_at, excluded.updated_at),
+                synced_at = excluded.synced_at
+            """,
+            rows,
+        )
+        conn.execute(
+            "DELETE FROM entity_links WHERE (a_type = ? AND a_id IN (SELECT value FROM json_each(?)))"
+            " OR (b_type = ? AND b_id IN (SELECT value FROM json_each(?)))",
+            (entity_type, json.dumps([row[1] for row in rows]), entity_type, json.dumps([row[1] for row in rows])),
+        )
+    return len(rows)
+
+
+def finish_full_sync(entity_type: str, started_at: int) -> int:
+    """
+    Полная синхронизация прошла: сущности, которых в ней не было и которые
+    не обновлялись после её начала, удалены в AmoCRM. Возвращает их число.
+    """
+    with _writer() as conn:
+        removed = conn.execute(
+            "UPDATE entities SET deleted = 1 WHERE entity_type = ? AND deleted = 0 AND synced_at < ?",
+            (entity_type, started_at),
+        ).rowcount
+        items = conn.execute(
+            "SELECT COUNT(*) FROM entities WHERE entity_type = ? AND deleted = 0", (entity_type,)
+        ).fetchone()[0]
+        conn.execute(
+            """
+            INSERT INTO entity_sync_state (entity_type, full_sync_at, items) VALUES (?, ?, ?)
+            ON CONFLICT(entity_type) DO UPDATE SET full_sync_at = excluded.full_sync_at, items = excluded.items
+            """,
+            (entity_type, started_at, items),
+        )
+    return removed
+
+
+def set_watermark(entity_type: str, watermark: int, polled_at: int) -> None:
+    """Сохранить отметку дельта-синхронизации: изменения до watermark уже применены."""
+    with _writer() as conn:
+        conn.execute(
+            """
+            INSERT INTO entity_sync_state (entity_type, updated_watermark, last_poll_at) VALUES (?, ?, ?)
+            ON CONFLICT(entity_type) DO UPDATE SET
+                updated_watermark = excluded.updated_watermark,
+                last_poll_at = excluded.last_poll_at
+            """,
+            (entity_type, watermark, polled_at),
+        )
+
+
+def record_change(entity_type: str, changed_at: Optional[int] = None) -> None:
+    """Отметить применённое изменение из вебхука (для отметки свежести)."""
+    with _writer() as conn:
+        conn.execute(
+            """
+            INSERT INTO entity_sync_state (entity_type, last_change_at) VALUES (?, ?)
+            ON CONFLICT(entity_type) DO UPDATE SET last_change_at = excluded.last_change_at
+            """,
+            (entity_type, changed_at or int(time.time())),
+        )
+
+
+# ---------- Чтение ----------
+
+def sync_state() -> Dict[str, dict]:
+    with _reader() as conn:
+        rows = conn.execute("SELECT * FROM entity_sync_state").fetchall()
+    return {row["entity_type"]: dict(row) for row in rows}
+
+
+def freshness(entity_type: str) -> Optional[dict]:
+    """
+    Отметка свежести для ответа: когда началась последняя полная синхронизация,
+    когда применено последнее изменение из вебхука и когда прошёл последний
+    дельта-опрос. None — тип ещё не синхронизирован.
+    """
+    with _reader() as conn:
+        row = conn.execute(
+            "SELECT full_sync_at, last_change_at, last_poll_at FROM entity_sync_state WHERE entity_type = ?",
+            (entity_type,),
+        ).fetchone()
+    if row is None or row["full_sync_at"] is None:
+        return None
+    as_of = max(row["full_sync_at"], row["last_change_at"] or 0, row["last_poll_at"] or 0)
+    return {
+        "source": "local",
+        "full_sync_at": row["full_sync_at"],
+        "last_change_at": row["last_change_at"],
+        "last_poll_at": row["last_poll_at"],
+        "as_of": as_of,
+        "age_seconds": max(0, int(time.time()) - as_of),
+    }
+
+
+def get_entity(entity_type: str, entity_id: int) -> Optional[dict]:
+    with _reader() as conn:
+        row = conn.execute(
+            "SELECT data FROM entities WHERE entity_type = ? AND id = ? AND deleted = 0",
+            (entity_type, int(entity_id)),
+        ).fetchone()
+    if row is None:
+        return None
+    return json.loads(row["data"])
+
+
+def _filter_sql(filters: Dict[str, Any]) -> Tuple[str, list]:
+    where = ["entity_type = ?", "deleted = 0"]
+    args: list = [filters["entity_type"]]
+    if filters.get("query"):
+        where.append("instr(search_text, ?) > 0")
+        args.append(str(filters["query"]).lower())
+    for field, column, op in (
+        ("created_at_from", "created_at", ">="),
+        ("updated_at_from", "updated_at", ">="),
+        ("pipeline_id", "pipeline_id", "="),
+        ("status_id", "status_id", "="),
+    ):
+        if filters.get(field):
+            where.append(f"{column} {op} ?")
+            args.append(int(filters[field]))
+    return " AND ".join(where), args
+
+
+def list_entities(entity_type: str, limit: int = 50, page: int = 1, **filters) -> List[dict]:
+    """
+    Страница сущностей в порядке id (как у AmoCRM по умолчанию).
+    Фильтры: query (подстрока имени, телефона, email), created_at_from,
+    updated_at_from, pipeline_id, status_id.
+    """
+    where, args = _filter_sql({**filters, "entity_type": entity_type})
+    with _reader() as conn:
+        rows = conn.execute(
+            f"SELECT data FROM entities WHERE {where} ORDER BY id LIMIT ? OFFSET ?",
+            (*args, limit, max(0, page - 1) * limit),
+        ).fetchall()
+    return [json.loads(row["data"]) for row in rows]
+
+
+def entities_after(entity_type: str, after_id: int, limit: int, **filters) -> List[dict]:
+    """Keyset-страница для полного обхода (отчёты): сущности с id > after_id."""
+    where, args = _filter_sql({**filters, "entity_type": entity_type})
+    with _reader() as conn:
+        rows = conn.execute(
+            f"SELECT data FROM entities WHERE {where} AND id > ? ORDER BY id LIMIT ?",
+            (*args, int(after_id), limit),
+        ).fetchall()
+    return [json.loads(row["data"]) for row in rows]
+
+
+def linked_ids(entity_type: str, entity_id: int, other_type: str) -> List[int]:
+    """ID связанных сущностей other_type."""
+    a_type, a_id, b_type, b_id = _link_row(entity_type, int(entity_id), other_type, 0)
+    with _reader() as conn:
+        if a_type == entity_type:
+            rows = conn.execute(
+                "SELECT b_id FROM entity_links WHERE a_type = ? AND a_id = ? AND b_type = ?",
+                (entity_type, int(entity_id), other_type),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT a_id FROM entity_links WHERE b_type = ? AND b_id = ? AND a_type = ?",
+                (entity_type, int(entity_id), other_type),
+            ).fetchall()
+    return [row[0] for row in rows]
+
+
+def counts() -> Dict[str, int]:
+    with _reader() as conn:
+        rows = conn.execute(
+            "SELECT entity_type, COUNT(*) FROM entities WHERE deleted = 0 GROUP BY entity_type"
+        ).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+# ---------- Синхронизация ----------
+
+class EntityMirror:
+    """Полная синхронизация и применение вебхуков (расписание — в sync_engine)."""
+
+    def __init__(self):
+        self._sync_lock = asyncio.Lock()
+        self.syncing: Optional[str] = None
+        self.last_sync: Dict[str, dict] = {}
+        self.webhook_refreshed = 0
+        self.webhook_deleted = 0
+        self.refetch_requests = 0
+        self.errors = 0
+
+    async def start(self) -> None:
+        await chat_storage.run_in_db(init_db)
+        logger.info(f"Entity store: {ENTITY_DB_PATH}")
+
+    async def close(self) -> None:
+        close_db()
+
+    async def full_sync(self, entity_type: str) -> dict:
+        """Постраничная выгрузка всех сущностей типа; по одной транзакции на страницу."""
+        async with self._sync_lock:
+            self.syncing = entity_type
+            started_at = int(time.time())
+            started = time.monotonic()
+            items = 0
+            try:
+                async for page in amocrm_client.iter_pages(
+                    f"/api/v4/{entity_type}", entity_type, {"with": ENTITY_WITH[entity_type]}
+                ):
+                    await chat_storage.run_in_db(upsert_entities, entity_type, page, int(time.time()))
+                    items += len(page)
+                removed = await chat_storage.run_in_db(finish_full_sync, entity_type, started_at)
+            finally:
+                self.syncing = None
+            result = {
+                "entity_type": entity_type,
+                "items": items,
+                "removed": removed,
+                "started_at": started_at,
+                "seconds": round(time.monotonic() - started, 2),
+            }
+            self.last_sync[entity_type] = result
+            logger.info(f"Entity store: {entity_type} синхронизированы: {items} шт. за {result['seconds']}s, удалено {removed}")
+            return result
+
+    async def delta_sync(self, entity_type: str, since: int, concurrency: Optional[int] = None) -> dict:
+        """
+        Изменённые с since (filter[updated_at][from], включительно) сущности типа —
+        постранично, не больше concurrency страниц в полёте. Возвращает число сущностей.
+        """
+        async with self._sync_lock:
+            items = 0
+            async for page in amocrm_client.iter_pages(
+                f"/api/v4/{entity_type}",
+                entity_type,
+                {"filter[updated_at][from]": since, "with": ENTITY_WITH[entity_type]},
+                concurrency=concurrency,
+            ):
+                await chat_storage.run_in_db(upsert_entities, entity_type, page, int(time.time()))
+                items += len(page)
+            return {"items": items}
+
+    async def apply_webhooks(self, payloads: List[Any]) -> Dict[str, dict]:
+        """
+        Применить пачку вебхуков: удалённые пометить, остальные изменённые
+        перечитать из AmoCRM — по одному запросу filter[id][] на тип и 250 ID.
+        """
+        changes = webhook_changes(payloads)
+        for entity_type, (refresh, delete) in changes.items():
+            if delete:
+                await chat_storage.run_in_db(mark_deleted, entity_type, delete)
+                self.webhook_deleted += len(delete)
+            if refresh:
+                await self._refetch(entity_type, sorted(refresh))
+            await chat_storage.run_in_db(record_change, entity_type)
+        return {t: {"refreshed": len(r), "deleted": len(d)} for t, (r, d) in changes.items()}
+
+    async def _refetch(self, entity_type: str, ids: List[int]) -> None:
+        limit = amocrm_client.AMO_PAGE_LIMIT
+        for start in range(0, len(ids), limit):
+            chunk = ids[start:start + limit]
+            self.refetch_requests += 1
+            with rate_limiter.priority(rate_limiter.PRIORITY_INTERACTIVE):
+                result = await amocrm_client.make_amocrm_request(
+                    f"/api/v4/{entity_type}",
+                    "GET",
+                    params={"filter[id][]": chunk, "with": ENTITY_WITH[entity_type], "limit": limit},
+                )
+            if isinstance(result, dict) and result.get("code") == 204:
+                items = []
+            else:
+                items = (result.get("_embedded") or {}).get(entity_type) if isinstance(result, dict) else None
+            if items is None:
+                self.errors += 1
+                logger.error(f"Entity store: некорректный ответ при обновлении {entity_type}: {str(result)[:300]}")
+                continue
+            await chat_storage.run_in_db(upsert_entities, entity_type, items)
+            self.webhook_refreshed += len(items)
+            # Не вернулись — удалены (или недоступны токену)
+            missing = set(chunk) - {int(item["id"]) for item in items}
+            if missing:
+                await chat_storage.run_in_db(mark_deleted, entity_type, missing)
+                self.webhook_deleted += len(missing)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": ENTITY_STORE_ENABLED,
+            "syncing": self.syncing,
+            "last_sync": self.last_sync,
+            "webhook_refreshed": self.webhook_refreshed,
+            "webhook_deleted": self.webhook_deleted,
+            "refetch_requests": self.refetch_requests,
+            "errors": self.errors,
+        }
+
+
+def webhook_changes(payloads: Iterable[Any]) -> Dict[str, Tuple[Set[int], Set[int]]]:
+    """
+    ID сущностей из вебхуков (JSON или form вида leads[update][0][id]=123):
+    {тип: (перечитать, удалить)}. Удаление в той же пачке перекрывает изменение.
+    """
+    changes: Dict[str, Tuple[Set[int], Set[int]]] = {}
+    for payload in payloads:
+        for path, value in iter_webhook_fields(payload):
+            if len(path) != 4 or path[0] not in _TYPE_ORDER or path[3] != "id":
+                continue
+            action = path[1]
+            if action not in WEBHOOK_REFRESH_ACTIONS and action not in WEBHOOK_DELETE_ACTIONS:
+                continue
+            try:
+                entity_id = int(value)
+            except (TypeError, ValueError):
+                continue
+            refresh, delete = changes.setdefault(path[0], (set(), set()))
+            (delete if action in WEBHOOK_DELETE_ACTIONS else refresh).add(entity_id)
+    for refresh, delete in changes.values():
+        refresh -= delete
+    return changes
+
+
+mirror = EntityMirror()
+
+
+async def local_ready(entity_type: str) -> Optional[dict]:
+    """Отметка свежести, если тип можно читать локально; иначе None (читать из AmoCRM)."""
+    if not ENTITY_STORE_ENABLED or entity_type not in _TYPE_ORDER:
+        return None
+    return await chat_storage.run_in_db(freshness, entity_type)
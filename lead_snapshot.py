@@ -0,0 +1,364 @@
+"""
+Колоночный снимок сделок в памяти для повторяющихся аналитических запросов.
+Одна массовая выгрузка раскладывает сделки по типизированным колонкам
+(array: int64 для id, бюджета и дат, int32 для справочных ID и месяцев);
+фильтры и группировки затем считаются по колонкам без обращений к AmoCRM.
+Если установлен NumPy, колонки оборачиваются в ndarray без копирования
+и запросы выполняются векторно; без него — тем же кодом на списках индексов.
+Снимок живёт LEAD_SNAPSHOT_TTL секунд, обновляется по запросу или при устаревании.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from array import array
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from chat_storage import MSK
+from deal_analytics import DAY, STATUS_LOST, STATUS_WON, summarize
+
+try:
+    import numpy as np
+except ImportError:  # необязательная зависимость
+    np = None
+
+logger = logging.getLogger(__name__)
+
+LEAD_SNAPSHOT_TTL = float(os.getenv("LEAD_SNAPSHOT_TTL", "900"))  # сек. жизни снимка
+LEAD_SNAPSHOT_NUMPY = os.getenv("LEAD_SNAPSHOT_NUMPY", "true").lower() in ("1", "true", "yes")
+
+# Колонка → typecode array; отсутствующее значение хранится как 0
+COLUMNS = {
+    "id": "q",
+    "price": "q",
+    "created_at": "q",
+    "updated_at": "q",
+    "closed_at": "q",
+    "status_id": "i",
+    "pipeline_id": "i",
+    "responsible_user_id": "i",
+    "loss_reason_id": "i",
+    "created_month": "i",  # YYYYMM по МСК
+    "closed_month": "i",
+}
+
+GROUP_FIELDS = ("pipeline_id", "status_id", "responsible_user_id", "loss_reason_id", "created_month", "closed_month")
+
+# Фильтр → (колонка, сравнение)
+FILTERS = {
+    "pipeline_id": ("pipeline_id", "eq"),
+    "status_id": ("status_id", "eq"),
+    "responsible_user_id": ("responsible_user_id", "eq"),
+    "loss_reason_id": ("loss_reason_id", "eq"),
+    "created_at_from": ("created_at", "ge"),
+    "created_at_to": ("created_at", "le"),
+    "updated_at_from": ("updated_at", "ge"),
+    "updated_at_to": ("updated_at", "le"),
+    "closed_at_from": ("closed_at", "ge"),
+    "closed_at_to": ("closed_at", "le"),
+}
+
+
+def _month_key(ts: Optional[int]) -> int:
+    if not ts:
+        return 0
+    moment = datetime.fromtimestamp(ts, MSK)
+    return moment.year * 100 + moment.month
+
+
+def _group_value(field: str, value: int) -> Any:
+    """Значение ключа группы для ответа: 0 — нет значения, месяцы — 'YYYY-MM'."""
+    value = int(value)
+    if not value:
+        return None
+    if field.endswith("_month"):
+        return f"{value // 100:04d}-{value % 100:02d}"
+    return value
+
+
+class LeadSnapshot:
+    """Неизменяемый после build колоночный снимок сделок."""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.columns: Dict[str, array] = {name: array(code) for name, code in COLUMNS.items()}
+        self.built_at: Optional[float] = None
+        self.build_seconds = 0.0
+        self._np: Optional[Dict[str, Any]] = None
+
+    def append_page(self, leads: List[dict]) -> None:
+        columns = self.columns
+        for lead in leads:
+            created_at = lead.get("created_at") or 0
+            closed_at = lead.get("closed_at") or 0
+            columns["id"].append(int(lead["id"]))
+            columns["price"].append(int(lead.get("price") or 0))
+            columns["created_at"].append(created_at)
+            columns["updated_at"].append(lead.get("updated_at") or 0)
+            columns["closed_at"].append(closed_at)
+            columns["status_id"].append(lead.get("status_id") or 0)
+            columns["pipeline_id"].append(lead.get("pipeline_id") or 0)
+            columns["responsible_user_id"].append(lead.get("responsible_user_id") or 0)
+            columns["loss_reason_id"].append(lead.get("loss_reason_id") or 0)
+            columns["created_month"].append(_month_key(created_at))
+            columns["closed_month"].append(_month_key(closed_at))
+
+    def finish(self, started: float) -> None:
+        self.built_at = time.time()
+        self.build_seconds = time.monotonic() - started
+        if np is not None and LEAD_SNAPSHOT_NUMPY:
+            # Представления над буферами array, без копирования; массивы больше не меняются
+            self._np = {name: np.frombuffer(col, dtype=np.dtype(col.typecode)) for name, col in self.columns.items()}
+
+    def __len__(self) -> int:
+        return len(self.columns["id"])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(col.itemsize * len(col) for col in self.columns.values())
+
+    def age(self) -> float:
+        return time.time() - self.built_at if self.built_at else float("inf")
+
+    def info(self) -> dict:
+        return {
+            "rows": len(self),
+            "bytes": self.nbytes,
+            "source": self.source,
+            "built_at": int(self.built_at) if self.built_at else None,
+            "age_seconds": round(self.age(), 1) if self.built_at else None,
+            "build_seconds": round(self.build_seconds, 3),
+            "engine": "numpy" if self._np is not None else "array",
+        }
+
+    # ---------- Запросы ----------
+
+    def query(
+        self,
+        filters: Dict[str, Any],
+        group_by: Sequence[str] = (),
+        percentiles: Sequence[float] = (50, 90),
+        now: Optional[int] = None,
+    ) -> dict:
+        """Фильтры FILTERS, группировка по GROUP_FIELDS; строки в формате deal_analytics."""
+        now = now or int(time.time())
+        conditions = [(FILTERS[name], int(value)) for name, value in filters.items() if value is not None]
+        if self._np is not None:
+            groups = self._groups_numpy(conditions, group_by)
+            metrics = self._metrics_numpy
+        else:
+            groups = self._groups_python(conditions, group_by)
+            metrics = self._metrics_python
+
+        rows = []
+        selected = []
+        for key, rows_index in groups:
+            selected.append(rows_index)
+            if group_by:
+                rows.append({
+                    "group": {field: _group_value(field, value) for field, value in zip(group_by, key)},
+                    **metrics(rows_index, percentiles, now),
+                })
+        rows.sort(key=lambda row: row["count"], reverse=True)
+        if self._np is not None:
+            everything = np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+        else:
+            everything = [i for rows_index in selected for i in rows_index]
+        return {
+            "group_by": list(group_by),
+            "groups": rows,
+            "totals": metrics(everything, percentiles, now),
+        }
+
+    def _groups_numpy(self, conditions, group_by) -> List[Tuple[tuple, Any]]:
+        cols = self._np
+        mask = np.ones(len(self), dtype=bool)
+        for (column, op), value in conditions:
+            if op == "eq":
+                mask &= cols[column] == value
+            elif op == "ge":
+                mask &= cols[column] >= value
+            else:
+                mask &= cols[column] <= value
+        index = np.flatnonzero(mask)
+        if not group_by:
+            return [((), index)]
+        if not len(index):
+            return []
+        # Составной ключ — одно int64: коды значений колонок, уплотняемые после каждой
+        codes = np.zeros(len(index), dtype=np.int64)
+        for field in group_by:
+            values, inverse = np.unique(cols[field][index], return_inverse=True)
+            codes = codes * len(values) + inverse.reshape(-1)
+            codes = np.unique(codes, return_inverse=True)[1].reshape(-1)
+        _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        parts = np.split(index[order], np.cumsum(np.bincount(inverse))[:-1])
+        first_rows = index[first]
+        keys = zip(*(cols[field][first_rows].tolist() for field in group_by))
+        return list(zip(keys, parts))
+
+    def _groups_python(self, conditions, group_by) -> List[Tuple[tuple, list]]:
+        cols = self.columns
+        index = range(len(self))
+        for (column, op), value in conditions:
+            col = cols[column]
+            if op == "eq":
+                index = [i for i in index if col[i] == value]
+            elif op == "ge":
+                index = [i for i in index if col[i] >= value]
+            else:
+                index = [i for i in index if col[i] <= value]
+        index = list(index)
+        if not group_by:
+            return [((), index)]
+        key_cols = [cols[field] for field in group_by]
+        groups: Dict[tuple, list] = {}
+        for i in index:
+            groups.setdefault(tuple(col[i] for col in key_cols), []).append(i)
+        return list(groups.items())
+
+    @staticmethod
+    def _row(count: int, won: int, lost: int, price: dict, cycle: dict, age: dict) -> dict:
+        closed = won + lost
+        return {
+            "count": count,
+            "won": won,
+            "lost": lost,
+            "open": count - closed,
+            "win_rate": round(won / closed, 4) if closed else None,
+            "price": price,
+            "cycle_days": cycle,
+            "age_days": age,
+        }
+
+    def _metrics_numpy(self, index, percentiles, now) -> dict:
+        cols = self._np
+        status = cols["status_id"][index]
+        price = np.sort(cols["price"][index])
+        created = cols["created_at"][index]
+        closed = cols["closed_at"][index]
+        has_created = created > 0
+        cycle = np.sort(np.maximum(0, (closed - created)[has_created & (closed > 0)]))
+        age = np.sort(np.maximum(0, (now - created)[has_created & (closed == 0)]))
+        return self._row(
+            int(len(index)),
+            int(np.count_nonzero(status == STATUS_WON)),
+            int(np.count_nonzero(status == STATUS_LOST)),
+            summarize(price, float(price.sum()), percentiles),
+            summarize(cycle, float(cycle.sum()), percentiles, scale=DAY),
+            summarize(age, float(age.sum()), percentiles, scale=DAY),
+        )
+
+    def _metrics_python(self, index, percentiles, now) -> dict:
+        cols = self.columns
+        status, price_col = cols["status_id"], cols["price"]
+        created_col, closed_col = cols["created_at"], cols["closed_at"]
+        price = sorted(price_col[i] for i in index)
+        cycle, age = [], []
+        for i in index:
+            created = created_col[i]
+            if not created:
+                continue
+            closed = closed_col[i]
+            if closed:
+                cycle.append(max(0, closed - created))
+            else:
+                age.append(max(0, now - created))
+        cycle.sort()
+        age.sort()
+        return self._row(
+            len(index),
+            sum(1 for i in index if status[i] == STATUS_WON),
+            sum(1 for i in index if status[i] == STATUS_LOST),
+            summarize(price, sum(price), percentiles),
+            summarize(cycle, sum(cycle), percentiles, scale=DAY),
+            summarize(age, sum(age), percentiles, scale=DAY),
+        )
+
+
+PageLoader = Callable[[], Awaitable[Tuple[AsyncIterator[List[dict]], str]]]
+
+
+class SnapshotManager:
+    """
+    Текущий снимок и его обновление. loader() возвращает (страницы сделок, источник).
+    Пока снимок строится, запросы ждут его (одна выгрузка на всех), старый
+    снимок заменяется только целиком готовым новым.
+    """
+
+    def __init__(self, loader: PageLoader, ttl: float = LEAD_SNAPSHOT_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self._snapshot: Optional[LeadSnapshot] = None
+        self._lock = asyncio.Lock()
+        self.builds = 0
+        self.hits = 0
+        self.queries = 0
+
+    async def get(self, max_age: Optional[float] = None, refresh: bool = False) -> LeadSnapshot:
+        """Снимок не старше max_age (по умолчанию ttl); refresh — построить заново."""
+        max_age = self.ttl if max_age is None else max_age
+        requested = time.time()
+        snapshot = self._snapshot
+        if not refresh and snapshot is not None and snapshot.age() <= max_age:
+            self.hits += 1
+            return snapshot
+        async with self._lock:
+            snapshot = self._snapshot
+            # Пока ждали блокировку, снимок мог построить другой запрос
+            if snapshot is not None and (
+                (refresh and snapshot.built_at >= requested) or (not refresh and snapshot.age() <= max_age)
+            ):
+                self.hits += 1
+                return snapshot
+            return await self._build()
+
+    async def _build(self) -> LeadSnapshot:
+        started = time.monotonic()
+        pages, source = await self.loader()
+        snapshot = LeadSnapshot(source)
+        async for leads in pages:
+            snapshot.append_page(leads)
+        snapshot.finish(started)
+        self._snapshot = snapshot
+        self.builds += 1
+        logger.info(
+            f"Lead snapshot: {len(snapshot)} сделок ({snapshot.nbytes} байт) из {source} за {snapshot.build_seconds:.2f}s"
+        )
+        return snapshot
+
+    async def query(
+        self,
+        filters: Dict[str, Any],
+        group_by: Sequence[str] = (),
+        percentiles: Sequence[float] = (50, 90),
+        max_age: Optional[float] = None,
+        refresh: bool = False,
+    ) -> dict:
+        snapshot = await self.get(max_age, refresh)
+        started = time.perf_counter()
+        # Готовый снимок только читается: проход по столбцам — в потоке, не в event loop
+        result = await asyncio.to_thread(snapshot.query, filters, group_by, percentiles)
+        self.queries += 1
+        result["query_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        result["snapshot"] = snapshot.info()
+        return result
+
+    def drop(self) -> bool:
+        dropped = self._snapshot is not None
+        self._snapshot = None
+        return dropped
+
+    def stats(self) -> dict:
+        return {
+            "ttl": self.ttl,
+            "snapshot": self._snapshot.info() if self._snapshot is not None else None,
+            "builds": self.builds,
+            "hits": self.hits,
+            "queries": self.queries,
+            "numpy": np is not None and LEAD_SNAPSHOT_NUMPY,
+        }
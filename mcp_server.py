@@ -19,9 +19,39 @@ import mcp.server.stdio
 # Берём из переменной окружения AMOCRM_SERVER_URL, иначе localhost
 AMOCRM_SERVER_URL = os.getenv("AMOCRM_SERVER_URL", "http://127.0.0.1:8000")
 
+# Позволяем отключить проверку SSL (например, при нестабильных сертификатах)
+VERIFY_SSL = os.getenv("AMO_SSL_VERIFY", "true").lower() not in {"0", "false", "no"}
+
+# Пул соединений к HTTP-бэкенду: одна сессия на всё время жизни stdio-сервера
+BRIDGE_HTTP_LIMIT = int(os.getenv("BRIDGE_HTTP_LIMIT", "20"))
+BRIDGE_HTTP_TIMEOUT = float(os.getenv("BRIDGE_HTTP_TIMEOUT", "300"))
+
 # Создаем MCP сервер
 server = Server("amocrm-mcp-server")
 
+_session: aiohttp.ClientSession = None
+
+def get_session() -> aiohttp.ClientSession:
+    """Долгоживущая сессия с keep-alive к бэкенду (создаётся при первом вызове)"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            ssl=None if VERIFY_SSL else False,
+            limit=BRIDGE_HTTP_LIMIT,
+            keepalive_timeout=60,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=BRIDGE_HTTP_TIMEOUT),
+        )
+    return _session
+
+async def close_session() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
 def _to_unix(ts_value) -> int:
     """Преобразует ISO-дату/строку/число в Unix timestamp (секунды).
     Допускает значения вида '2025-09-15', '2025-09-15T12:00:00', int/str unix.
@@ -53,17 +83,32 @@ def _to_unix(ts_value) -> int:
 async def make_request(method: str, endpoint: str, data: Dict[str, Any] = None, params: Dict[str, Any] = None) -> Dict[str, Any]:
     """Выполняет HTTP запрос к AmoCRM серверу"""
     url = f"{AMOCRM_SERVER_URL}{endpoint}"
-    
-    # Позволяем отключить проверку SSL (например, при нестабильных сертификатах)
-    verify_ssl = os.getenv("AMO_SSL_VERIFY", "true").lower() not in {"0", "false", "no"}
-    connector = aiohttp.TCPConnector(ssl=False) if not verify_ssl else None
-    async with aiohttp.ClientSession(connector=connector) as session:
-        if method.upper() == "GET":
-            async with session.get(url, params=params) as response:
-                return await response.json()
-        elif method.upper() == "POST":
-            async with session.post(url, json=data) as response:
-                return await response.json()
+    method = method.upper()
+    body = data if method in {"POST", "PATCH"} else None
+    async with get_session().request(method, url, params=params, json=body) as response:
+        return await response.json()
+
+async def make_requests(calls: List[Dict[str, Any]]) -> List[Any]:
+    """
+    Пакет запросов к бэкенду: все уходят одновременно по общему пулу
+    keep-alive соединений, результаты возвращаются в порядке запросов.
+    Ошибка одного запроса не прерывает остальные.
+    """
+    async def one(call: Dict[str, Any]) -> Any:
+        try:
+            if not isinstance(call, dict):
+                return {"error": "call must be an object"}
+            method = str(call.get("method", "GET")).upper()
+            path = call.get("path")
+            if not isinstance(path, str) or not path.startswith("/"):
+                return {"error": "'path' must start with '/'"}
+            if method in {"GET", "DELETE"}:
+                return await make_request(method, path, params=call.get("params"))
+            return await make_request(method, path, call.get("body"))
+        except Exception as e:
+            return {"error": str(e)}
+
+    return await asyncio.gather(*(one(call) for call in calls))
 
 @server.list_resources()
 async def handle_list_resources() -> List[types.Resource]:
@@ -210,6 +255,29 @@ async def handle_list_tools() -> List[types.Tool]:
                 "required": ["name"],
             },
         ),
+        types.Tool(
+            name="batch_request",
+            description="Несколько запросов к бэкенду одним пакетом: выполняются одновременно, результаты в том же порядке.",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "requests": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "method": {"type": "string", "enum": ["GET","POST","PATCH","DELETE"]},
+                                "path": {"type": "string", "description": "Путь, например: /api/entities"},
+                                "params": {"type": "object"},
+                                "body": {"type": "object"}
+                            },
+                            "required": ["method", "path"]
+                        }
+                    }
+                },
+                "required": ["requests"],
+            },
+        ),
     ]
 
 @server.call_tool()
@@ -346,24 +414,36 @@ async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[types.T
             types.TextContent(type="text", text=json.dumps(result, ensure_ascii=False, indent=2))
         ]
     
+    elif name == "batch_request":
+        calls = arguments.get("requests") or []
+        if not isinstance(calls, list):
+            raise ValueError("'requests' must be an array")
+        results = await make_requests(calls)
+        return [
+            types.TextContent(type="text", text=json.dumps(results, ensure_ascii=False, indent=2))
+        ]
+    
     else:
         raise ValueError(f"Unknown tool: {name}")
 
 async def main():
     # Запуск MCP сервера через stdio
-    async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="amocrm-mcp-server",
-                server_version="1.0.0",
-                capabilities=server.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={},
+    try:
+        async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="amocrm-mcp-server",
+                    server_version="1.0.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={},
+                    ),
                 ),
-            ),
-        )
+            )
+    finally:
+        await close_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,194 @@
+"""
+Транспорт MCP поверх SSE: сериализация JSON-RPC сообщений и очередь сессии.
+Результат инструмента сериализуется один раз (компактно, без отступов),
+а очередь сессии ограничена суммарным размером ещё не отправленных сообщений.
+Keep-alive всех простаивающих сессий обслуживает одно общее «колесо таймеров».
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+MCP_SESSION_QUEUE_BYTES = int(os.getenv("MCP_SESSION_QUEUE_BYTES", str(8 * 1024 * 1024)))  # на сессию
+MCP_SESSION_PUT_TIMEOUT = float(os.getenv("MCP_SESSION_PUT_TIMEOUT", "30"))  # сек. ожидания места в очереди
+MCP_KEEPALIVE_INTERVAL = float(os.getenv("MCP_KEEPALIVE_INTERVAL", "30"))  # сек. тишины до keep-alive
+MCP_KEEPALIVE_SLOTS = int(os.getenv("MCP_KEEPALIVE_SLOTS", "30"))  # делений колеса на интервал
+
+# Маркер из SessionQueue.get(): пора отправить keep-alive
+KEEPALIVE = object()
+
+
+def dumps(obj: Any) -> str:
+    """Компактный JSON: без пробелов и отступов, кириллица как есть."""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def serialize_tool_result(msg_id: Any, result: Any) -> str:
+    """
+    JSON-RPC ответ на tools/call одной строкой: результат сериализуется один раз
+    и целиком ложится в единственный text-блок. Ответ доставляется одним
+    сообщением, по частям он не передаётся.
+    """
+    text = dumps(result)
+    return '{"jsonrpc":"2.0","id":' + dumps(msg_id) + ',"result":{"content":[{"type":"text","text":' + dumps(text) + "}]}}"
+
+
+def progress_notification(token: Any, progress: float, total: Optional[float] = None, message: str = "") -> str:
+    params = {"progressToken": token, "progress": progress}
+    if total is not None:
+        params["total"] = total
+    if message:
+        params["message"] = message
+    return dumps({"jsonrpc": "2.0", "method": "notifications/progress", "params": params})
+
+
+class SessionQueue:
+    """
+    Очередь готовых SSE-сообщений сессии, ограниченная по байтам.
+    Медленный клиент не копит в памяти сервера больше max_bytes: отправитель
+    ждёт места до timeout, после чего сообщение отбрасывается (ответ всё равно
+    уходит в теле HTTP). Сообщение крупнее лимита принимается в пустую очередь.
+    get() возвращает сообщение, KEEPALIVE (запрошен колесом) или None — сессия закрыта.
+    """
+
+    def __init__(self, max_bytes: int = MCP_SESSION_QUEUE_BYTES, timeout: float = MCP_SESSION_PUT_TIMEOUT):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._items: Deque[Tuple[str, int]] = deque()
+        self._bytes = 0
+        self._changed = asyncio.Condition()
+        self._closed = False
+        self._keepalive_due = False
+        self.last_activity = time.monotonic()
+        self.wheel_slot = 0
+        # Метрики
+        self.sent = 0
+        self.dropped = 0
+        self.max_queued_bytes = 0
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._bytes
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _fits(self, size: int) -> bool:
+        return self._closed or not self._items or self._bytes + size <= self.max_bytes
+
+    async def put(self, message: str) -> bool:
+        """Положить сериализованное сообщение. False — места не дождались, сообщение отброшено."""
+        size = len(message) if message.isascii() else len(message.encode("utf-8"))
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait_for(lambda: self._fits(size)), self.timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                logger.warning(f"MCP session queue: нет места ({self._bytes} байт в очереди), сообщение {size} байт отброшено")
+                return False
+            if self._closed:
+                self.dropped += 1
+                return False
+            self._items.append((message, size))
+            self._bytes += size
+            self.max_queued_bytes = max(self.max_queued_bytes, self._bytes)
+            self._changed.notify_all()
+        return True
+
+    async def get(self) -> Any:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._closed or self._keepalive_due or bool(self._items))
+            if self._closed:
+                return None
+            self.last_activity = time.monotonic()
+            if not self._items:
+                self._keepalive_due = False
+                return KEEPALIVE
+            message, size = self._items.popleft()
+            self._bytes -= size
+            self.sent += 1
+            self._changed.notify_all()
+            return message
+
+    async def request_keepalive(self) -> None:
+        async with self._changed:
+            self._keepalive_due = True
+            self._changed.notify_all()
+
+    async def close(self) -> None:
+        """Клиент отключился: разбудить читателя и ожидающих отправителей."""
+        async with self._changed:
+            self._closed = True
+            self._items.clear()
+            self._bytes = 0
+            self._changed.notify_all()
+
+
+class KeepAliveWheel:
+    """
+    Общий таймер keep-alive для всех SSE-сессий. Сессии разложены по slots
+    делениям колеса; одна задача раз в interval/slots обходит очередное деление
+    и будит только те сессии, которые молчат дольше interval. Вместо таймера
+    на каждую сессию — один на процесс.
+    """
+
+    def __init__(self, interval: float = MCP_KEEPALIVE_INTERVAL, slots: int = MCP_KEEPALIVE_SLOTS):
+        self.interval = interval
+        self._slots: List[Set[SessionQueue]] = [set() for _ in range(max(1, slots))]
+        self._cursor = 0
+        self._next = 0
+        self._task: Optional[asyncio.Task] = None
+        self.ticks = 0
+        self.keepalives = 0
+
+    def add(self, queue: SessionQueue) -> None:
+        # По кругу, чтобы keep-alive'ы разных сессий не приходились на один тик
+        queue.wheel_slot = self._next % len(self._slots)
+        self._next += 1
+        self._slots[queue.wheel_slot].add(queue)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._run(), name="mcp-keepalive-wheel")
+
+    def discard(self, queue: SessionQueue) -> None:
+        self._slots[queue.wheel_slot].discard(queue)
+
+    async def _run(self) -> None:
+        tick = self.interval / len(self._slots)
+        while any(self._slots):
+            await asyncio.sleep(tick)
+            self.ticks += 1
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            deadline = time.monotonic() - self.interval + tick
+            for queue in list(self._slots[self._cursor]):
+                if queue.last_activity <= deadline:
+                    self.keepalives += 1
+                    await queue.request_keepalive()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "slots": len(self._slots),
+            "sessions": sum(len(slot) for slot in self._slots),
+            "ticks": self.ticks,
+            "keepalives": self.keepalives,
+        }
+
+
+keepalive = KeepAliveWheel()
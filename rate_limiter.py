@@ -0,0 +1,173 @@
+"""
+Планировщик исходящих запросов к AmoCRM.
+Token bucket с приоритетами: интерактивные вызовы (MCP-инструменты, вебхуки)
+обслуживаются раньше массовых отчётов. При 429 весь поток приостанавливается
+на Retry-After, повтор — с экспоненциальной задержкой и джиттером.
+
+Корзина своя у каждого процесса: при uvicorn --workers N лимит аккаунта
+делится поровну между воркерами (AMO_RATE_WORKERS, по умолчанию WEB_CONCURRENCY).
+"""
+
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Приоритеты (меньше — важнее)
+PRIORITY_INTERACTIVE = 0   # MCP tools/call, обработка вебхуков
+PRIORITY_NORMAL = 1        # обычные REST-запросы
+PRIORITY_BULK = 2          # отчёты, постраничные выгрузки, синхронизация
+
+AMO_RATE_LIMIT = float(os.getenv("AMO_RATE_LIMIT", "7"))          # запросов в секунду
+AMO_RATE_BURST = int(os.getenv("AMO_RATE_BURST", "7"))            # размер корзины
+# Число процессов, делящих лимит AMO_RATE_LIMIT/AMO_RATE_BURST (uvicorn берёт --workers из WEB_CONCURRENCY)
+AMO_RATE_WORKERS = max(1, int(os.getenv("AMO_RATE_WORKERS", os.getenv("WEB_CONCURRENCY", "1"))))
+AMO_RETRY_MAX = int(os.getenv("AMO_RETRY_MAX", "3"))              # повторов при 429
+AMO_RETRY_BASE = float(os.getenv("AMO_RETRY_BASE", "0.5"))        # базовая задержка, сек
+AMO_RETRY_MAX_DELAY = float(os.getenv("AMO_RETRY_MAX_DELAY", "30"))
+
+_current_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "amocrm_request_priority", default=PRIORITY_NORMAL
+)
+
+
+@contextmanager
+def priority(level: int):
+    """Задать приоритет исходящих запросов для текущей задачи."""
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_priority() -> int:
+    return _current_priority.get()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After: число секунд или HTTP-дата."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token bucket с очередью ожидающих по приоритету."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters: list = []  # heap: (priority, seq, future, enqueued_at)
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        # Метрики
+        self.granted = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+        self.retries = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if now < self._blocked_until:
+            self._updated = now
+            return
+        start = max(self._updated, self._blocked_until)
+        self._tokens = min(self.burst, self._tokens + (now - start) * self.rate)
+        self._updated = now
+
+    def _grant(self, enqueued_at: float) -> None:
+        self._tokens -= 1
+        self.granted += 1
+        wait = time.monotonic() - enqueued_at
+        if wait > 0.001:
+            self.waited += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    async def acquire(self, level: Optional[int] = None) -> None:
+        """Дождаться токена. Без очереди и при наличии токена — сразу."""
+        level = current_priority() if level is None else level
+        enqueued_at = time.monotonic()
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._grant(enqueued_at)
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (level, next(self._seq), future, enqueued_at))
+        if self._dispatcher is None or self._dispatcher.done() or self._dispatcher.get_loop() is not loop:
+            self._dispatcher = loop.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            self._refill()
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future, enqueued_at = heapq.heappop(self._waiters)
+            if future.done():  # ожидающий отменён
+                continue
+            self._grant(enqueued_at)
+            future.set_result(None)
+
+    def throttle(self, retry_after: Optional[float], attempt: int) -> float:
+        """
+        Реакция на 429: останавливаем выдачу токенов и возвращаем задержку
+        перед повтором (Retry-After или экспонента, плюс джиттер).
+        """
+        backoff = min(AMO_RETRY_MAX_DELAY, AMO_RETRY_BASE * (2 ** attempt))
+        delay = max(retry_after or 0.0, backoff) + random.uniform(0, backoff)
+        self.throttled += 1
+        self._blocked_until = max(self._blocked_until, time.monotonic() + (retry_after or backoff))
+        self._tokens = 0.0
+        return delay
+
+    def stats(self) -> dict:
+        depth = {}
+        for level, _, future, _ in self._waiters:
+            if not future.done():
+                depth[level] = depth.get(level, 0) + 1
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "workers": AMO_RATE_WORKERS,
+            "tokens": round(self._tokens, 2),
+            "queue_depth": sum(depth.values()),
+            "queue_depth_by_priority": depth,
+            "granted": self.granted,
+            "waited": self.waited,
+            "avg_wait_ms": round(self.total_wait / self.granted * 1000, 2) if self.granted else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "throttled_429": self.throttled,
+            "retries": self.retries,
+            "blocked_for_s": round(max(0.0, self._blocked_until - time.monotonic()), 2),
+        }
+
+
+limiter = RateLimiter(AMO_RATE_LIMIT / AMO_RATE_WORKERS, AMO_RATE_BURST // AMO_RATE_WORKERS)
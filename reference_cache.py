@@ -0,0 +1,225 @@
+"""
+Кэш справочных данных AmoCRM (воронки, пользователи, поля, причины отказа, аккаунт).
+TTL на каждый ресурс, LRU-ограничение размера и защита от stampede:
+одновременные промахи по одному ключу ждут один запрос к AmoCRM.
+Если обновление просроченной записи упало, отдаётся прежнее значение.
+"""
+
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+REF_CACHE_MAX_ENTRIES = int(os.getenv("REF_CACHE_MAX_ENTRIES", "256"))
+
+# TTL (сек.) по ресурсам; переопределяется REF_CACHE_TTL_<RESOURCE>
+RESOURCE_TTLS: Dict[str, float] = {
+    "account": 3600,
+    "pipelines": 300,
+    "users": 600,
+    "custom_fields": 600,
+    "loss_reasons": 1800,
+}
+for _name in RESOURCE_TTLS:
+    _env = os.getenv(f"REF_CACHE_TTL_{_name.upper()}")
+    if _env:
+        RESOURCE_TTLS[_name] = float(_env)
+
+# Разделы вебхука, прямо сообщающие об изменении справочника
+WEBHOOK_SECTIONS: Dict[str, Tuple[str, ...]] = {
+    "pipelines": ("pipelines",),
+    "statuses": ("pipelines",),
+    "users": ("users",),
+    "custom_fields": ("custom_fields",),
+    "loss_reasons": ("loss_reasons",),
+}
+
+# Поля сущностей в вебхуке, ссылающиеся на справочник: неизвестный ID — повод сбросить кэш
+WEBHOOK_REFERENCE_FIELDS: Dict[str, str] = {
+    "status_id": "pipelines",
+    "pipeline_id": "pipelines",
+    "responsible_user_id": "users",
+    "created_user_id": "users",
+    "modified_user_id": "users",
+}
+
+_FORM_KEY_RE = re.compile(r"\[([^\[\]]*)\]")
+
+
+def _is_cacheable(result: Any) -> bool:
+    """Ошибки AmoCRM приходят обычным JSON — их не кэшируем."""
+    if not isinstance(result, dict):
+        return False
+    if "error" in result or "code" in result:
+        return False
+    status = result.get("status")
+    return not (isinstance(status, int) and status >= 400)
+
+
+class ReferenceCache:
+    """TTL + LRU кэш с объединением одновременных промахов."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_served = 0
+
+    def peek(self, resource: str, key: Hashable = None) -> Optional[Any]:
+        """Значение из кэша без обращения к AmoCRM (или None)."""
+        entry = self._entries.get((resource, key))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    async def get_or_fetch(self, resource: str, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        cache_key = (resource, key)
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            if entry[0] >= time.monotonic():
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+
+        inflight = self._inflight.get(cache_key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        task = asyncio.ensure_future(self._fetch(cache_key, fetch))
+        task.add_done_callback(self._fetch_done)
+        self._inflight[cache_key] = task
+        # shield: отмена одного клиента не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _fetch(self, cache_key: Tuple[str, Hashable], fetch: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            try:
+                result = await fetch()
+            except Exception as e:
+                # Просроченная запись остаётся в кэше до успешного обновления
+                stale = self._entries.get(cache_key)
+                if stale is None:
+                    raise
+                self.stale_served += 1
+                logger.warning(f"Reference cache: не удалось обновить {cache_key[0]}, отдаём прежнее значение: {e}")
+                return stale[1]
+            # Если во время запроса пришла инвалидация — результат не сохраняем
+            if _is_cacheable(result) and self._inflight.get(cache_key) is asyncio.current_task():
+                ttl = RESOURCE_TTLS.get(cache_key[0], 300)
+                self._entries[cache_key] = (time.monotonic() + ttl, result)
+                self._entries.move_to_end(cache_key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            return result
+        finally:
+            if self._inflight.get(cache_key) is asyncio.current_task():
+                del self._inflight[cache_key]
+
+    @staticmethod
+    def _fetch_done(task: asyncio.Future) -> None:
+        """
+        Запрос живёт в фоне (shield): если все ожидающие ушли, исключение
+        иначе никто не заберёт. Забираем и пишем в лог.
+        """
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Reference cache: ошибка запроса к AmoCRM: {task.exception()}")
+
+    def invalidate(self, resource: Optional[str] = None) -> int:
+        """Сбросить ресурс целиком (или весь кэш). Возвращает число удалённых записей."""
+        keys = [k for k in self._entries if resource is None or k[0] == resource]
+        for k in keys:
+            del self._entries[k]
+        for k in [k for k in self._inflight if resource is None or k[0] == resource]:
+            del self._inflight[k]
+        self.invalidations += 1
+        return len(keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale_served": self.stale_served,
+            "ttl": RESOURCE_TTLS,
+        }
+
+
+cache = ReferenceCache(REF_CACHE_MAX_ENTRIES)
+
+
+# ---------- Инвалидация по вебхукам ----------
+
+def iter_webhook_fields(payload: Any, path: Tuple[str, ...] = ()) -> Iterable[Tuple[Tuple[str, ...], Any]]:
+    """
+    Пары (путь, значение) для JSON-вебхука и для плоского form-вебхука
+    вида leads[status][0][status_id]=142.
+    """
+    if isinstance(payload, dict):
+        for key, value in payload.items():
+            key = str(key)
+            if not path and "[" in key:
+                head = key.split("[", 1)[0]
+                yield (head, *_FORM_KEY_RE.findall(key)), value
+            else:
+                yield from iter_webhook_fields(value, path + (key,))
+    elif isinstance(payload, list):
+        for i, value in enumerate(payload):
+            yield from iter_webhook_fields(value, path + (str(i),))
+    elif path:
+        yield path, payload
+
+
+def _known_ids(resource: str) -> Optional[set]:
+    """ID из закэшированного полного списка ресурса (None — списка в кэше нет)."""
+    data = cache.peek(resource)
+    if not isinstance(data, dict):
+        return None
+    ids = set()
+    if resource == "pipelines":
+        for pipeline in data.get("_embedded", {}).get("pipelines", []):
+            ids.add(str(pipeline.get("id")))
+            for status in pipeline.get("_embedded", {}).get("statuses", []):
+                ids.add(str(status.get("id")))
+    elif resource == "users":
+        for user in data.get("_embedded", {}).get("users", []):
+            ids.add(str(user.get("id")))
+    return ids
+
+
+def invalidate_from_webhook(payload: Any) -> list:
+    """Сбросить справочники, изменение которых следует из вебхука. Возвращает их список."""
+    stale = set()
+    known: Dict[str, Optional[set]] = {}
+    for path, value in iter_webhook_fields(payload):
+        stale.update(WEBHOOK_SECTIONS.get(path[0], ()))
+        resource = WEBHOOK_REFERENCE_FIELDS.get(path[-1])
+        if resource is None or resource in stale or value in (None, "", 0, "0"):
+            continue
+        if resource not in known:
+            known[resource] = _known_ids(resource)
+        if known[resource] is not None and str(value) not in known[resource]:
+            stale.add(resource)
+
+    for resource in stale:
+        removed = cache.invalidate(resource)
+        logger.info(f"Reference cache: сброшен {resource} по вебхуку ({removed} записей)")
+    return sorted(stale)
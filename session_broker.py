@@ -0,0 +1,189 @@
+"""
+Брокер MCP SSE-сессий.
+SSE-стрим сессии живёт в одном воркере, а POST на /mcp/messages может попасть
+в любой (uvicorn --workers N, несколько контейнеров за балансировщиком).
+Брокер знает, где сессия, и доставляет ответ в очередь воркера-владельца.
+
+MCP_SESSION_BROKER=memory — один процесс (по умолчанию);
+MCP_SESSION_BROKER=redis  — владение сессиями и доставка через Redis (pub/sub).
+"""
+
+import os
+import uuid
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+import mcp_transport
+
+logger = logging.getLogger(__name__)
+
+MCP_SESSION_BROKER = os.getenv("MCP_SESSION_BROKER", "memory")
+MCP_REDIS_URL = os.getenv("MCP_REDIS_URL", "redis://localhost:6379/0")
+MCP_SESSION_TTL = int(os.getenv("MCP_SESSION_TTL", "120"))  # сек. жизни ключа сессии без продления
+
+
+class InMemoryBroker:
+    """Сессии только этого процесса."""
+
+    def __init__(self):
+        self.sessions: Dict[str, mcp_transport.SessionQueue] = {}
+        self.published = 0
+        self.undelivered = 0
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        self.sessions.clear()
+
+    async def register(self, session_id: str) -> mcp_transport.SessionQueue:
+        queue = mcp_transport.SessionQueue()
+        self.sessions[session_id] = queue
+        return queue
+
+    async def unregister(self, session_id: str) -> None:
+        self.sessions.pop(session_id, None)
+
+    async def exists(self, session_id: str) -> bool:
+        return session_id in self.sessions
+
+    async def publish(self, session_id: str, message: str) -> bool:
+        """Доставить сериализованное сообщение в SSE-стрим сессии."""
+        self.published += 1
+        queue = self.sessions.get(session_id)
+        if queue is None or not await queue.put(message):
+            self.undelivered += 1
+            return False
+        return True
+
+    def stats(self) -> dict:
+        queues = list(self.sessions.values())
+        return {
+            "backend": "memory",
+            "active": len(queues),
+            "queued_bytes": sum(q.queued_bytes for q in queues),
+            "max_queued_bytes": max((q.max_queued_bytes for q in queues), default=0),
+            "dropped": sum(q.dropped for q in queues),
+            "published": self.published,
+            "undelivered": self.undelivered,
+        }
+
+
+class RedisBroker(InMemoryBroker):
+    """
+    Локальные очереди + Redis: ключ mcp:session:<id> хранит узел-владелец (с TTL,
+    продлевается фоновой задачей), сообщения чужим сессиям уходят в канал
+    mcp:node:<node_id> владельца. client — любой совместимый с redis.asyncio клиент
+    (в тестах его можно подменить локальной заглушкой).
+    """
+
+    def __init__(self, client: Any = None, url: str = MCP_REDIS_URL, ttl: int = MCP_SESSION_TTL):
+        super().__init__()
+        self.url = url
+        self.ttl = ttl
+        self.node_id = uuid.uuid4().hex
+        self.channel = f"mcp:node:{self.node_id}"
+        self.client = client
+        self._pubsub = None
+        self._tasks: list = []
+        self.forwarded = 0
+        self.received = 0
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"mcp:session:{session_id}"
+
+    async def start(self) -> None:
+        if self.client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("MCP_SESSION_BROKER=redis требует пакет redis (pip install -r requirements-redis.txt)")
+            self.client = redis.from_url(self.url, decode_responses=True)
+        self._pubsub = self.client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._tasks = [
+            asyncio.create_task(self._listen(), name="mcp-broker-listen"),
+            asyncio.create_task(self._refresh(), name="mcp-broker-refresh"),
+        ]
+        logger.info(f"MCP session broker: redis, node={self.node_id}")
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.sessions:
+            await self.client.delete(*(self._key(sid) for sid in self.sessions))
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self.channel)
+            await self._pubsub.close()
+        await super().close()
+
+    async def register(self, session_id: str) -> mcp_transport.SessionQueue:
+        queue = await super().register(session_id)
+        await self.client.set(self._key(session_id), self.node_id, ex=self.ttl)
+        return queue
+
+    async def unregister(self, session_id: str) -> None:
+        await super().unregister(session_id)
+        await self.client.delete(self._key(session_id))
+
+    async def exists(self, session_id: str) -> bool:
+        return session_id in self.sessions or bool(await self.client.exists(self._key(session_id)))
+
+    async def publish(self, session_id: str, message: str) -> bool:
+        if session_id in self.sessions:
+            return await super().publish(session_id, message)
+        owner = await self.client.get(self._key(session_id))
+        if owner is None:
+            self.published += 1
+            self.undelivered += 1
+            return False
+        # ID сессии — uuid, сообщение — JSON без переводов строк: хватает разделителя \n
+        await self.client.publish(f"mcp:node:{owner}", f"{session_id}\n{message}")
+        self.forwarded += 1
+        return True
+
+    async def _listen(self) -> None:
+        async for item in self._pubsub.listen():
+            if item.get("type") != "message":
+                continue
+            data = item["data"]
+            if isinstance(data, bytes):
+                data = data.decode("utf-8")
+            session_id, _, message = data.partition("\n")
+            self.received += 1
+            try:
+                await super().publish(session_id, message)
+            except Exception as e:
+                logger.error(f"MCP session broker: ошибка доставки в {session_id}: {e}")
+
+    async def _refresh(self) -> None:
+        """Продлевать ключи живых сессий, пока стримы открыты."""
+        while True:
+            await asyncio.sleep(max(1.0, self.ttl / 3))
+            for session_id in list(self.sessions):
+                try:
+                    await self.client.expire(self._key(session_id), self.ttl)
+                except Exception as e:
+                    logger.warning(f"MCP session broker: не удалось продлить {session_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "backend": "redis",
+            "node_id": self.node_id,
+            "forwarded": self.forwarded,
+            "received": self.received,
+        }
+
+
+def create_broker(backend: Optional[str] = None):
+    backend = (backend or MCP_SESSION_BROKER).lower()
+    if backend == "memory":
+        return InMemoryBroker()
+    if backend == "redis":
+        return RedisBroker()
+    raise ValueError(f"Неизвестный MCP_SESSION_BROKER: {backend}")
@@ -0,0 +1,178 @@
+"""
+Фоновая дельта-синхронизация локального зеркала (entity_store) с AmoCRM.
+Для каждого типа хранится отметка updated_at: опрос запрашивает только
+изменённые с неё сущности (filter[updated_at][from]) вместо полного обхода.
+Удаления в дельте не видны — их приносят вебхуки и периодическая полная
+синхронизация (SYNC_FULL_INTERVAL).
+"""
+
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import Dict, Optional
+
+import chat_storage
+import entity_store
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "300"))                # сек. между дельта-опросами (0 — не опрашивать)
+SYNC_FULL_INTERVAL = float(os.getenv("SYNC_FULL_INTERVAL", "86400"))    # сек. между полными синхронизациями (0 — только первая)
+SYNC_OVERLAP = int(os.getenv("SYNC_OVERLAP", "60"))                     # сек. перекрытия окна (расхождение часов, запись во время обхода)
+SYNC_PAGE_CONCURRENCY = int(os.getenv("SYNC_PAGE_CONCURRENCY", "2"))    # страниц дельты в полёте
+SYNC_RUNNER_RETRY = float(os.getenv("SYNC_RUNNER_RETRY", "60"))         # сек. между попытками стать ведущим воркером
+
+
+class SyncEngine:
+    """
+    Один фоновый цикл на все воркеры: синхронизацию ведёт процесс, взявший
+    эксклюзивную блокировку файла рядом с БД зеркала; остальные только читают
+    зеркало и периодически пробуют перехватить блокировку (ОС снимает её,
+    если ведущий процесс завершился). Ведущий делает полную синхронизацию
+    типов, у которых её ещё не было (или она устарела), затем дельта-опросы
+    раз в SYNC_INTERVAL.
+    Отметка сдвигается на момент начала опроса минус SYNC_OVERLAP: сущности,
+    изменённые во время постраничного обхода, попадут в следующий опрос;
+    повторно прочитанные безвредны (upsert сравнивает updated_at).
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._runner_lock: Optional[sqlite3.Connection] = None
+        self.polls = 0
+        self.errors = 0
+        self.last: Dict[str, dict] = {}
+        self.next_poll_at: Optional[float] = None
+
+    async def start(self) -> None:
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="entity-sync-engine")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._release_runner()
+
+    @property
+    def is_runner(self) -> bool:
+        return self._runner_lock is not None
+
+    def trigger(self) -> bool:
+        """Опросить AmoCRM сейчас, не дожидаясь интервала; False — синхронизацию ведёт другой воркер."""
+        self._wake.set()
+        return self.is_runner
+
+    def _acquire_runner(self) -> bool:
+        """Взять блокировку ведущего без ожидания; держится открытым соединением до stop()."""
+        lock = sqlite3.connect(entity_store.ENTITY_DB_PATH + ".sync.lock", timeout=0, isolation_level=None)
+        try:
+            lock.execute("BEGIN EXCLUSIVE")
+        except sqlite3.OperationalError:
+            lock.close()
+            return False
+        self._runner_lock = lock
+        return True
+
+    def _release_runner(self) -> None:
+        if self._runner_lock is not None:
+            self._runner_lock.close()
+            self._runner_lock = None
+
+    async def _sleep(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self._wake.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def _run(self) -> None:
+        while not self._acquire_runner():
+            await self._sleep(SYNC_RUNNER_RETRY)
+        logger.info(f"Sync engine: синхронизацию ведёт этот процесс (pid {os.getpid()})")
+        while True:
+            await self.run_once()
+            if SYNC_INTERVAL <= 0:
+                return
+            self.next_poll_at = time.time() + SYNC_INTERVAL
+            await self._sleep(SYNC_INTERVAL)
+
+    async def run_once(self) -> None:
+        state = await chat_storage.run_in_db(entity_store.sync_state)
+        for entity_type in entity_store.ENTITY_TYPES:
+            try:
+                await self._sync_type(entity_type, state.get(entity_type) or {})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                self.last.setdefault(entity_type, {})["error"] = str(e)
+                logger.error(f"Sync engine: ошибка синхронизации {entity_type}: {e}")
+
+    async def _sync_type(self, entity_type: str, state: dict) -> None:
+        now = int(time.time())
+        full_sync_at = state.get("full_sync_at")
+        watermark = state.get("updated_watermark")
+        if (
+            full_sync_at is None
+            or watermark is None
+            or (SYNC_FULL_INTERVAL > 0 and now - full_sync_at >= SYNC_FULL_INTERVAL)
+        ):
+            result = await entity_store.mirror.full_sync(entity_type)
+            started_at = result["started_at"]
+            await chat_storage.run_in_db(entity_store.set_watermark, entity_type, started_at - SYNC_OVERLAP, started_at)
+            self.last[entity_type] = {"mode": "full", "at": started_at, **result}
+            return
+
+        started = time.monotonic()
+        result = await entity_store.mirror.delta_sync(entity_type, watermark, SYNC_PAGE_CONCURRENCY)
+        new_watermark = max(watermark, now - SYNC_OVERLAP)
+        await chat_storage.run_in_db(entity_store.set_watermark, entity_type, new_watermark, now)
+        self.polls += 1
+        self.last[entity_type] = {
+            "mode": "delta",
+            "at": now,
+            "since": watermark,
+            "items": result["items"],
+            "seconds": round(time.monotonic() - started, 2),
+        }
+        if result["items"]:
+            logger.info(f"Sync engine: {entity_type} — изменений с {watermark}: {result['items']}")
+
+    async def status(self) -> dict:
+        """Отметки, последний проход и отставание по каждому типу."""
+        now = int(time.time())
+        state = await chat_storage.run_in_db(entity_store.sync_state)
+        types = {}
+        for entity_type in entity_store.ENTITY_TYPES:
+            row = state.get(entity_type) or {}
+            synced_to = max(row.get("last_poll_at") or 0, row.get("full_sync_at") or 0)
+            types[entity_type] = {
+                "items": row.get("items", 0),
+                "full_sync_at": row.get("full_sync_at"),
+                "updated_watermark": row.get("updated_watermark"),
+                "last_poll_at": row.get("last_poll_at"),
+                "last_change_at": row.get("last_change_at"),
+                # Изменения старше этого момента уже в зеркале (вебхуки могут быть свежее)
+                "lag_seconds": now - synced_to if synced_to else None,
+                "last_run": self.last.get(entity_type),
+            }
+        return {
+            "enabled": entity_store.ENTITY_STORE_ENABLED,
+            "running": self._task is not None and not self._task.done(),
+            "runner": self.is_runner,
+            "syncing": entity_store.mirror.syncing,
+            "interval": SYNC_INTERVAL,
+            "full_interval": SYNC_FULL_INTERVAL,
+            "next_poll_in": round(max(0.0, self.next_poll_at - time.time()), 1) if self.next_poll_at else None,
+            "polls": self.polls,
+            "errors": self.errors,
+            "types": types,
+        }
+
+
+engine = SyncEngine()
@@ -0,0 +1,91 @@
+"""
+Миграции хранилища чатов на базе, созданной до версионных миграций
+(схема 1, PRAGMA user_version = 0), и последующее уплотнение.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+
+import pytest
+
+import chat_storage
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "chat.db")
+    monkeypatch.setattr(chat_storage, "CHAT_DB_PATH", path)
+    yield path
+    chat_storage.close_db()
+
+
+def _make_baseline_db(path: str, rows: int) -> None:
+    conn = sqlite3.connect(path)
+    conn.executescript(chat_storage.MIGRATIONS[0])
+    payload = json.dumps({"text": "x" * 2000, "author": {"type": "contact"}})
+    conn.executemany(
+        "INSERT INTO chat_messages (message_id, chat_id, lead_id, text, origin, created_at, raw_payload)"
+        " VALUES (?, 'chat', 1, 'привет', 'avito', 1700000000, ?)",
+        ((f"m{i}", payload) for i in range(rows)),
+    )
+    conn.commit()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+    conn.close()
+
+
+def test_baseline_db_is_compacted_after_migrations(db_path):
+    _make_baseline_db(db_path, 2000)
+    size_before = os.path.getsize(db_path)
+
+    chat_storage.init_db()
+    result = chat_storage.compact_db()
+    chat_storage.close_db()
+
+    assert result is not None
+    assert result["reason"].startswith("после миграций 1..")
+    assert os.path.getsize(db_path) < size_before / 2
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM chat_messages").fetchone()[0] == 2000
+    assert conn.execute("SELECT COUNT(*) FROM chat_message_payloads").fetchone()[0] == 2000
+    assert conn.execute("SELECT value FROM chat_meta WHERE key = 'vacuum_pending'").fetchone() is None
+    conn.close()
+
+
+def test_new_db_needs_no_compaction(db_path, monkeypatch):
+    monkeypatch.setattr(chat_storage, "CHAT_RETENTION_DAYS", 30)
+    chat_storage.init_db()
+    with chat_storage._reader() as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert chat_storage.compact_db() is None
+
+
+def test_reads_are_not_blocked_by_busy_writer(db_path):
+    chat_storage.init_db()
+    message = {"message_id": "m", "chat_id": "chat", "text": "привет", "created_at": 1700000000}
+
+    async def scenario():
+        # Писатель занят (как при VACUUM): записи ждут в очереди, чтение проходит
+        with chat_storage._writer_lock:
+            writes = [
+                asyncio.ensure_future(chat_storage.run_in_writer(chat_storage.save_messages, [dict(message, message_id=f"m{i}")]))
+                for i in range(chat_storage.CHAT_DB_READERS * 2)
+            ]
+            stats = await asyncio.wait_for(chat_storage.run_in_db(chat_storage.get_stats, 7), 5)
+            assert stats["total"] == 0
+        await asyncio.gather(*writes)
+        return await chat_storage.run_in_db(chat_storage.get_stats, 7)
+
+    assert asyncio.run(scenario())["total"] == chat_storage.CHAT_DB_READERS * 2
+
+
+def test_stats_group_missing_origin_under_empty_string(db_path):
+    chat_storage.init_db()
+    chat_storage.save_messages([
+        {"message_id": "a", "text": "1", "origin": "avito", "created_at": 1700000000},
+        {"message_id": "b", "text": "2", "origin": None, "created_at": 1700000000},
+        {"message_id": "c", "text": "3", "origin": "", "created_at": 1700000000},
+    ])
+    assert chat_storage.get_stats(7)["by_origin"] == {"": 2, "avito": 1}
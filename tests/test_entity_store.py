@@ -0,0 +1,47 @@
+"""
+Зеркало сущностей: сделки хранятся вместе с _embedded.companies, а зеркало,
+собранное без них, до новой полной синхронизации не читается.
+"""
+
+import sqlite3
+
+import pytest
+
+import entity_store
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "entities.db")
+    monkeypatch.setattr(entity_store, "ENTITY_DB_PATH", path)
+    yield path
+    entity_store.close_db()
+
+
+def test_leads_mirrored_without_companies_wait_for_full_sync(db_path):
+    conn = sqlite3.connect(db_path)
+    for number, step in enumerate(entity_store.MIGRATIONS[:2], start=1):
+        conn.executescript(f"BEGIN; {step}; PRAGMA user_version = {number}; COMMIT;")
+    conn.executemany(
+        "INSERT INTO entity_sync_state (entity_type, full_sync_at, updated_watermark) VALUES (?, 1700000000, 1700000000)",
+        [("leads",), ("contacts",)],
+    )
+    conn.commit()
+    conn.close()
+
+    entity_store.init_db()
+    assert entity_store.freshness("leads") is None
+    assert entity_store.freshness("contacts")["full_sync_at"] == 1700000000
+
+
+def test_lead_companies_are_stored(db_path):
+    assert "companies" in entity_store.ENTITY_WITH["leads"].split(",")
+    entity_store.init_db()
+    entity_store.upsert_entities("leads", [{
+        "id": 1,
+        "name": "Сделка",
+        "updated_at": 1700000000,
+        "_embedded": {"contacts": [{"id": 10}], "companies": [{"id": 20}]},
+    }])
+    assert entity_store.get_entity("leads", 1)["_embedded"]["companies"] == [{"id": 20}]
+    assert entity_store.linked_ids("leads", 1, "companies") == [20]
@@ -0,0 +1,32 @@
+"""
+Пакет запросов stdio-моста: невалидные элементы получают свою ошибку
+на своём месте, остальные запросы пачки выполняются.
+"""
+
+import asyncio
+
+import mcp_server
+
+
+def test_mixed_batch_keeps_order_and_valid_results(monkeypatch):
+    sent = []
+
+    async def fake_request(method, endpoint, data=None, params=None):
+        sent.append((method, endpoint))
+        return {"endpoint": endpoint}
+
+    monkeypatch.setattr(mcp_server, "make_request", fake_request)
+    results = asyncio.run(mcp_server.make_requests([
+        {"path": "/api/leads"},
+        {"path": 42},
+        {"path": None},
+        "not-an-object",
+        {"path": "api/no-slash"},
+        {"method": "post", "path": "/api/leads", "body": {"name": "x"}},
+    ]))
+
+    assert results[0] == {"endpoint": "/api/leads"}
+    assert results[1] == results[2] == results[4] == {"error": "'path' must start with '/'"}
+    assert results[3] == {"error": "call must be an object"}
+    assert results[5] == {"endpoint": "/api/leads"}
+    assert sent == [("GET", "/api/leads"), ("POST", "/api/leads")]
@@ -0,0 +1,60 @@
+"""
+Кэш справочников: при ошибке обновления остаётся прежнее значение,
+а исключение фонового запроса не теряется, даже если его никто не ждёт.
+"""
+
+import asyncio
+import logging
+
+import pytest
+
+import reference_cache
+
+
+async def _fail():
+    raise RuntimeError("amocrm down")
+
+
+def test_failed_refresh_serves_stale_value():
+    cache = reference_cache.ReferenceCache(8)
+
+    async def scenario():
+        async def ok():
+            return {"_embedded": {"pipelines": []}}
+
+        first = await cache.get_or_fetch("pipelines", None, ok)
+        # Запись просрочена: следующее обращение идёт в AmoCRM и падает
+        cache._entries[("pipelines", None)] = (0, first)
+        return first, await cache.get_or_fetch("pipelines", None, _fail)
+
+    first, second = asyncio.run(scenario())
+    assert second is first
+    assert cache.stats()["stale_served"] == 1
+
+
+def test_failed_fetch_without_stale_value_raises():
+    cache = reference_cache.ReferenceCache(8)
+    with pytest.raises(RuntimeError):
+        asyncio.run(cache.get_or_fetch("users", None, _fail))
+
+
+def test_abandoned_fetch_error_is_logged(caplog):
+    cache = reference_cache.ReferenceCache(8)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def slow_fail():
+            started.set()
+            await asyncio.sleep(0.01)
+            raise RuntimeError("amocrm down")
+
+        waiter = asyncio.ensure_future(cache.get_or_fetch("users", None, slow_fail))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.sleep(0.05)
+
+    with caplog.at_level(logging.ERROR, logger="reference_cache"):
+        asyncio.run(scenario())
+    assert "amocrm down" in caplog.text
+    assert "never retrieved" not in caplog.text
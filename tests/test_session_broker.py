@@ -0,0 +1,163 @@
+"""
+RedisBroker на локальной заглушке клиента: два брокера (два воркера) делят
+одно хранилище ключей и каналы pub/sub, как при общем Redis.
+"""
+
+import asyncio
+from typing import Dict, List, Optional
+
+import session_broker
+
+
+class FakeRedis:
+    """Подмножество redis.asyncio, которым пользуется RedisBroker."""
+
+    def __init__(self):
+        self.values: Dict[str, str] = {}
+        self.ttls: Dict[str, int] = {}
+        self.channels: Dict[str, List[asyncio.Queue]] = {}
+
+    async def set(self, key: str, value: str, ex: Optional[int] = None) -> None:
+        self.values[key] = value
+        if ex is not None:
+            self.ttls[key] = ex
+
+    async def get(self, key: str) -> Optional[str]:
+        return self.values.get(key)
+
+    async def exists(self, *keys: str) -> int:
+        return sum(key in self.values for key in keys)
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    async def expire(self, key: str, seconds: int) -> bool:
+        if key not in self.values:
+            return False
+        self.ttls[key] = seconds
+        return True
+
+    async def publish(self, channel: str, message: str) -> int:
+        subscribers = self.channels.get(channel, [])
+        for queue in subscribers:
+            queue.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(subscribers)
+
+    def pubsub(self) -> "FakePubSub":
+        return FakePubSub(self)
+
+
+class FakePubSub:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.subscribed: List[str] = []
+
+    async def subscribe(self, channel: str) -> None:
+        self.redis.channels.setdefault(channel, []).append(self.queue)
+        self.subscribed.append(channel)
+        self.queue.put_nowait({"type": "subscribe", "channel": channel, "data": 1})
+
+    async def unsubscribe(self, channel: str) -> None:
+        self.redis.channels.get(channel, []).remove(self.queue)
+        self.subscribed.remove(channel)
+
+    async def close(self) -> None:
+        pass
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+
+async def _get(queue, timeout: float = 1.0):
+    return await asyncio.wait_for(queue.get(), timeout)
+
+
+def test_register_sets_owner_key_and_unregister_removes_it():
+    async def scenario():
+        redis = FakeRedis()
+        broker = session_broker.RedisBroker(client=redis, ttl=30)
+        await broker.start()
+        try:
+            await broker.register("s1")
+            assert redis.values["mcp:session:s1"] == broker.node_id
+            assert redis.ttls["mcp:session:s1"] == 30
+            assert await broker.exists("s1")
+            await broker.unregister("s1")
+            assert "mcp:session:s1" not in redis.values
+            assert not await broker.exists("s1")
+        finally:
+            await broker.close()
+
+    asyncio.run(scenario())
+
+
+def test_publish_to_local_session_skips_redis():
+    async def scenario():
+        redis = FakeRedis()
+        broker = session_broker.RedisBroker(client=redis)
+        await broker.start()
+        try:
+            queue = await broker.register("s1")
+            assert await broker.publish("s1", '{"id":1}')
+            assert await _get(queue) == '{"id":1}'
+            assert broker.forwarded == 0
+        finally:
+            await broker.close()
+
+    asyncio.run(scenario())
+
+
+def test_publish_is_delivered_to_session_owned_by_another_worker():
+    async def scenario():
+        redis = FakeRedis()
+        owner = session_broker.RedisBroker(client=redis)
+        other = session_broker.RedisBroker(client=redis)
+        await owner.start()
+        await other.start()
+        try:
+            queue = await owner.register("s1")
+            assert await other.exists("s1")
+            assert await other.publish("s1", '{"jsonrpc":"2.0","id":7,"result":{}}')
+            assert await _get(queue) == '{"jsonrpc":"2.0","id":7,"result":{}}'
+            assert other.forwarded == 1
+            assert owner.received == 1
+        finally:
+            await other.close()
+            await owner.close()
+
+    asyncio.run(scenario())
+
+
+def test_publish_to_unknown_session_is_undelivered():
+    async def scenario():
+        redis = FakeRedis()
+        broker = session_broker.RedisBroker(client=redis)
+        await broker.start()
+        try:
+            assert not await broker.exists("missing")
+            assert not await broker.publish("missing", "{}")
+            assert broker.stats()["undelivered"] == 1
+        finally:
+            await broker.close()
+
+    asyncio.run(scenario())
+
+
+def test_close_releases_owned_sessions():
+    async def scenario():
+        redis = FakeRedis()
+        owner = session_broker.RedisBroker(client=redis)
+        other = session_broker.RedisBroker(client=redis)
+        await owner.start()
+        await other.start()
+        try:
+            await owner.register("s1")
+            await owner.close()
+            assert not await other.exists("s1")
+            assert owner.channel not in [c for c, subs in redis.channels.items() if subs]
+        finally:
+            await other.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,185 @@
+"""
+Реестр MCP-инструментов.
+Инструмент регистрируется декоратором вместе со схемой аргументов; из схемы
+заранее собирается проверка/приведение аргументов, из реестра строится
+список MCP_TOOLS, а вызов — поиск обработчика по имени в словаре.
+Плохие аргументы отклоняются до любого запроса к AmoCRM.
+"""
+
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+
+class ToolArgumentError(ValueError):
+    """Неизвестный инструмент или некорректные аргументы (JSON-RPC -32602)."""
+
+
+def parse_timestamp(value: Any) -> int:
+    """Unix timestamp из числа или строки: "1700000000", "2024-05-01", "2024-05-01T10:00:00Z"."""
+    if isinstance(value, bool):
+        raise ValueError(f"ожидается дата, получено {value!r}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    return int(datetime.fromisoformat(text.replace("Z", "+00:00")).timestamp())
+
+
+def _as_string(value: Any) -> str:
+    if isinstance(value, (dict, list)):
+        raise ValueError("ожидается строка")
+    return str(value)
+
+
+def _as_integer(value: Any) -> int:
+    if isinstance(value, bool):
+        raise ValueError("ожидается целое число")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError("ожидается целое число")
+        return int(value)
+    return int(value)
+
+
+def _as_number(value: Any):
+    if isinstance(value, bool):
+        raise ValueError("ожидается число")
+    number = value if isinstance(value, (int, float)) else float(value)
+    # ID и лимиты приходят как number: 42.0 в query string должно стать 42
+    return int(number) if isinstance(number, float) and number.is_integer() else number
+
+
+def _as_boolean(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    if value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ("true", "false", "1", "0"):
+        return value.strip().lower() in ("true", "1")
+    raise ValueError("ожидается true/false")
+
+
+def _as_object(value: Any) -> dict:
+    if not isinstance(value, dict):
+        raise ValueError("ожидается объект")
+    return value
+
+
+def _as_array(value: Any) -> list:
+    if not isinstance(value, list):
+        raise ValueError("ожидается массив")
+    return value
+
+
+_COERCERS: Dict[str, Callable[[Any], Any]] = {
+    "string": _as_string,
+    "integer": _as_integer,
+    "number": _as_number,
+    "boolean": _as_boolean,
+    "object": _as_object,
+    "array": _as_array,
+}
+
+# Нестандартный format в схеме: строка или число, приводится к unix timestamp
+_FORMAT_COERCERS: Dict[str, Callable[[Any], Any]] = {
+    "timestamp": parse_timestamp,
+}
+
+
+class Tool:
+    """Инструмент: обработчик, схема и собранная из неё проверка аргументов."""
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        handler: Callable[[dict], Awaitable[Any]],
+        properties: Dict[str, dict],
+        required: Sequence[str] = (),
+    ):
+        self.name = name
+        self.description = description
+        self.handler = handler
+        self.properties = properties
+        self.required = tuple(required)
+        # (имя, приведение, значение по умолчанию, допустимые значения)
+        self._fields = [
+            (
+                field,
+                _FORMAT_COERCERS.get(spec.get("format")) or _COERCERS.get(spec.get("type"), lambda v: v),
+                spec.get("default"),
+                frozenset(spec["enum"]) if "enum" in spec else None,
+            )
+            for field, spec in properties.items()
+        ]
+
+    def validate(self, args: Optional[dict]) -> dict:
+        """Аргументы по схеме: приведение типов, значения по умолчанию, required и enum."""
+        if args is None:
+            args = {}
+        if not isinstance(args, dict):
+            raise ToolArgumentError(f"{self.name}: arguments должен быть объектом")
+        for field in self.required:
+            if args.get(field) is None:
+                raise ToolArgumentError(f"{self.name}: не указан обязательный аргумент {field}")
+        result = {}
+        for field, coerce, default, allowed in self._fields:
+            value = args.get(field)
+            if value is None:
+                if default is not None:
+                    result[field] = default
+                continue
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError) as e:
+                raise ToolArgumentError(f"{self.name}: аргумент {field}: {e}")
+            if allowed is not None and value not in allowed:
+                raise ToolArgumentError(f"{self.name}: аргумент {field} должен быть одним из {sorted(allowed)}")
+            result[field] = value
+        return result
+
+    def schema(self) -> dict:
+        input_schema = {"type": "object", "properties": self.properties}
+        if self.required:
+            input_schema["required"] = list(self.required)
+        return {"name": self.name, "description": self.description, "inputSchema": input_schema}
+
+
+class ToolRegistry:
+    def __init__(self):
+        self._tools: Dict[str, Tool] = {}
+
+    def tool(
+        self,
+        name: str,
+        description: str,
+        properties: Optional[Dict[str, dict]] = None,
+        required: Sequence[str] = (),
+    ):
+        """Декоратор: зарегистрировать async-обработчик handler(args) под именем name."""
+        def register(handler: Callable[[dict], Awaitable[Any]]):
+            if name in self._tools:
+                raise ValueError(f"Инструмент {name} уже зарегистрирован")
+            self._tools[name] = Tool(name, description, handler, properties or {}, required)
+            return handler
+        return register
+
+    def __getitem__(self, name: str) -> Tool:
+        tool = self._tools.get(name)
+        if tool is None:
+            raise ToolArgumentError(f"Unknown tool: {name}")
+        return tool
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def list_tools(self) -> List[dict]:
+        """Описание инструментов для tools/list."""
+        return [tool.schema() for tool in self._tools.values()]
+
+    async def call(self, name: str, args: Optional[dict]) -> Any:
+        tool = self[name]
+        return await tool.handler(tool.validate(args))
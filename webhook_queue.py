@@ -0,0 +1,123 @@
+"""
+Очередь входящих вебхуков AmoCRM.
+Обработчик HTTP только проверяет тело и кладёт его в ограниченную очередь,
+ответ уходит сразу; фоновые воркеры разбирают очередь пачками.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "50"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+
+
+class WebhookQueue:
+    """Ограниченная очередь с пулом воркеров и обработкой микропачками."""
+
+    def __init__(
+        self,
+        handler: Callable[[List[Any]], Awaitable[None]],
+        maxsize: int = WEBHOOK_QUEUE_SIZE,
+        workers: int = WEBHOOK_WORKERS,
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+    ):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._accepting = False
+        # Метрики
+        self.enqueued = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.last_batch_ms = 0.0
+        self.last_lag_ms = 0.0
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._accepting = True
+        self._tasks = [
+            asyncio.create_task(self._worker(i), name=f"webhook-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Webhook queue: size={self.maxsize}, workers={self.workers}, batch={self.batch_size}")
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        """Перестать принимать и дообработать очередь (не дольше timeout)."""
+        self._accepting = False
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Webhook queue: при остановке не обработано {self._queue.qsize()} вебхуков")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, payload: Any) -> bool:
+        """Положить вебхук в очередь. False — очередь переполнена или остановлена."""
+        if not self._accepting or self._queue is None:
+            self.rejected += 1
+            return False
+        try:
+            self._queue.put_nowait((time.monotonic(), payload))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            items = [await self._queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            started = time.monotonic()
+            try:
+                await self.handler([payload for _, payload in items])
+                self.processed += len(items)
+            except Exception as e:
+                self.failed += len(items)
+                logger.error(f"Webhook worker {number}: ошибка обработки пачки из {len(items)}: {e}")
+            finally:
+                finished = time.monotonic()
+                self.batches += 1
+                self.last_batch_ms = (finished - started) * 1000
+                self.last_lag_ms = (finished - items[0][0]) * 1000
+                for _ in items:
+                    self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "maxsize": self.maxsize,
+            "max_depth": self.max_depth,
+            "workers": self.workers,
+            "batch_size": self.batch_size,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "avg_batch": round(self.processed / self.batches, 2) if self.batches else 0.0,
+            "last_batch_ms": round(self.last_batch_ms, 2),
+            "last_lag_ms": round(self.last_lag_ms, 2),
+        }